@@ -1,7 +1,15 @@
 from pathlib import Path
-from typing import Literal, Callable
+from threading import Lock
+from typing import Literal, Callable, BinaryIO, Iterator, Iterable
+import bisect
+import heapq
+import hashlib
+import struct
 import json
 import logging
+import time
+import zlib
+import os
 
 import numpy as np
 import hnswlib
@@ -11,33 +19,1055 @@ from utils import FileOperation
 
 
 
+# 分段二进制文件：魔数 + 头部长度 + JSON头部(各段的偏移与长度及其他元信息) + 按8字节对齐的各段数据。
+# 读取时以写时复制方式内存映射，各段直接作为NumPy数组的视图使用；写入时较大的段可以给出(长度, 分块迭代器)
+class SectionFile(object):
+    @staticmethod
+    def has_magic(path: str | Path, magic: bytes) -> bool:
+        with open(path, "rb") as f:
+            return f.read(len(magic)) == magic
+
+    @staticmethod
+    def read(path: str | Path, magic: bytes) -> tuple[np.memmap, dict]:
+        mapping = np.memmap(path, dtype=np.uint8, mode="c")
+        if bytes(mapping[:8]) != magic:
+            raise ValueError(f"索引文件格式不正确: {path}")
+        header_length = int(mapping[8:16].view(np.uint64)[0])
+        header = json.loads(bytes(mapping[16: 16 + header_length]).decode("utf-8"))
+        return mapping, header
+
+    @staticmethod
+    def section(mapping: np.memmap, header: dict, name: str, dtype: np.dtype, shape: tuple = ()) -> np.ndarray:
+        offset, length = header["sections"][name]
+        return mapping[offset: offset + length].view(dtype).reshape(-1, *shape)
+
+    @staticmethod
+    def write(
+            path: str | Path,
+            magic: bytes,
+            header: dict,
+            sections: dict[str, bytes | tuple[int, Iterable[bytes]]]
+        ) -> None:
+        layout = {}
+        offset = 0
+        for name, data in sections.items():
+            length = len(data) if isinstance(data, bytes) else data[0]
+            layout[name] = [offset, length]
+            offset += (length + 7) // 8 * 8
+        # 头部里的偏移依赖头部自身的长度，反复计算直到数据起始位置不再变化
+        data_start = 0
+        while True:
+            header["sections"] = {name: [data_start + start, length] for name, (start, length) in layout.items()}
+            header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+            required_start = (16 + len(header_bytes) + 7) // 8 * 8
+            if required_start <= data_start:
+                break
+            data_start = required_start
+        header_bytes = header_bytes.ljust(data_start - 16)
+        with open(path, "wb") as f:
+            f.write(magic + np.uint64(len(header_bytes)).tobytes() + header_bytes)
+            for name, data in sections.items():
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    for chunk in data[1]:
+                        f.write(chunk)
+                length = layout[name][1]
+                f.write(b"\0" * ((length + 7) // 8 * 8 - length))
+
+
+
+# HNSW近似检索后端，容量从index_capacity起按需成倍扩大，当前容量由hnswlib随索引文件一起保存
+class HnswBackend(object):
+    def __init__(
+            self,
+            space: Literal["l2", "cosine"],
+            dim: int,
+            capacity: int,
+            hnsw_m: int,
+            ef_construction: int,
+            ef_search: int
+        ) -> None:
+        self.__space: Literal["l2", "cosine"] = space
+        self.__dim: int = dim
+        self.__capacity: int = capacity
+        self.__ef_search: int = ef_search
+        self.__hnsw_index = hnswlib.Index(space=space, dim=dim)
+        self.__hnsw_index.init_index(
+            max_elements=capacity,
+            ef_construction=ef_construction,
+            M=hnsw_m,
+            random_seed=42
+        )
+
+    @property
+    def element_count(self) -> int:
+        return self.__hnsw_index.get_current_count()
+
+    def load(self, index_path: str | Path) -> None:
+        self.__hnsw_index = hnswlib.Index(space=self.__space, dim=self.__dim)
+        self.__hnsw_index.load_index(str(index_path))
+        # 旧版本按固定容量预分配，加载后收缩到与实际数量相称的大小
+        capacity = max(self.__capacity, self.element_count * 2)
+        if self.__hnsw_index.get_max_elements() > capacity * 2:
+            self.__hnsw_index.resize_index(capacity)
+
+    def save(self, index_path: str | Path) -> None:
+        self.snapshot()(index_path)
+
+    def snapshot(self) -> Callable[[str | Path], None]:
+        # 复制一份索引(已删除的标记一并复制)，写文件时不必再持有锁
+        hnsw_index = hnswlib.Index(self.__hnsw_index)
+        return lambda index_path: hnsw_index.save_index(str(index_path))
+
+    def reserve(self, ids: list[int]) -> None:
+        required = self.element_count + len(ids)
+        capacity = self.__hnsw_index.get_max_elements()
+        if required <= capacity:
+            return
+        while capacity < required:
+            capacity *= 2
+        self.__hnsw_index.resize_index(capacity)
+
+    def add(self, fvs: np.ndarray, ids: list[int]) -> None:
+        self.__hnsw_index.add_items(fvs, ids)
+
+    def delete(self, idx: int) -> None:
+        self.__hnsw_index.mark_deleted(idx)
+
+    def restore(self, idx: int) -> None:
+        self.__hnsw_index.unmark_deleted(idx)
+
+    def search(self, fv: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # ef至少为2k，与原先固定的max(100, 2k)一致，k较大时召回率不下降
+        self.__hnsw_index.set_ef(max(self.__ef_search, 2 * k))
+        labels, distances = self.__hnsw_index.knn_query(fv, k=k)
+        return distances[0], labels[0]
+
+    def get_items(self, ids: list[int]) -> np.ndarray:
+        return np.asarray(self.__hnsw_index.get_items(ids), dtype=np.float32)
+
+    def iter_items(self, batch_size: int = 4096) -> Iterator[tuple[list[int], np.ndarray, np.ndarray]]:
+        # 连同已删除的向量一起按批给出(附删除掩码)。已删除的向量取不出来，所在批次逐个区分，
+        # 再在索引的副本上取消删除标记后读取，不影响同时进行的查询
+        source = self.__hnsw_index
+        ids = sorted(source.get_ids_list())
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start: start + batch_size]
+            try:
+                yield batch, np.asarray(source.get_items(batch), dtype=np.float32), np.zeros(len(batch), dtype=bool)
+                continue
+            except RuntimeError:
+                pass
+            deleted = np.zeros(len(batch), dtype=bool)
+            for i, idx in enumerate(batch):
+                try:
+                    source.get_items([idx])
+                except RuntimeError:
+                    deleted[i] = True
+            if source is self.__hnsw_index:
+                source = hnswlib.Index(self.__hnsw_index)
+            for idx in np.asarray(batch)[deleted].tolist():
+                source.unmark_deleted(idx)
+            yield batch, np.asarray(source.get_items(batch), dtype=np.float32), deleted
+
+
+
+# 精确的暴力检索后端：以位置为行号把向量存放在连续矩阵中(cosine时先归一化)，查询为分块的矩阵-向量乘法加argpartition，
+# 已删除的行按状态屏蔽。可选float16或按维度缩放的int8存储。use_mmap时加载的矩阵以写时复制方式映射，
+# 只是推迟了读入：第一次扩容或快照(Windows下被映射的文件无法替换)时整体复制到内存，之后与不映射时相同，不能降低常驻内存。
+# 量化存储且rerank_factor大于0时，完整精度的向量按行号写在索引文件旁的.f32文件中并内存映射，
+# 查询先用量化向量选出k*rerank_factor个候选，再读取候选的完整向量精确排序。
+# .f32文件原地修改、不随检查点替换，因此带有代数(.f32.gen)：快照后第一次修改前先递增代数并落盘，
+# 快照时fsync旁路文件并把代数记在索引头部，加载时两者一致才使用旁路文件，否则由量化的向量还原
+class FlatBackend(object):
+    MAGIC = b"VFFLATIX"
+    EMPTY = 0
+    LIVE = 1
+    DELETED = 2
+    BLOCK_ROWS = 16384
+    # 量化存储需逐块转换为float32再相乘，块小一些使转换结果留在缓存中
+    QUANTIZED_BLOCK_ROWS = 2048
+    # int8的缩放系数不够用时多放大一些，避免每批新向量都要重新量化已有的行
+    SCALE_HEADROOM = 1.25
+    def __init__(
+            self,
+            space: Literal["l2", "cosine"],
+            dim: int,
+            capacity: int,
+            dtype: Literal["float32", "float16", "int8"] = "float32",
+            use_mmap: bool = False,
+            index_path: str | Path | None = None,
+            rerank_factor: int = 0
+        ) -> None:
+        self.__space: Literal["l2", "cosine"] = space
+        self.__dim: int = dim
+        self.__dtype = np.dtype(dtype)
+        self.__use_mmap: bool = use_mmap
+        self.__mapping: np.memmap | None = None
+        self.__rows = 0
+        self.__element_count = 0
+        self.__live_count = 0
+        self.__vectors = np.zeros((capacity, dim), dtype=self.__dtype)
+        # 每个维度的缩放系数：存储值 * 系数 = 原始值，只有int8需要，浮点存储时为1
+        self.__scales = np.zeros(dim, dtype=np.float32) if self.__dtype == np.int8 else np.ones(dim, dtype=np.float32)
+        # l2距离用到的各行模长平方(按完整精度计算)
+        self.__norms = np.zeros(capacity, dtype=np.float32)
+        self.__states = np.zeros(capacity, dtype=np.uint8)
+        self.__rerank_factor: int = rerank_factor
+        self.__side_path: Path | None = Path(index_path).with_suffix(".f32") if index_path is not None else None
+        self.__full_path: Path | None = None
+        if rerank_factor > 0 and self.__dtype != np.float32:
+            self.__full_path = self.__side_path
+        self.__full: np.memmap | None = None
+        self.__full_generation = 0
+        # 旁路文件的内容与最近一次快照记录的代数一致，再修改前需要先递增代数
+        self.__full_committed = True
+
+    @property
+    def element_count(self) -> int:
+        return self.__element_count
+
+    @property
+    def uses_side_files(self) -> bool:
+        return self.__full_path is not None
+
+    @staticmethod
+    def side_files(index_path: str | Path) -> list[Path]:
+        side_path = Path(index_path).with_suffix(".f32")
+        return [side_path, side_path.with_name(side_path.name + ".gen")]
+
+    def load(self, index_path: str | Path) -> None:
+        mapping, header = SectionFile.read(index_path, FlatBackend.MAGIC)
+        if header["space"] != self.__space or header["dim"] != self.__dim:
+            raise ValueError("向量索引的距离类型或维度与配置不一致")
+        stored_dtype = np.dtype(header["dtype"])
+        vectors = SectionFile.section(mapping, header, "vectors", stored_dtype, (self.__dim, ))
+        norms = SectionFile.section(mapping, header, "norms", np.float32)
+        states = SectionFile.section(mapping, header, "states", np.uint8)
+        stored_scales = np.ones(self.__dim, dtype=np.float32)
+        if "scales" in header["sections"]:
+            stored_scales = np.array(SectionFile.section(mapping, header, "scales", np.float32))
+        rows = header["rows"]
+        if self.__use_mmap and stored_dtype == self.__dtype:
+            self.__mapping = mapping
+            self.__norms, self.__states = norms, states
+        else:
+            self.__norms, self.__states = np.array(norms), np.array(states)
+        # 完整精度的向量：旁路文件的代数与索引记录的一致时直接使用；不一致说明快照之后有过修改，
+        # 快照之后写入的行由日志重放重新写入，其余的行与量化的向量核对，只还原对不上的行；没有旁路文件时全部还原
+        self.__reserve_full(len(self.__states))
+        stored_full = None
+        if header.get("rerank", False) and self.__side_path is not None and self.__side_path.exists():
+            stored_full = np.memmap(self.__side_path, dtype=np.float32, mode="r").reshape(-1, self.__dim)
+            stored_generation = self.__read_full_generation()
+            self.__full_generation = max(header.get("rerank_generation", 0), stored_generation or 0)
+            if header.get("rerank_generation") != stored_generation:
+                stored_full = self.__repair_full(stored_full, vectors, states, stored_scales, rows)
+        if self.__full is not None and stored_full is None:
+            self.__mark_full_dirty()
+            for start in range(0, rows, FlatBackend.BLOCK_ROWS):
+                end = min(start + FlatBackend.BLOCK_ROWS, rows)
+                self.__full[start: end] = vectors[start: end].astype(np.float32) * stored_scales
+        if stored_dtype == self.__dtype:
+            self.__scales = stored_scales
+            self.__vectors = vectors if self.__mapping is not None else np.array(vectors)
+            self.__rows = rows
+        else:
+            # 存储类型变了，重新量化
+            self.__vectors = np.zeros((len(self.__states), self.__dim), dtype=self.__dtype)
+            for start in range(0, rows, FlatBackend.BLOCK_ROWS):
+                end = min(start + FlatBackend.BLOCK_ROWS, rows)
+                if stored_full is not None:
+                    fvs = np.array(stored_full[start: end])
+                elif self.__full is not None:
+                    fvs = np.array(self.__full[start: end])
+                else:
+                    fvs = vectors[start: end].astype(np.float32) * stored_scales
+                self.__vectors[start: end] = self.__encode(fvs)
+                self.__rows = end
+        self.__element_count = int(np.count_nonzero(self.__states))
+        self.__live_count = int(np.count_nonzero(self.__states == FlatBackend.LIVE))
+
+    def __repair_full(
+            self,
+            stored_full: np.ndarray,
+            vectors: np.ndarray,
+            states: np.ndarray,
+            stored_scales: np.ndarray,
+            rows: int
+        ) -> np.ndarray | None:
+        # 量化误差不超过几个缩放步长(int8多次放大系数后每次再取整)或float16的相对精度，
+        # 超出的行说明旁路文件中是另一个向量，按量化的向量还原
+        if len(stored_full) < rows:
+            logging.error("完整精度向量文件不完整，将由量化的向量还原")
+            return None
+        if vectors.dtype == np.int8:
+            tolerance = stored_scales * 3 + 1e-6
+        repaired = 0
+        writable = False
+        for start in range(0, rows, FlatBackend.BLOCK_ROWS):
+            end = min(start + FlatBackend.BLOCK_ROWS, rows)
+            approx = vectors[start: end].astype(np.float32) * stored_scales
+            if vectors.dtype != np.int8:
+                tolerance = np.abs(approx) * np.finfo(vectors.dtype).eps + 1e-6
+            bad = np.flatnonzero(
+                (np.abs(stored_full[start: end] - approx) > tolerance).any(axis=1) & (states[start: end] != FlatBackend.EMPTY)
+            )
+            if len(bad) == 0:
+                continue
+            if not writable:
+                self.__mark_full_dirty()
+                stored_full = np.memmap(self.__side_path, dtype=np.float32, mode="r+").reshape(-1, self.__dim)
+                writable = True
+            stored_full[start + bad] = approx[bad]
+            repaired += len(bad)
+        if repaired > 0:
+            logging.error(f"完整精度向量文件与索引不一致，已由量化的向量还原{repaired}行")
+        return stored_full
+
+    def __release_mapping(self) -> None:
+        # Windows下被映射的文件无法被替换，写新文件前先整体复制到内存，此后不再映射
+        if self.__mapping is None:
+            return
+        self.__vectors = np.array(self.__vectors)
+        self.__norms = np.array(self.__norms)
+        self.__states = np.array(self.__states)
+        self.__mapping = None
+
+    def __generation_path(self) -> Path:
+        return FlatBackend.side_files(self.__side_path)[1]
+
+    def __read_full_generation(self) -> int | None:
+        try:
+            with open(self.__generation_path(), "r", encoding="utf-8") as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def __mark_full_dirty(self) -> None:
+        # 原地修改旁路文件之前先让代数与已保存的索引不同，中途崩溃时加载就不会信任写了一半的内容
+        if not self.__full_committed:
+            return
+        self.__full_generation = max(self.__full_generation, self.__read_full_generation() or 0) + 1
+        with open(self.__generation_path(), "w", encoding="utf-8") as f:
+            f.write(str(self.__full_generation))
+            f.flush()
+            os.fsync(f.fileno())
+        self.__full_committed = False
+
+    def __reserve_full(self, rows: int) -> None:
+        # 旁路文件只增不减，扩展前先解除映射
+        if self.__full_path is None or (self.__full is not None and len(self.__full) >= rows):
+            return
+        self.__full = None
+        row_bytes = self.__dim * 4
+        with open(self.__full_path, "ab") as f:
+            f.truncate(max(rows, f.tell() // row_bytes, 1) * row_bytes)
+        self.__full = np.memmap(self.__full_path, dtype=np.float32, mode="r+").reshape(-1, self.__dim)
+
+    def save(self, index_path: str | Path) -> None:
+        self.snapshot()(index_path)
+
+    def snapshot(self) -> Callable[[str | Path], None]:
+        self.__release_mapping()
+        if self.__full is not None:
+            self.__full.flush()
+        rerank = self.__full is not None
+        header = {
+            "space": self.__space,
+            "dim": self.__dim,
+            "dtype": self.__dtype.name,
+            "rows": self.__rows,
+            "rerank": rerank,
+            "rerank_generation": self.__full_generation
+        }
+        # 此后的修改会先递增代数；这次快照没能提交时，磁盘上的旧索引记录的代数也与之不同
+        self.__full_committed = True
+        sections = {
+            "states": self.__states[:self.__rows].tobytes(),
+            "norms": self.__norms[:self.__rows].tobytes(),
+            "scales": self.__scales.tobytes(),
+            "vectors": self.__vectors[:self.__rows].tobytes()
+        }
+
+        def write(index_path: str | Path) -> None:
+            # 检查点提交前旁路文件必须已经落盘
+            if rerank:
+                FileOperation.fsync_file(self.__full_path)
+            SectionFile.write(index_path, FlatBackend.MAGIC, header, sections)
+
+        return write
+
+    def reserve(self, ids: list[int]) -> None:
+        required = max(ids) + 1 if len(ids) > 0 else 0
+        capacity = len(self.__states)
+        if required > capacity:
+            capacity = max(capacity, 1024)
+            while capacity < required:
+                capacity *= 2
+            vectors = np.zeros((capacity, self.__dim), dtype=self.__dtype)
+            norms = np.zeros(capacity, dtype=np.float32)
+            states = np.zeros(capacity, dtype=np.uint8)
+            vectors[:self.__rows] = self.__vectors[:self.__rows]
+            norms[:self.__rows] = self.__norms[:self.__rows]
+            states[:self.__rows] = self.__states[:self.__rows]
+            self.__vectors, self.__norms, self.__states = vectors, norms, states
+            self.__mapping = None
+        self.__reserve_full(capacity)
+
+    def __normalize(self, fvs: np.ndarray) -> np.ndarray:
+        fvs = np.asarray(fvs, dtype=np.float32).reshape(-1, self.__dim)
+        if self.__space == "cosine":
+            fvs = fvs / np.maximum(np.linalg.norm(fvs, axis=1, keepdims=True), 1e-12)
+        return fvs
+
+    def fit_scales(self, fvs: np.ndarray) -> None:
+        # int8存储时按即将写入的向量提前放大缩放系数；重新量化已有的行会改动查询读取的矩阵，调用方持有锁。
+        # 之后的add中缩放系数已经够用，不再修改已有的行
+        if self.__dtype == np.int8:
+            self.__grow_scales(np.abs(self.__normalize(fvs)).max(axis=0, initial=0) / 127)
+
+    def __encode(self, fvs: np.ndarray) -> np.ndarray:
+        if self.__dtype != np.int8:
+            return fvs.astype(self.__dtype)
+        self.__grow_scales(np.abs(fvs).max(axis=0, initial=0) / 127)
+        return np.clip(np.rint(fvs / np.where(self.__scales > 0, self.__scales, 1)), -127, 127).astype(np.int8)
+
+    def __grow_scales(self, required: np.ndarray) -> None:
+        # 超出范围的维度放大缩放系数，已有的行按新旧系数之比重新量化
+        grow = np.flatnonzero(required > self.__scales)
+        if len(grow) == 0:
+            return
+        scales = self.__scales.copy()
+        scales[grow] = np.where(self.__scales[grow] > 0, required[grow] * FlatBackend.SCALE_HEADROOM, required[grow])
+        columns = grow[self.__scales[grow] > 0]
+        if len(columns) > 0:
+            ratios = self.__scales[columns] / scales[columns]
+            for start in range(0, self.__rows, FlatBackend.BLOCK_ROWS):
+                end = min(start + FlatBackend.BLOCK_ROWS, self.__rows)
+                block = self.__vectors[start: end, columns].astype(np.float32) * ratios
+                self.__vectors[start: end, columns] = np.rint(block).astype(np.int8)
+        self.__scales = scales
+
+    def add(self, fvs: np.ndarray, ids: list[int]) -> None:
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        fvs = self.__normalize(fvs)
+        previous_states = self.__states[ids]
+        self.__vectors[ids] = self.__encode(fvs)
+        if self.__full is not None:
+            self.__mark_full_dirty()
+            self.__full[ids] = fvs
+        self.__norms[ids] = np.einsum("ij,ij->i", fvs, fvs)
+        self.__states[ids] = FlatBackend.LIVE
+        self.__element_count += int(np.count_nonzero(previous_states == FlatBackend.EMPTY))
+        self.__live_count += int(np.count_nonzero(previous_states != FlatBackend.LIVE))
+        self.__rows = max(self.__rows, int(ids.max()) + 1) if len(ids) > 0 else self.__rows
+
+    def delete(self, idx: int) -> None:
+        if idx >= self.__rows or self.__states[idx] != FlatBackend.LIVE:
+            raise RuntimeError(f"向量{idx}不存在或已删除")
+        self.__states[idx] = FlatBackend.DELETED
+        self.__live_count -= 1
+
+    def restore(self, idx: int) -> None:
+        if idx >= self.__rows or self.__states[idx] != FlatBackend.DELETED:
+            raise RuntimeError(f"向量{idx}未被删除")
+        self.__states[idx] = FlatBackend.LIVE
+        self.__live_count += 1
+
+    def search(self, fv: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # 每块先取块内前若干个，再在各块的候选中排序；得分越大越近，l2时得分为2x·q-|x|²
+        query = np.asarray(fv, dtype=np.float32).reshape(-1)
+        if self.__space == "cosine":
+            query = query / max(float(np.linalg.norm(query)), 1e-12)
+        k = min(k, self.__live_count)
+        if k <= 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        candidate_count = min(k * self.__rerank_factor, self.__live_count) if self.__full is not None else k
+        # 量化的系数并入查询向量，不必还原存储的矩阵
+        weights = query * self.__scales
+        block_rows = FlatBackend.BLOCK_ROWS if self.__dtype == np.float32 else FlatBackend.QUANTIZED_BLOCK_ROWS
+        candidate_ids = []
+        candidate_scores = []
+        for start in range(0, self.__rows, block_rows):
+            end = min(start + block_rows, self.__rows)
+            scores = self.__vectors[start: end].astype(np.float32, copy=False) @ weights
+            if self.__space == "l2":
+                scores = 2 * scores - self.__norms[start: end]
+            scores[self.__states[start: end] != FlatBackend.LIVE] = -np.inf
+            if end - start > candidate_count:
+                top = np.argpartition(scores, end - start - candidate_count)[end - start - candidate_count:]
+            else:
+                top = np.arange(end - start)
+            candidate_ids.append(top + start)
+            candidate_scores.append(scores[top])
+        ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(candidate_scores)
+        order = np.argsort(-scores, kind="stable")[:candidate_count]
+        ids, scores = ids[order], scores[order]
+        if self.__full is not None:
+            # 按完整精度的向量重新计算候选的得分
+            scores = self.__full[ids] @ query
+            if self.__space == "l2":
+                scores = 2 * scores - self.__norms[ids]
+            order = np.argsort(-scores, kind="stable")[:k]
+            ids, scores = ids[order], scores[order]
+        distances = 1 - scores if self.__space == "cosine" else float(query @ query) - scores
+        return distances.astype(np.float32), ids
+
+    def get_items(self, ids: list[int]) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        if self.__full is not None:
+            return np.array(self.__full[ids])
+        return self.__vectors[ids].astype(np.float32) * self.__scales
+
+    def iter_items(self, batch_size: int = 4096) -> Iterator[tuple[list[int], np.ndarray, np.ndarray]]:
+        # 连同已删除的向量一起按批给出(附删除掩码)
+        for start in range(0, self.__rows, batch_size):
+            end = min(start + batch_size, self.__rows)
+            states = self.__states[start: end]
+            stored_ids = np.flatnonzero(states != FlatBackend.EMPTY) + start
+            if len(stored_ids) > 0:
+                yield stored_ids.tolist(), self.get_items(stored_ids), self.__states[stored_ids] == FlatBackend.DELETED
+
+
+
+# 倒排(IVF)后端：k-means训练的粗聚类中心把向量分到各个列表，查询时只扫描与查询最近的nprobe个列表。
+# 向量按列表分组存放在不可变的段文件中(索引文件旁的.ivf目录)，查询时内存映射，只读取被探查的列表；
+# 索引文件本身只保存聚类中心、各位置的状态与所在段内位置以及引用的段，随检查点一起替换。
+# 新增的向量先留在内存中，累计到SEGMENT_ROWS或保存时写成新段；段过多、首次达到训练规模或规模增长很多时重写为一个段。
+# 位置被重新写入后旧的项只是失效，删除只做标记，这样已删除的向量仍可恢复；未被引用的段由持有索引的进程在检查点恢复后清理
+class IvfBackend(object):
+    MAGIC = b"VFIVFIDX"
+    SEGMENT_MAGIC = b"VFIVFSEG"
+    EMPTY = 0
+    LIVE = 1
+    DELETED = 2
+    MIN_TRAIN_ROWS = 65536
+    TRAIN_SAMPLE_ROWS = 65536
+    RETRAIN_GROWTH = 16
+    SEGMENT_ROWS = 65536
+    MAX_SEGMENTS = 8
+    def __init__(
+            self,
+            space: Literal["l2", "cosine"],
+            dim: int,
+            capacity: int,
+            index_path: str | Path,
+            nlist: int = 0,
+            nprobe: int = 16
+        ) -> None:
+        self.__space: Literal["l2", "cosine"] = space
+        self.__dim: int = dim
+        self.__segment_dir = Path(index_path).with_suffix(".ivf")
+        self.__nlist_config: int = nlist
+        self.__nprobe: int = nprobe
+        # 训练前只有一个列表，相当于精确的暴力检索
+        self.__centroids = np.zeros((1, dim), dtype=np.float32)
+        self.__trained_rows = 0
+        self.__rows = 0
+        self.__element_count = 0
+        self.__live_count = 0
+        self.__states = np.zeros(capacity, dtype=np.uint8)
+        # 各位置当前有效项的全局位置：段的起始位置 + 段内序号，内存中的新项排在所有段之后
+        self.__locations = np.full(capacity, -1, dtype=np.int64)
+        # 段：(文件名, 起始位置, 各列表偏移, 位置标签, 向量)
+        self.__segments: list[tuple[str, int, np.ndarray, np.ndarray, np.ndarray]] = []
+        # 重建索引时旧的段可能仍被映射，新段的编号排在已有文件之后
+        existing_segments = [int(path.stem) for path in self.__segment_dir.glob("*.seg") if path.stem.isdigit()]
+        self.__next_segment = max(existing_segments, default=-1) + 1
+        # 已加载或保存过的索引文件引用的段，检查点替换前仍可能被使用，在检查点提交后或加载时清理
+        self.__persisted_segments: set[str] = set()
+        # 最近一次快照引用的段，检查点提交后其余已保存过的段不再被引用
+        self.__snapshot_segments: set[str] | None = None
+        # 已fsync的段；段写成后不再修改，在引用它的索引文件写入之前补做fsync即可
+        self.__synced_segments: set[str] = set()
+        self.__pending_start = 0
+        self.__pending_count = 0
+        self.__pending_ids = np.zeros(0, dtype=np.int64)
+        self.__pending_lists = np.zeros(0, dtype=np.int32)
+        self.__pending_vectors = np.zeros((0, dim), dtype=np.float32)
+        self.__pending_members: list[list[int]] = [[]]
+
+    @property
+    def element_count(self) -> int:
+        return self.__element_count
+
+    @property
+    def nlist(self) -> int:
+        return len(self.__centroids)
+
+    def load(self, index_path: str | Path) -> None:
+        mapping, header = SectionFile.read(index_path, IvfBackend.MAGIC)
+        if header["space"] != self.__space or header["dim"] != self.__dim:
+            raise ValueError("向量索引的距离类型或维度与配置不一致")
+        self.__centroids = np.array(SectionFile.section(mapping, header, "centroids", np.float32, (self.__dim, )))
+        self.__states = np.array(SectionFile.section(mapping, header, "states", np.uint8))
+        self.__locations = np.array(SectionFile.section(mapping, header, "locations", np.int64))
+        del mapping
+        self.__rows = header["rows"]
+        self.__trained_rows = header["trained_rows"]
+        self.__next_segment = header["next_segment"]
+        self.__segments = [self.__open_segment(name, start) for name, start in header["segments"]]
+        self.__reset_pending(header["pending_start"])
+        self.__element_count = int(np.count_nonzero(self.__states))
+        self.__live_count = int(np.count_nonzero(self.__states == IvfBackend.LIVE))
+        referenced = {name for name, _ in header["segments"]}
+        self.__persisted_segments = set(referenced)
+        self.__synced_segments = set(referenced)
+
+    def remove_unreferenced_segments(self) -> None:
+        # 清理崩溃或重写后残留的段。只读加载索引的工具(如tune_index)看不到正在运行的程序新写的段，不能调用
+        referenced = self.__persisted_segments | {name for name, *_ in self.__segments}
+        for segment_path in self.__segment_dir.glob("*.seg"):
+            if segment_path.name not in referenced:
+                FileOperation.delete_file(segment_path)
+
+    def remove_superseded_segments(self) -> None:
+        # 检查点提交后调用(调用方持有锁)：删除之前保存过、但新快照与当前结构都不再引用的段。
+        # 锁外可能正在写新段，这里只删除记录过的段，不扫描目录
+        if self.__snapshot_segments is None:
+            return
+        current = {name for name, *_ in self.__segments}
+        for name in self.__persisted_segments - self.__snapshot_segments - current:
+            FileOperation.delete_file(self.__segment_dir / name)
+        self.__persisted_segments = self.__snapshot_segments
+        self.__snapshot_segments = None
+
+    def __open_segment(self, name: str, start: int) -> tuple[str, int, np.ndarray, np.ndarray, np.ndarray]:
+        mapping, header = SectionFile.read(self.__segment_dir / name, IvfBackend.SEGMENT_MAGIC)
+        return (
+            name,
+            start,
+            SectionFile.section(mapping, header, "list_offsets", np.int64),
+            SectionFile.section(mapping, header, "ids", np.int64),
+            SectionFile.section(mapping, header, "vectors", np.float32, (self.__dim, ))
+        )
+
+    def __reset_pending(self, start: int) -> None:
+        self.__pending_start = start
+        self.__pending_count = 0
+        self.__pending_ids = np.zeros(0, dtype=np.int64)
+        self.__pending_lists = np.zeros(0, dtype=np.int32)
+        self.__pending_vectors = np.zeros((0, self.__dim), dtype=np.float32)
+        self.__pending_members = [[] for _ in range(self.nlist)]
+
+    def save(self, index_path: str | Path) -> None:
+        self.snapshot()(index_path)
+
+    def snapshot(self) -> Callable[[str | Path], None]:
+        # 内存中的新项先写成段，索引文件本身只有聚类中心与两列位置信息
+        self.__flush_pending()
+        header = {
+            "space": self.__space,
+            "dim": self.__dim,
+            "rows": self.__rows,
+            "trained_rows": self.__trained_rows,
+            "next_segment": self.__next_segment,
+            "pending_start": self.__pending_start,
+            "segments": [[name, start] for name, start, *_ in self.__segments]
+        }
+        self.__snapshot_segments = {name for name, *_ in self.__segments}
+        self.__persisted_segments.update(self.__snapshot_segments)
+        sections = {
+            "centroids": self.__centroids.tobytes(),
+            "states": self.__states[:self.__rows].tobytes(),
+            "locations": self.__locations[:self.__rows].tobytes()
+        }
+        unsynced_segments = [name for name, *_ in self.__segments if name not in self.__synced_segments]
+
+        def write(index_path: str | Path) -> None:
+            # 检查点提交前，新索引引用的段与目录项必须已经落盘
+            for name in unsynced_segments:
+                FileOperation.fsync_file(self.__segment_dir / name)
+            if unsynced_segments:
+                FileOperation.fsync_dir(self.__segment_dir)
+                self.__synced_segments.update(unsynced_segments)
+            SectionFile.write(index_path, IvfBackend.MAGIC, header, sections)
+
+        return write
+
+    def __normalize(self, fvs: np.ndarray) -> np.ndarray:
+        fvs = np.asarray(fvs, dtype=np.float32).reshape(-1, self.__dim)
+        if self.__space == "cosine":
+            fvs = fvs / np.maximum(np.linalg.norm(fvs, axis=1, keepdims=True), 1e-12)
+        return fvs
+
+    def __scores(self, vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+        # 得分越大越近，l2时为2x·q-|x|²
+        scores = vectors @ query
+        if self.__space == "l2":
+            scores = 2 * scores - np.einsum("ij,ij->i", vectors, vectors)
+        return scores
+
+    def __assign(self, fvs: np.ndarray, centroids: np.ndarray, block_rows: int = 8192) -> np.ndarray:
+        centroid_norms = np.einsum("ij,ij->i", centroids, centroids)
+        assignments = []
+        for start in range(0, len(fvs), block_rows):
+            scores = fvs[start: start + block_rows] @ centroids.T
+            if self.__space == "l2":
+                scores = 2 * scores - centroid_norms[None, :]
+            assignments.append(np.argmax(scores, axis=1).astype(np.int32))
+        return np.concatenate(assignments) if assignments else np.zeros(0, dtype=np.int32)
+
+    def __train_centroids(self, samples: np.ndarray, nlist: int, iterations: int = 20) -> np.ndarray:
+        # Lloyd迭代；空的聚类用随机样本重新初始化，cosine时聚类中心归一化
+        rng = np.random.default_rng(42)
+        centroids = samples[rng.choice(len(samples), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            assignment = self.__assign(samples, centroids)
+            order = np.argsort(assignment, kind="stable")
+            counts = np.bincount(assignment, minlength=nlist)
+            non_empty = np.flatnonzero(counts)
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[non_empty]
+            centroids[non_empty] = np.add.reduceat(samples[order], starts, axis=0) / counts[non_empty, None]
+            empty = np.flatnonzero(counts == 0)
+            if len(empty) > 0:
+                centroids[empty] = samples[rng.choice(len(samples), len(empty), replace=False)]
+            if self.__space == "cosine":
+                centroids = self.__normalize(centroids)
+        return centroids
+
+    def __segment_index(self, positions: np.ndarray) -> np.ndarray:
+        # 各全局位置所在的段序号，等于段数时表示在内存中
+        starts = np.array([start for _, start, *_ in self.__segments] + [self.__pending_start], dtype=np.int64)
+        return np.searchsorted(starts, positions, side="right") - 1
+
+    def __vectors_at(self, positions: np.ndarray) -> np.ndarray:
+        fvs = np.zeros((len(positions), self.__dim), dtype=np.float32)
+        segment_index = self.__segment_index(positions)
+        for segment_no, (_, start, _, _, vectors) in enumerate(self.__segments):
+            selected = np.flatnonzero(segment_index == segment_no)
+            if len(selected) > 0:
+                fvs[selected] = vectors[positions[selected] - start]
+        selected = np.flatnonzero(segment_index == len(self.__segments))
+        if len(selected) > 0:
+            fvs[selected] = self.__pending_vectors[positions[selected] - self.__pending_start]
+        return fvs
+
+    def __lists_at(self, positions: np.ndarray) -> np.ndarray:
+        lists = np.zeros(len(positions), dtype=np.int32)
+        segment_index = self.__segment_index(positions)
+        for segment_no, (_, start, list_offsets, _, _) in enumerate(self.__segments):
+            selected = np.flatnonzero(segment_index == segment_no)
+            if len(selected) > 0:
+                lists[selected] = np.searchsorted(list_offsets, positions[selected] - start, side="right") - 1
+        selected = np.flatnonzero(segment_index == len(self.__segments))
+        if len(selected) > 0:
+            lists[selected] = self.__pending_lists[positions[selected] - self.__pending_start]
+        return lists
+
+    def __write_segment(
+            self,
+            ids: np.ndarray,
+            positions: np.ndarray,
+            lists: np.ndarray,
+            start: int,
+            nlist: int
+        ) -> tuple[str, int, np.ndarray, np.ndarray, np.ndarray]:
+        # 按列表分组写成新段，向量分块读出写入，不在内存中拼出整段；只读取当前结构，各位置的段内位置由调用方更新
+        order = np.lexsort((positions, lists))
+        ids, positions, lists = ids[order], positions[order], lists[order]
+        list_offsets = np.searchsorted(lists, np.arange(nlist + 1)).astype(np.int64)
+        block_rows = 8192
+
+        def iter_vectors() -> Iterator[bytes]:
+            for block_start in range(0, len(positions), block_rows):
+                yield self.__vectors_at(positions[block_start: block_start + block_rows]).tobytes()
+
+        name = f"{self.__next_segment:08d}.seg"
+        self.__next_segment += 1
+        Path.mkdir(self.__segment_dir, parents=True, exist_ok=True)
+        SectionFile.write(self.__segment_dir / name, IvfBackend.SEGMENT_MAGIC, {"dim": self.__dim}, {
+            "list_offsets": list_offsets.tobytes(),
+            "ids": ids.tobytes(),
+            "vectors": (len(ids) * self.__dim * 4, iter_vectors())
+        })
+        return self.__open_segment(name, start)
+
+    def __flush_pending(self) -> None:
+        flush = self.prepare_flush(1)
+        if flush is not None:
+            self.apply_flush(flush)
+
+    def prepare_flush(self, min_rows: int | None = None) -> tuple | None:
+        # 内存中的新项达到min_rows(默认SEGMENT_ROWS)时，把仍有效的写成一个新段。与prepare_rewrite一样只读取当前结构，
+        # 调用方不必持有锁，之后在锁内用apply_flush换入
+        if self.__pending_count == 0 or self.__pending_count < (min_rows or IvfBackend.SEGMENT_ROWS):
+            return None
+        positions = self.__pending_start + np.arange(self.__pending_count)
+        ids = self.__pending_ids[:self.__pending_count]
+        valid = self.__locations[ids] == positions
+        segment = self.__write_segment(
+            ids[valid], positions[valid], self.__pending_lists[:self.__pending_count][valid], self.__pending_start, self.nlist
+        )
+        return segment, self.__pending_start + self.__pending_count
+
+    def apply_flush(self, flush: tuple) -> None:
+        segment, end_position = flush
+        if end_position != self.__pending_start + self.__pending_count:
+            # 准备期间又写入了新项，新段已不完整，放弃这次落盘
+            FileOperation.delete_file(self.__segment_dir / segment[0])
+            return
+        start = segment[1]
+        self.__locations[segment[3]] = start + np.arange(len(segment[3]))
+        self.__segments.append(segment)
+        self.__reset_pending(start + len(segment[3]))
+
+    def prepare_rewrite(self) -> tuple | None:
+        # 段过多、首次达到训练规模或规模增长很多时，把所有段与内存中的项合并为一个新段(训练时按新的聚类中心重新分配列表)，
+        # 已删除的项也保留。k-means与写段都很慢，这里只读取当前结构，调用方不必持有锁，之后在锁内用apply_rewrite换入
+        centroids = self.__retrained_centroids()
+        if centroids is None and len(self.__segments) <= IvfBackend.MAX_SEGMENTS:
+            return None
+        ids = np.flatnonzero(self.__states[:self.__rows] != IvfBackend.EMPTY)
+        positions = self.__locations[ids]
+        if centroids is None:
+            lists = self.__lists_at(positions)
+        else:
+            lists = np.concatenate([
+                self.__assign(self.__vectors_at(positions[start: start + 65536]), centroids)
+                for start in range(0, len(positions), 65536)
+            ]) if len(positions) > 0 else np.zeros(0, dtype=np.int32)
+        segment = self.__write_segment(ids, positions, lists, 0, self.nlist if centroids is None else len(centroids))
+        end_position = self.__pending_start + self.__pending_count
+        return segment, centroids, end_position, self.__live_count
+
+    def apply_rewrite(self, rewrite: tuple) -> None:
+        segment, centroids, end_position, live_count = rewrite
+        if end_position != self.__pending_start + self.__pending_count:
+            # 准备期间又写入了新项，新段已不完整，放弃这次重写
+            FileOperation.delete_file(self.__segment_dir / segment[0])
+            return
+        replaced_names = [name for name, *_ in self.__segments if name not in self.__persisted_segments]
+        self.__locations[segment[3]] = np.arange(len(segment[3]))
+        if centroids is not None:
+            self.__centroids = centroids
+            self.__trained_rows = live_count
+        self.__segments = [segment]
+        self.__reset_pending(len(segment[3]))
+        # 两次保存之间写入又被合并掉的段不会再被引用
+        for name in replaced_names:
+            FileOperation.delete_file(self.__segment_dir / name)
+
+    def __retrained_centroids(self) -> np.ndarray | None:
+        if self.__live_count < IvfBackend.MIN_TRAIN_ROWS:
+            return None
+        if self.__trained_rows and self.__live_count < self.__trained_rows * IvfBackend.RETRAIN_GROWTH:
+            return None
+        live_ids = np.flatnonzero(self.__states[:self.__rows] == IvfBackend.LIVE)
+        nlist = self.__nlist_config or int(np.clip(4 * np.sqrt(len(live_ids)), 16, 65536))
+        sample_ids = np.random.default_rng(42).choice(
+            live_ids, min(len(live_ids), max(IvfBackend.TRAIN_SAMPLE_ROWS, nlist * 4)), replace=False
+        )
+        samples = self.__vectors_at(self.__locations[np.sort(sample_ids)])
+        return self.__train_centroids(samples, min(nlist, len(samples)))
+
+    def reserve(self, ids: list[int]) -> None:
+        # 扩容在这里进行，调用方持有锁，查询看到的结构始终完整
+        required = max(ids) + 1 if len(ids) > 0 else 0
+        capacity = len(self.__states)
+        if required > capacity:
+            capacity = max(capacity, 1024)
+            while capacity < required:
+                capacity *= 2
+            states = np.zeros(capacity, dtype=np.uint8)
+            locations = np.full(capacity, -1, dtype=np.int64)
+            states[:self.__rows] = self.__states[:self.__rows]
+            locations[:self.__rows] = self.__locations[:self.__rows]
+            self.__states, self.__locations = states, locations
+        required = self.__pending_count + len(ids)
+        capacity = len(self.__pending_ids)
+        if required > capacity:
+            capacity = max(capacity, 1024)
+            while capacity < required:
+                capacity *= 2
+            pending_ids = np.zeros(capacity, dtype=np.int64)
+            pending_lists = np.zeros(capacity, dtype=np.int32)
+            pending_vectors = np.zeros((capacity, self.__dim), dtype=np.float32)
+            pending_ids[:self.__pending_count] = self.__pending_ids[:self.__pending_count]
+            pending_lists[:self.__pending_count] = self.__pending_lists[:self.__pending_count]
+            pending_vectors[:self.__pending_count] = self.__pending_vectors[:self.__pending_count]
+            self.__pending_ids, self.__pending_lists, self.__pending_vectors = pending_ids, pending_lists, pending_vectors
+
+    def add(self, fvs: np.ndarray, ids: list[int]) -> None:
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        fvs = self.__normalize(fvs)
+        lists = self.__assign(fvs, self.__centroids)
+        pending_slots = self.__pending_count + np.arange(len(ids))
+        self.__pending_ids[pending_slots] = ids
+        self.__pending_lists[pending_slots] = lists
+        self.__pending_vectors[pending_slots] = fvs
+        previous_states = self.__states[ids]
+        self.__states[ids] = IvfBackend.LIVE
+        self.__locations[ids] = self.__pending_start + pending_slots
+        for slot, list_no in zip(pending_slots.tolist(), lists.tolist()):
+            self.__pending_members[list_no].append(slot)
+        self.__pending_count += len(ids)
+        self.__element_count += int(np.count_nonzero(previous_states == IvfBackend.EMPTY))
+        self.__live_count += int(np.count_nonzero(previous_states != IvfBackend.LIVE))
+        self.__rows = max(self.__rows, int(ids.max()) + 1) if len(ids) > 0 else self.__rows
+
+    def delete(self, idx: int) -> None:
+        if idx >= self.__rows or self.__states[idx] != IvfBackend.LIVE:
+            raise RuntimeError(f"向量{idx}不存在或已删除")
+        self.__states[idx] = IvfBackend.DELETED
+        self.__live_count -= 1
+
+    def restore(self, idx: int) -> None:
+        if idx >= self.__rows or self.__states[idx] != IvfBackend.DELETED:
+            raise RuntimeError(f"向量{idx}未被删除")
+        self.__states[idx] = IvfBackend.LIVE
+        self.__live_count += 1
+
+    def search(self, fv: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        query = self.__normalize(fv)[0]
+        k = min(k, self.__live_count)
+        if k <= 0:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        coarse_scores = self.__scores(self.__centroids, query)
+        nprobe = min(self.__nprobe, self.nlist)
+        probes = np.argpartition(coarse_scores, self.nlist - nprobe)[self.nlist - nprobe:]
+        candidate_ids = []
+        candidate_scores = []
+
+        def collect(ids: np.ndarray, positions: np.ndarray, vectors: np.ndarray) -> None:
+            valid = (self.__states[ids] == IvfBackend.LIVE) & (self.__locations[ids] == positions)
+            if not valid.any():
+                return
+            ids, scores = ids[valid], self.__scores(vectors[valid], query)
+            if len(scores) > k:
+                top = np.argpartition(scores, len(scores) - k)[len(scores) - k:]
+                ids, scores = ids[top], scores[top]
+            candidate_ids.append(ids)
+            candidate_scores.append(scores)
+
+        for list_no in probes.tolist():
+            for _, start, list_offsets, segment_ids, vectors in self.__segments:
+                begin, end = int(list_offsets[list_no]), int(list_offsets[list_no + 1])
+                if begin < end:
+                    collect(np.asarray(segment_ids[begin: end]), start + np.arange(begin, end), vectors[begin: end])
+            members = np.array(self.__pending_members[list_no], dtype=np.int64)
+            if len(members) > 0:
+                collect(self.__pending_ids[members], self.__pending_start + members, self.__pending_vectors[members])
+        if not candidate_ids:
+            return np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.int64)
+        ids = np.concatenate(candidate_ids)
+        scores = np.concatenate(candidate_scores)
+        order = np.argsort(-scores, kind="stable")[:k]
+        ids, scores = ids[order], scores[order]
+        distances = 1 - scores if self.__space == "cosine" else float(query @ query) - scores
+        return distances.astype(np.float32), ids
+
+    def get_items(self, ids: list[int]) -> np.ndarray:
+        return self.__vectors_at(self.__locations[np.asarray(ids, dtype=np.int64)])
+
+    def iter_items(self, batch_size: int = 4096) -> Iterator[tuple[list[int], np.ndarray, np.ndarray]]:
+        # 连同已删除的向量一起按批给出(附删除掩码)
+        stored_ids = np.flatnonzero(self.__states[:self.__rows] != IvfBackend.EMPTY)
+        for start in range(0, len(stored_ids), batch_size):
+            batch = stored_ids[start: start + batch_size]
+            yield batch.tolist(), self.get_items(batch), self.__states[batch] == IvfBackend.DELETED
+
+
+
+# 向量索引：backend为hnsw时近似检索，为flat时精确的暴力检索，为ivf时按倒排列表检索(适合内存有限的超大图库)；
+# 为auto时新索引先用flat，向量数超过flat_max_elements后转为hnsw，加载的hnsw索引不足阈值一半时转回flat。
+# 各后端的距离都沿用hnswlib的定义(cosine为1-余弦相似度，l2为欧氏距离的平方)
 class VectorIndexManager:
     def __init__(
-            self, 
-            index_path: str, 
+            self,
+            index_path: str,
             index_capacity: int,
             space: Literal["l2", "cosine"],
-            dim: int
+            dim: int,
+            hnsw_m: int = 32,
+            ef_construction: int = 200,
+            ef_search: int = 100,
+            backend: Literal["auto", "hnsw", "flat", "ivf"] = "hnsw",
+            flat_dtype: Literal["float32", "float16", "int8"] = "float32",
+            flat_mmap: bool = False,
+            flat_max_elements: int = 200000,
+            flat_rerank_factor: int = 4,
+            ivf_nlist: int = 0,
+            ivf_nprobe: int = 16
         ) -> None:
         self.__index_path: str = index_path
-        self.__index_capacity: int = index_capacity
+        self.__index_capacity: int = max(index_capacity, 1)
         self.__space: Literal["l2", "cosine"] = space
         self.__dim: int = dim
+        # M与ef_construction只在新建索引时生效，已有索引沿用文件中保存的值
+        self.__hnsw_m: int = hnsw_m
+        self.__ef_construction: int = ef_construction
+        self.__ef_search: int = ef_search
+        self.__backend_name: Literal["auto", "hnsw", "flat", "ivf"] = backend
+        self.__flat_dtype: Literal["float32", "float16", "int8"] = flat_dtype
+        self.__flat_mmap: bool = flat_mmap
+        self.__flat_max_elements: int = flat_max_elements
+        self.__flat_rerank_factor: int = flat_rerank_factor
+        self.__ivf_nlist: int = ivf_nlist
+        self.__ivf_nprobe: int = ivf_nprobe
+        # 扩容和切换后端会重新分配内存，不能与查询同时进行
+        self.__backend_lock = Lock()
         self.match: Callable = lambda: None
         self.__init_index()
         self.__init_match_function()
 
-    def __init_index(self) -> None:
-        self.__hnsw_index = hnswlib.Index(space=self.__space, dim=self.__dim)
-        if Path(self.__index_path).exists():
-            self.__hnsw_index.load_index(self.__index_path, max_elements=self.__index_capacity)
-        else:
-            self.__hnsw_index.init_index(
-                max_elements=self.__index_capacity, 
-                ef_construction=200, 
-                M=32,
-                random_seed=42
+    @property
+    def element_count(self) -> int:
+        return self.__backend.element_count
+
+    @property
+    def backend_kind(self) -> str:
+        if isinstance(self.__backend, FlatBackend):
+            return "flat"
+        if isinstance(self.__backend, IvfBackend):
+            return "ivf"
+        return "hnsw"
+
+    def __create_backend(self, kind: str) -> HnswBackend | FlatBackend | IvfBackend:
+        if kind == "flat":
+            return FlatBackend(
+                self.__space,
+                self.__dim,
+                self.__index_capacity,
+                self.__flat_dtype,
+                self.__flat_mmap,
+                self.__index_path,
+                self.__flat_rerank_factor
             )
+        if kind == "ivf":
+            return IvfBackend(
+                self.__space, self.__dim, self.__index_capacity, self.__index_path, self.__ivf_nlist, self.__ivf_nprobe
+            )
+        return HnswBackend(
+            self.__space, self.__dim, self.__index_capacity, self.__hnsw_m, self.__ef_construction, self.__ef_search
+        )
+
+    def __init_index(self) -> None:
+        self.__backend = self.__create_backend("flat" if self.__backend_name == "auto" else self.__backend_name)
+        if not Path(self.__index_path).exists():
+            return
+        try:
+            stored_kind = self.stored_kind(self.__index_path)
+            stored_backend = self.__create_backend(stored_kind)
+            stored_backend.load(self.__index_path)
+        except Exception as e:
+            logging.error(f"加载向量索引失败，将重新创建: {e}")
+            return
+        self.__backend = stored_backend
+        target_kind = self.__target_kind()
+        if target_kind != stored_kind:
+            self.__backend = self.__convert(target_kind)
+
+    @staticmethod
+    def stored_kind(index_path: str | Path) -> str:
+        if SectionFile.has_magic(index_path, FlatBackend.MAGIC):
+            return "flat"
+        if SectionFile.has_magic(index_path, IvfBackend.MAGIC):
+            return "ivf"
+        return "hnsw"
 
     def __init_match_function(self) -> None:
         if self.__space == "cosine":
@@ -47,93 +1077,1013 @@ class VectorIndexManager:
         else:
             self.match = lambda: None
 
+    def __target_kind(self) -> str:
+        if self.__backend_name != "auto":
+            return self.__backend_name
+        if self.backend_kind == "flat" and self.element_count > self.__flat_max_elements:
+            return "hnsw"
+        if self.backend_kind == "hnsw" and self.element_count < self.__flat_max_elements // 2:
+            return "flat"
+        return self.backend_kind
+
+    def __convert(self, kind: str) -> HnswBackend | FlatBackend | IvfBackend:
+        # 已删除的向量也一并转换并重新标记删除，之后仍能恢复(识别移动、重放日志中的SET记录都依赖这一点)。
+        # 修改索引的调用由上层串行化，转换期间当前后端只会被查询读取，因此不必持有锁，返回的新后端由调用方替换
+        if isinstance(self.__backend, FlatBackend) and self.__flat_dtype != "float32":
+            logging.error(
+                f"向量数{self.element_count}，向量索引由flat转换为{kind}，不再使用{self.__flat_dtype}量化存储，"
+                "完整精度向量文件在新索引保存后删除"
+            )
+        target_backend = self.__create_backend(kind)
+        for ids, fvs, deleted in self.__backend.iter_items():
+            target_backend.reserve(ids)
+            target_backend.add(fvs, ids)
+            for idx in np.asarray(ids)[deleted].tolist():
+                target_backend.delete(idx)
+            if isinstance(target_backend, IvfBackend):
+                # 新后端尚未换入，不必持有锁
+                flush = target_backend.prepare_flush()
+                if flush is not None:
+                    target_backend.apply_flush(flush)
+        return target_backend
+
     def reset_index(self) -> None:
         FileOperation.delete_file(self.__index_path)
         self.__init_index()
 
-    def save_index(self) -> None:
-        self.__hnsw_index.save_index(self.__index_path)
+    def remove_stale_files(self) -> None:
+        # 只能由持有索引的进程在检查点恢复之后调用，此时磁盘上的索引文件引用的就是全部有效的段
+        if isinstance(self.__backend, IvfBackend):
+            self.__backend.remove_unreferenced_segments()
+        self.__remove_side_files()
+
+    def remove_superseded_files(self) -> None:
+        # 检查点提交之后调用，删除新快照不再引用的文件
+        with self.__backend_lock:
+            if isinstance(self.__backend, IvfBackend):
+                self.__backend.remove_superseded_segments()
+            self.__remove_side_files()
+
+    def __remove_side_files(self) -> None:
+        # 转换为其他后端后，完整精度向量的旁路文件在当前后端不使用、磁盘上的索引也不再是flat时删除
+        if isinstance(self.__backend, FlatBackend) and self.__backend.uses_side_files:
+            return
+        if Path(self.__index_path).exists() and self.stored_kind(self.__index_path) == "flat":
+            return
+        for side_file in FlatBackend.side_files(self.__index_path):
+            if side_file.exists():
+                FileOperation.delete_file(side_file)
+
+    def save_index(self, index_path: str | None = None) -> None:
+        self.snapshot()(index_path or self.__index_path)
+
+    def snapshot(self) -> Callable[[str | Path], None]:
+        # 在锁内复制当前索引，返回的写入函数可以在锁外执行
+        with self.__backend_lock:
+            return self.__backend.snapshot()
+
+    def get_vectors(self, ids: list[int]) -> np.ndarray:
+        return self.__backend.get_items(ids)
 
     def add_vector(self, fv: np.ndarray, idx: int) -> None:
-        self.__hnsw_index.add_items(fv, idx)
+        self.add_vectors(fv, [idx])
+
+    def add_vectors(self, fvs: np.ndarray, ids: list[int]) -> None:
+        with self.__backend_lock:
+            self.__backend.reserve(ids)
+            if isinstance(self.__backend, FlatBackend):
+                self.__backend.fit_scales(fvs)
+        self.__backend.add(fvs, ids)
+        if isinstance(self.__backend, IvfBackend):
+            # 倒排索引的落盘、训练与合并在锁外准备，只在换入时持有锁
+            flush = self.__backend.prepare_flush()
+            if flush is not None:
+                with self.__backend_lock:
+                    self.__backend.apply_flush(flush)
+            rewrite = self.__backend.prepare_rewrite()
+            if rewrite is not None:
+                with self.__backend_lock:
+                    self.__backend.apply_rewrite(rewrite)
+        target_kind = self.__target_kind()
+        if target_kind != self.backend_kind:
+            target_backend = self.__convert(target_kind)
+            with self.__backend_lock:
+                self.__backend = target_backend
 
     def delete_vector(self, idx: int) -> None:
         try:
-            self.__hnsw_index.mark_deleted(idx)
+            self.__backend.delete(idx)
         except Exception as e:
             logging.error(f"删除向量时出错: {e}")
 
+    def delete_vectors(self, ids: list[int]) -> None:
+        # 逐个标记删除，单个失败不影响其余
+        for idx in ids:
+            self.delete_vector(idx)
+
+    def restore_vector(self, idx: int) -> None:
+        try:
+            self.__backend.restore(idx)
+        except Exception as e:
+            logging.error(f"恢复向量时出错: {e}")
+
     def match_with_cosine(self, fv, nc=5):
-        self.__hnsw_index.set_ef(max(100, nc * 2))
-        labels, distances = self.__hnsw_index.knn_query(fv, k=nc)
-        cos_similarities = 1.0 - distances[0]
+        with self.__backend_lock:
+            distances, labels = self.__backend.search(fv, nc)
+        cos_similarities = 1.0 - distances
         logits_per_image = 100 * cos_similarities
-        return logits_per_image, labels[0]
-    
+        return logits_per_image, labels
+
     def match_with_l2(self, fv, nc=5):
-        self.__hnsw_index.set_ef(max(100, nc * 2))
-        query = self.__hnsw_index.knn_query(fv, k=nc)
-        similarity = (1 - np.tanh(query[1][0] / 3000)) * 100
-        return similarity, query[0][0]
+        with self.__backend_lock:
+            distances, labels = self.__backend.search(fv, nc)
+        similarity = (1 - np.tanh(distances / 3000)) * 100
+        return similarity, labels
+
+
+
+# 路径 -> 索引位置的开放寻址哈希表，槽位只存位置(-1为空，-2为已删除)与64位路径哈希，
+# 哈希相同时再比对完整路径，不为每个路径创建Python对象。两个数组随名称索引一起保存，加载时直接映射
+class PathIdMap(object):
+    EMPTY = -1
+    DELETED = -2
+    def __init__(
+            self,
+            get_name: Callable[[int], str],
+            capacity: int = 1024,
+            tables: tuple[np.ndarray, np.ndarray, int, int] | None = None
+        ) -> None:
+        self.__get_name = get_name
+        if tables is None:
+            self.__init_table(capacity)
+        else:
+            self.__slots, self.__hashes, self.__used, self.__filled = tables
+            self.__mask = len(self.__slots) - 1
+
+    def __init_table(self, capacity: int) -> None:
+        capacity = 1 << max(10, (capacity - 1).bit_length())
+        self.__slots = np.full(capacity, PathIdMap.EMPTY, dtype=np.int64)
+        self.__hashes = np.zeros(capacity, dtype=np.uint64)
+        self.__mask = capacity - 1
+        self.__used = 0
+        self.__filled = 0
+
+    def __len__(self) -> int:
+        return self.__used
+
+    @property
+    def tables(self) -> tuple[np.ndarray, np.ndarray, int, int]:
+        return self.__slots, self.__hashes, self.__used, self.__filled
+
+    def detach(self) -> None:
+        # 映射自文件的表在文件被替换前复制到内存
+        self.__slots = np.array(self.__slots)
+        self.__hashes = np.array(self.__hashes)
+
+    @staticmethod
+    def hash_path(path: str) -> int:
+        digest = hashlib.blake2b(path.encode("utf-8", "surrogatepass"), digest_size=8).digest()
+        return int.from_bytes(digest, "little")
+
+    def __find_slot(self, path: str, path_hash: int) -> int:
+        slot = path_hash & self.__mask
+        while True:
+            idx = int(self.__slots[slot])
+            if idx == PathIdMap.EMPTY:
+                return -1
+            if idx >= 0 and int(self.__hashes[slot]) == path_hash and self.__get_name(idx) == path:
+                return slot
+            slot = (slot + 1) & self.__mask
+
+    def get(self, path: str) -> int | None:
+        slot = self.__find_slot(path, self.hash_path(path))
+        return None if slot < 0 else int(self.__slots[slot])
+
+    def put(self, path: str, idx: int) -> None:
+        path_hash = self.hash_path(path)
+        slot = self.__find_slot(path, path_hash)
+        if slot >= 0:
+            self.__slots[slot] = idx
+            return
+        if (self.__filled + 1) * 2 > len(self.__slots):
+            self.__rehash()
+        slot = path_hash & self.__mask
+        while self.__slots[slot] >= 0:
+            slot = (slot + 1) & self.__mask
+        if self.__slots[slot] == PathIdMap.EMPTY:
+            self.__filled += 1
+        self.__slots[slot] = idx
+        self.__hashes[slot] = path_hash
+        self.__used += 1
+
+    def remove(self, path: str) -> None:
+        slot = self.__find_slot(path, self.hash_path(path))
+        if slot < 0:
+            return
+        self.__slots[slot] = PathIdMap.DELETED
+        self.__used -= 1
+
+    def __rehash(self) -> None:
+        # 扩容时顺带清掉已删除的槽位，哈希值已保存，不需要重新解码路径
+        occupied = self.__slots >= 0
+        ids, hashes = self.__slots[occupied], self.__hashes[occupied]
+        self.__init_table(max(len(ids), 512) * 4)
+        for idx, path_hash in zip(ids.tolist(), hashes.tolist()):
+            slot = path_hash & self.__mask
+            while self.__slots[slot] >= 0:
+                slot = (slot + 1) & self.__mask
+            self.__slots[slot] = idx
+            self.__hashes[slot] = path_hash
+        self.__used = self.__filled = len(ids)
+
+
+
+# 名称索引中的一项按列存放，name_index[idx]按需组装出[文件路径, 文件大小, 内容哈希(十六进制，未知时为空串), 修改时间ns, inode]，
+# 兼容原来列表的用法
+class NameEntries(object):
+    def __init__(self, manager: "NameIndexManager") -> None:
+        self.__manager = manager
+
+    def __len__(self) -> int:
+        return self.__manager.count
 
+    def __getitem__(self, idx: int) -> list:
+        if not 0 <= idx < self.__manager.count:
+            raise IndexError(idx)
+        return self.__manager.get_entry(idx)
 
+    def __iter__(self) -> Iterator[list]:
+        for idx in range(self.__manager.count):
+            yield self.__manager.get_entry(idx)
 
+
+
+# 名称索引按列存储：去重的目录表 + 文件名字节串与偏移 + 大小/修改时间/inode/内容哈希/标志的NumPy数组。
+# 以SectionFile格式保存(头部中另有dir_mtimes)，加载时以写时复制方式内存映射，文件名按需解码。
+# dir_mtimes记录上次完整同步时各目录的修改时间，用于跳过文件列表没有变化的目录
 class NameIndexManager(object):
     NOTEXISTS = 'NOTEXISTS'
+    MAGIC = b"VFNAMEIX"
+    FLAG_EXISTS = 1
+    FLAG_HASHED = 2
+    COLUMNS = {
+        "dir_ids": (np.int32, ()),
+        "name_offsets": (np.int64, ()),
+        "name_lengths": (np.int32, ()),
+        "sizes": (np.int64, ()),
+        "mtimes": (np.int64, ()),
+        "inodes": (np.uint64, ()),
+        "hashes": (np.uint8, (16, )),
+        "flags": (np.uint8, ())
+    }
     def __init__(self, name_index_path: Path, max_match_count: int) -> None:
-        self.__name_index_path = name_index_path
+        self.__name_index_path = Path(name_index_path)
         self.__max_match_count = max_match_count
+        self.__name_entries = NameEntries(self)
+        self.__mapping: np.memmap | None = None
         self.__init_index()
 
     @property
-    def name_index(self) -> list[list]:
-        return self.__name_index
-    
+    def name_index(self) -> NameEntries:
+        return self.__name_entries
+
+    @property
+    def count(self) -> int:
+        return self.__count
+
+    @property
+    def valid_ids(self) -> np.ndarray:
+        return np.flatnonzero(self.__columns["flags"][:self.__count] & NameIndexManager.FLAG_EXISTS)
+
+    @property
+    def dir_mtimes(self) -> dict[str, int]:
+        return self.__dir_mtimes
+
     @property
     def results_count(self) -> int:
         return min(self.__max_match_count, self.__valid_index_count)
-    
+
     @property
     def valid_index_count(self) -> int:
         return self.__valid_index_count
-    
+
     def update_max_match_count(self, max_match_count: int) -> None:
         self.__max_match_count = max_match_count
-   
+
+    def __init_columns(self, count: int) -> None:
+        self.__count = count
+        self.__columns: dict[str, np.ndarray] = {
+            name: np.zeros((max(count, 1024), *shape), dtype=dtype)
+            for name, (dtype, shape) in NameIndexManager.COLUMNS.items()
+        }
+        self.__name_blob: np.ndarray = np.zeros(0, dtype=np.uint8)
+        self.__extra_blob = bytearray()
+        self.__garbage_bytes = 0
+        self.__dirs: list[str] = []
+        self.__dir_ids: dict[str, int] = {}
+        self.__dir_mtimes: dict[str, int] = {}
+        self.__path_ids = PathIdMap(self.__get_path)
+        # 已删除可复用的位置，最小堆；位置被重新占用后不立即移除，取出时再按标记跳过
+        self.__free_ids: list[int] = []
+        # 结果乱序到达时末尾会留下尚未写入的位置，下次分配前由标记列重新统计空位
+        self.__has_gaps = False
+        # 目录前缀索引：按名称排序的目录表，以及按目录分组的有效位置(成员, 各目录的起始偏移)。
+        # 分组建立后新写入的项记在(目录, 位置)增量表中，删除与移走的项在读取时按当前各列过滤，
+        # 增量超过分组规模的1/4时才整体重建
+        self.__sorted_dirs: tuple[list[str], list[int]] | None = None
+        self.__dir_members: tuple[np.ndarray, np.ndarray] | None = None
+        self.__added_dirs: list[int] = []
+        self.__added_ids: list[int] = []
+        self.__member_changes = 0
+
     def __init_index(self) -> None:
+        self.__init_columns(0)
+        legacy_path = self.__name_index_path.with_suffix(".json")
         try:
-            with open(self.__name_index_path, "r", encoding="utf-8") as f:
-                self.__name_index = json.load(f)
-        except json.JSONDecodeError:
-            self.__name_index = []
-        except FileNotFoundError:
-            Path.mkdir(self.__name_index_path.parent, exist_ok=True)
-            self.__name_index = []
-        finally:
-            self.__valid_index_count = sum(
-                index_file != NameIndexManager.NOTEXISTS
-                for index_file, _ in self.__name_index
-            )
-    
-    def add_name(self, name: Path | str, idx: int) -> None:
-        while idx > len(self.__name_index) - 1:
-            self.__name_index.append([NameIndexManager.NOTEXISTS, 0])
-        self.__name_index[idx] = [str(name), FileOperation.get_metainfo(name)]
-        self.__valid_index_count += 1
-    
+            if self.__name_index_path.exists():
+                self.__load_binary()
+            elif legacy_path.exists():
+                self.__load_legacy(legacy_path)
+            else:
+                Path.mkdir(self.__name_index_path.parent, parents=True, exist_ok=True)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.error(f"加载名称索引失败，将重新创建: {e}")
+            self.__release_mapping()
+            self.__init_columns(0)
+        self.__valid_index_count = len(self.valid_ids)
+
+    def __load_binary(self) -> None:
+        mapping, header = SectionFile.read(self.__name_index_path, NameIndexManager.MAGIC)
+        self.__mapping = mapping
+
+        def section(name: str, dtype: np.dtype, shape: tuple = ()) -> np.ndarray:
+            return SectionFile.section(mapping, header, name, dtype, shape)
+
+        self.__count = header["count"]
+        for name, (dtype, shape) in NameIndexManager.COLUMNS.items():
+            self.__columns[name] = section(name, dtype, shape)
+        self.__name_blob = section("name_blob", np.uint8)
+        dir_offsets = section("dir_offsets", np.int64).tolist()
+        dir_blob = bytes(section("dir_blob", np.uint8))
+        self.__dirs = [
+            dir_blob[start: end].decode("utf-8", "surrogatepass")
+            for start, end in zip(dir_offsets, dir_offsets[1:])
+        ]
+        self.__dir_ids = {directory: dir_id for dir_id, directory in enumerate(self.__dirs)}
+        self.__dir_mtimes = header["dirs"]
+        self.__garbage_bytes = header.get("garbage_bytes", 0)
+        if "path_slots" not in header["sections"]:
+            self.__rebuild_lookup()
+            return
+        used, filled = header["path_map"]
+        self.__path_ids = PathIdMap(
+            self.__get_path,
+            tables=(section("path_slots", np.int64), section("path_hashes", np.uint64), used, filled)
+        )
+        # 保存时按从小到大写出，本身就是合法的堆
+        self.__free_ids = section("free_ids", np.int64).tolist()
+
+    def __load_legacy(self, legacy_path: Path) -> None:
+        # 旧版本的JSON索引：更早的版本只有名称列表，且每项只有[路径, 大小]，缺失的元信息在下次同步时补齐
+        with open(legacy_path, "r", encoding="utf-8") as f:
+            content = json.load(f)
+        names = content if isinstance(content, list) else content["names"]
+        if isinstance(content, dict):
+            self.__dir_mtimes = content["dirs"]
+        for idx, entry in enumerate(names):
+            entry.extend(["", 0, 0][len(entry) - 2:])
+            name, size, content_hash, mtime_ns, inode = entry
+            if name == NameIndexManager.NOTEXISTS:
+                continue
+            self.__set_entry(idx, name, bytes.fromhex(content_hash) if content_hash else None, (size, mtime_ns, inode))
+        self.__rebuild_lookup()
+
+    def __rebuild_lookup(self) -> None:
+        # 由各列重建路径表与空闲位置，只在导入旧格式时需要
+        valid_ids = self.valid_ids
+        self.__path_ids = PathIdMap(self.__get_path, len(valid_ids) * 2)
+        for idx in valid_ids.tolist():
+            self.__path_ids.put(self.__get_path(idx), idx)
+        self.__collect_free_ids()
+
+    def __collect_free_ids(self) -> None:
+        flags = self.__columns["flags"][:self.__count]
+        self.__free_ids = np.flatnonzero((flags & NameIndexManager.FLAG_EXISTS) == 0).tolist()
+        self.__has_gaps = False
+
+    def __release_mapping(self) -> None:
+        # Windows下被映射的文件无法被替换或删除，写新文件或追加新项前先把各列复制到内存，
+        # 不再有视图引用映射后文件随之关闭
+        if self.__mapping is None:
+            return
+        for name in self.__columns:
+            self.__columns[name] = np.array(self.__columns[name])
+        self.__name_blob = np.array(self.__name_blob)
+        self.__path_ids.detach()
+        self.__mapping = None
+
+    def __ensure_capacity(self, count: int) -> None:
+        self.__release_mapping()
+        capacity = len(self.__columns["flags"])
+        if count <= capacity:
+            return
+        capacity = max(capacity, 1024)
+        while capacity < count:
+            capacity *= 2
+        for name, column in self.__columns.items():
+            grown = np.zeros((capacity, *column.shape[1:]), dtype=column.dtype)
+            grown[:self.__count] = column[:self.__count]
+            self.__columns[name] = grown
+
+    def __intern_dir(self, directory: str) -> int:
+        dir_id = self.__dir_ids.get(directory)
+        if dir_id is None:
+            dir_id = len(self.__dirs)
+            self.__dirs.append(directory)
+            self.__dir_ids[directory] = dir_id
+            self.__sorted_dirs = None
+        return dir_id
+
+    def __get_dir_members(self) -> tuple[np.ndarray, np.ndarray]:
+        if self.__dir_members is None:
+            valid_ids = self.valid_ids
+            dir_ids = self.__columns["dir_ids"][valid_ids]
+            order = np.argsort(dir_ids, kind="stable")
+            members = valid_ids[order]
+            offsets = np.searchsorted(dir_ids[order], np.arange(len(self.__dirs) + 1))
+            self.__dir_members = (members, offsets)
+            self.__added_dirs, self.__added_ids = [], []
+            self.__member_changes = 0
+        return self.__dir_members
+
+    def __note_member_change(self, idx: int | None = None, dir_id: int = 0) -> None:
+        # 分组尚未建立时不必记录，首次使用时整体建立
+        if self.__dir_members is None:
+            return
+        if idx is not None:
+            self.__added_dirs.append(dir_id)
+            self.__added_ids.append(idx)
+        self.__member_changes += 1
+        if self.__member_changes > max(1024, len(self.__dir_members[0]) // 4):
+            self.__dir_members = None
+
+    def __members_of(self, dir_ids: list[int]) -> np.ndarray:
+        members, offsets = self.__get_dir_members()
+        parts = [members[offsets[dir_id]: offsets[dir_id + 1]] for dir_id in dir_ids if dir_id + 1 < len(offsets)]
+        if self.__added_ids:
+            added_ids = np.array(self.__added_ids, dtype=np.int64)
+            parts.append(added_ids[np.isin(np.array(self.__added_dirs, dtype=np.int64), dir_ids)])
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        candidates = np.concatenate(parts)
+        # 分组建立后被删除或移到其他目录的项按当前的列过滤，重复写入的项去重
+        valid = (
+            (self.__columns["flags"][candidates] & NameIndexManager.FLAG_EXISTS != 0) &
+            np.isin(self.__columns["dir_ids"][candidates], dir_ids)
+        )
+        return np.unique(candidates[valid])
+
+    def iter_directories(self) -> Iterator[tuple[str, np.ndarray]]:
+        # 按所在目录分组给出有效位置；遍历整个图库，有修改时直接重建分组
+        if self.__member_changes > 0:
+            self.__dir_members = None
+        members, offsets = self.__get_dir_members()
+        for dir_id, directory in enumerate(self.__dirs):
+            if offsets[dir_id] < offsets[dir_id + 1]:
+                yield directory, members[offsets[dir_id]: offsets[dir_id + 1]]
+
+    def ids_in_directory(self, directory: str | Path) -> np.ndarray:
+        # 目录及其所有子目录下的有效位置：在排序的目录表上二分出前缀区间，只取这些目录的成员
+        directory = str(Path(directory))
+        prefix = directory.rstrip("\\/") + os.sep
+        if self.__sorted_dirs is None:
+            dir_ids = sorted(range(len(self.__dirs)), key=self.__dirs.__getitem__)
+            self.__sorted_dirs = ([self.__dirs[dir_id] for dir_id in dir_ids], dir_ids)
+        dir_names, dir_ids = self.__sorted_dirs
+        start = bisect.bisect_left(dir_names, prefix)
+        end = bisect.bisect_left(dir_names, prefix[:-1] + chr(ord(os.sep) + 1), start)
+        subtree_ids = dir_ids[start: end]
+        if directory in self.__dir_ids and directory != prefix:
+            subtree_ids.append(self.__dir_ids[directory])
+        return self.__members_of(subtree_ids)
+
+    def __get_path(self, idx: int) -> str:
+        offset = int(self.__columns["name_offsets"][idx])
+        length = int(self.__columns["name_lengths"][idx])
+        blob_length = len(self.__name_blob)
+        if offset < blob_length:
+            name = self.__name_blob[offset: offset + length].tobytes()
+        else:
+            name = bytes(self.__extra_blob[offset - blob_length: offset - blob_length + length])
+        return self.__dirs[self.__columns["dir_ids"][idx]] + name.decode("utf-8", "surrogatepass")
+
+    def __is_deleted(self, idx: int) -> bool:
+        return idx >= self.__count or not self.__columns["flags"][idx] & NameIndexManager.FLAG_EXISTS
+
+    def get_name(self, idx: int) -> str:
+        if self.__is_deleted(idx):
+            return NameIndexManager.NOTEXISTS
+        return self.__get_path(idx)
+
+    def get_entry(self, idx: int) -> list:
+        content_hash = self.get_content_hash(idx)
+        return [
+            self.get_name(idx),
+            int(self.__columns["sizes"][idx]),
+            content_hash.hex() if content_hash is not None else "",
+            int(self.__columns["mtimes"][idx]),
+            int(self.__columns["inodes"][idx])
+        ]
+
+    def find(self, name: Path | str) -> int | None:
+        return self.__path_ids.get(str(name))
+
+    def iter_free_ids(self) -> Iterator[int]:
+        # 从小到大给出可复用的位置；遍历的是调用时的快照，期间被重新占用的位置会跳过
+        if self.__has_gaps:
+            self.__collect_free_ids()
+        free_ids = self.__free_ids.copy()
+        previous = -1
+        while free_ids:
+            idx = heapq.heappop(free_ids)
+            if idx != previous and self.__is_deleted(idx):
+                yield idx
+            previous = idx
+
+    def __set_entry(
+            self,
+            idx: int,
+            name: str,
+            content_hash: bytes | None,
+            metainfo: tuple[int, int, int]
+        ) -> None:
+        self.__ensure_capacity(idx + 1)
+        if idx > self.__count:
+            self.__has_gaps = True
+        self.__count = max(self.__count, idx + 1)
+        split_at = len(os.path.dirname(name))
+        encoded_name = name[split_at:].encode("utf-8", "surrogatepass")
+        columns = self.__columns
+        self.__garbage_bytes += int(columns["name_lengths"][idx])
+        columns["dir_ids"][idx] = self.__intern_dir(name[:split_at])
+        self.__note_member_change(idx, int(columns["dir_ids"][idx]))
+        columns["name_offsets"][idx] = len(self.__name_blob) + len(self.__extra_blob)
+        columns["name_lengths"][idx] = len(encoded_name)
+        self.__extra_blob += encoded_name
+        columns["sizes"][idx], columns["mtimes"][idx], columns["inodes"][idx] = metainfo
+        flags = NameIndexManager.FLAG_EXISTS
+        if content_hash is not None:
+            columns["hashes"][idx] = np.frombuffer(content_hash[:16].ljust(16, b"\0"), dtype=np.uint8)
+            flags |= NameIndexManager.FLAG_HASHED
+        columns["flags"][idx] = flags
+
+    def add_name(
+            self,
+            name: Path | str,
+            idx: int,
+            content_hash: bytes | None = None,
+            metainfo: tuple[int, int, int] | None = None
+        ) -> None:
+        name = str(name)
+        if self.__is_deleted(idx):
+            self.__valid_index_count += 1
+        else:
+            self.__path_ids.remove(self.__get_path(idx))
+        metainfo = metainfo if metainfo is not None else FileOperation.get_metainfo(name)
+        self.__set_entry(idx, name, content_hash, metainfo)
+        self.__path_ids.put(name, idx)
+
+    def relabel_name(self, idx: int, name: Path | str) -> None:
+        self.add_name(name, idx, self.get_content_hash(idx))
+
+    def update_metainfo(self, idx: int, metainfo: tuple[int, int, int]) -> None:
+        self.__columns["sizes"][idx], self.__columns["mtimes"][idx], self.__columns["inodes"][idx] = metainfo
+
+    @property
+    def unhashed_ids(self) -> np.ndarray:
+        flags = self.__columns["flags"][:self.__count]
+        return np.flatnonzero(
+            flags & (NameIndexManager.FLAG_EXISTS | NameIndexManager.FLAG_HASHED) == NameIndexManager.FLAG_EXISTS
+        )
+
+    def set_content_hash(self, idx: int, content_hash: bytes) -> None:
+        self.__columns["hashes"][idx] = np.frombuffer(content_hash[:16].ljust(16, b"\0"), dtype=np.uint8)
+        self.__columns["flags"][idx] |= NameIndexManager.FLAG_HASHED
+
+    def get_content_hash(self, idx: int) -> bytes | None:
+        if idx >= self.__count or not self.__columns["flags"][idx] & NameIndexManager.FLAG_HASHED:
+            return None
+        return self.__columns["hashes"][idx].tobytes()
+
     def delete_name(self, idx: int) -> None:
-        try:
-            self.__name_index[idx][0] = NameIndexManager.NOTEXISTS
-            self.__valid_index_count -= 1
-        except IndexError:
-            pass
+        if self.__is_deleted(idx):
+            return
+        self.__path_ids.remove(self.__get_path(idx))
+        self.__columns["flags"][idx] &= 0xFF ^ NameIndexManager.FLAG_EXISTS
+        heapq.heappush(self.__free_ids, idx)
+        self.__note_member_change()
+        self.__valid_index_count -= 1
+
+    def update_dir_mtimes(self, dir_mtimes: dict[str, int]) -> None:
+        self.__dir_mtimes.update(dir_mtimes)
+
+    def forget_dirs(self, directory: str | Path | None = None) -> bool:
+        # 清除目录记录，使这些目录在下次同步时重新完整扫描；返回是否清除了记录
+        if directory is None:
+            forgotten = len(self.__dir_mtimes) > 0
+            self.__dir_mtimes.clear()
+            return forgotten
+        directory = str(Path(directory))
+        prefix = directory.rstrip("\\/") + os.sep
+        forgotten = False
+        for recorded_dir in list(self.__dir_mtimes):
+            if recorded_dir == directory or recorded_dir.startswith(prefix):
+                del self.__dir_mtimes[recorded_dir]
+                forgotten = True
+        return forgotten
 
     def reset_index(self) -> None:
+        self.__release_mapping()
         FileOperation.delete_file(self.__name_index_path)
+        FileOperation.delete_file(self.__name_index_path.with_suffix(".json"))
         self.__init_index()
 
-    def save_index(self) -> None:
-        with open(self.__name_index_path, 'w', encoding='utf-8') as f:
-            json.dump(self.__name_index, f, ensure_ascii=False, indent=4)
+    def __compact_names(self) -> None:
+        # 重命名和删除留下的无用文件名超过一半时重写文件名字节串
+        blob_length = len(self.__name_blob) + len(self.__extra_blob)
+        if self.__garbage_bytes * 2 <= blob_length:
+            return
+        names = [self.__get_path(idx) for idx in range(self.__count)]
+        flags = self.__columns["flags"][:self.__count].copy()
+        self.__name_blob = np.zeros(0, dtype=np.uint8)
+        self.__extra_blob = bytearray()
+        self.__dirs, self.__dir_ids = [], {}
+        self.__sorted_dirs, self.__dir_members = None, None
+        self.__columns["name_lengths"][:] = 0
+        for idx, name in enumerate(names):
+            if flags[idx] & NameIndexManager.FLAG_EXISTS:
+                split_at = len(os.path.dirname(name))
+                encoded_name = name[split_at:].encode("utf-8", "surrogatepass")
+                self.__columns["dir_ids"][idx] = self.__intern_dir(name[:split_at])
+                self.__columns["name_offsets"][idx] = len(self.__extra_blob)
+                self.__columns["name_lengths"][idx] = len(encoded_name)
+                self.__extra_blob += encoded_name
+            else:
+                self.__columns["dir_ids"][idx] = self.__intern_dir("")
+                self.__columns["name_offsets"][idx] = 0
+        self.__garbage_bytes = 0
+
+    def save_index(self, index_path: str | Path | None = None) -> None:
+        self.snapshot()(index_path or self.__name_index_path)
+
+    def snapshot(self) -> Callable[[str | Path], None]:
+        # 各段先复制成bytes，返回的写入函数可以在锁外执行
+        self.__release_mapping()
+        self.__compact_names()
+        dir_blob = bytearray()
+        dir_offsets = [0]
+        for directory in self.__dirs:
+            dir_blob += directory.encode("utf-8", "surrogatepass")
+            dir_offsets.append(len(dir_blob))
+        sections: dict[str, bytes] = {
+            name: column[:self.__count].tobytes() for name, column in self.__columns.items()
+        }
+        sections["name_blob"] = self.__name_blob.tobytes() + bytes(self.__extra_blob)
+        sections["dir_offsets"] = np.array(dir_offsets, dtype=np.int64).tobytes()
+        sections["dir_blob"] = bytes(dir_blob)
+        path_slots, path_hashes, path_used, path_filled = self.__path_ids.tables
+        sections["path_slots"] = path_slots.tobytes()
+        sections["path_hashes"] = path_hashes.tobytes()
+        # 顺带清掉堆中已被重新占用的位置
+        self.__collect_free_ids()
+        sections["free_ids"] = np.array(self.__free_ids, dtype=np.int64).tobytes()
+        header = {
+            "count": self.__count,
+            "dirs": self.__dir_mtimes,
+            "garbage_bytes": self.__garbage_bytes,
+            "path_map": [path_used, path_filled]
+        }
+        return lambda index_path: SectionFile.write(index_path, NameIndexManager.MAGIC, header, sections)
+
+
+
+# 向量索引与名称索引必须成对落盘：先分别写到临时文件，再创建提交标记，最后rename替换正式文件。
+# 启动时存在提交标记说明替换中途被打断，临时文件都是完整的，继续完成替换；没有标记的临时文件直接丢弃
+class IndexCheckpoint(object):
+    def __init__(self, vector_index_path: str | Path, name_index_path: str | Path) -> None:
+        self.__targets = [Path(vector_index_path), Path(name_index_path)]
+        self.__marker_path = Path(name_index_path).parent / "checkpoint.commit"
+
+    @staticmethod
+    def __tmp_path(path: Path) -> Path:
+        return path.with_name(path.name + ".tmp")
+
+    def recover(self) -> None:
+        tmp_paths = [self.__tmp_path(target) for target in self.__targets]
+        if self.__marker_path.exists():
+            logging.error("上次保存索引时中断，继续完成保存")
+            for tmp_path, target in zip(tmp_paths, self.__targets):
+                if tmp_path.exists():
+                    os.replace(tmp_path, target)
+            self.__marker_path.unlink()
+            return
+        for tmp_path in tmp_paths:
+            tmp_path.unlink(missing_ok=True)
+
+    def commit(self, writers: list[Callable[[str], None]]) -> None:
+        tmp_paths = [self.__tmp_path(target) for target in self.__targets]
+        for writer, tmp_path in zip(writers, tmp_paths):
+            Path.mkdir(tmp_path.parent, parents=True, exist_ok=True)
+            writer(str(tmp_path))
+            FileOperation.fsync_file(tmp_path)
+        with open(self.__marker_path, "w") as f:
+            f.flush()
+            os.fsync(f.fileno())
+        FileOperation.fsync_dir(self.__marker_path.parent)
+        for tmp_path, target in zip(tmp_paths, self.__targets):
+            os.replace(tmp_path, target)
+        FileOperation.fsync_dir(self.__marker_path.parent)
+        self.__marker_path.unlink()
+
+
+
+# 追加写入的变更日志，记录上次快照之后对索引的每一次修改，启动时在快照之上重放。
+# 每条记录为 头部(类型, 位置, 名称项长度, 向量长度, CRC32) + 名称项JSON + float32向量；
+# 末尾写了一半的记录按CRC识别后截断。重放是幂等的，快照与清空日志之间崩溃也不会出错
+class IndexJournal(object):
+    ADD = 1
+    SET = 2
+    DELETE = 3
+    DIRS = 4
+    HEADER = struct.Struct("<BIIII")
+    def __init__(self, journal_path: Path, dim: int) -> None:
+        self.__journal_path = Path(journal_path)
+        self.__dim = dim
+        # 快照在更新锁之外写入，写完后丢弃日志前段时可能有新记录正在追加
+        self.__lock = Lock()
+        self.__dirty = False
+        self.__created_time = time.monotonic()
+        Path.mkdir(self.__journal_path.parent, parents=True, exist_ok=True)
+        self.__journal_file: BinaryIO = open(self.__journal_path, "ab")
+
+    @property
+    def size(self) -> int:
+        with self.__lock:
+            return self.__journal_file.tell()
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.__created_time
+
+    def __write(self, kind: int, idx: int, payload: bytes, vector: bytes = b"") -> None:
+        crc = zlib.crc32(vector, zlib.crc32(payload, kind))
+        with self.__lock:
+            self.__journal_file.write(self.HEADER.pack(kind, idx, len(payload), len(vector), crc) + payload + vector)
+            self.__dirty = True
+
+    def append(self, idx: int, entry: list, fv: np.ndarray | None = None) -> None:
+        if entry[0] == NameIndexManager.NOTEXISTS:
+            self.__write(self.DELETE, idx, b"")
+            return
+        payload = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        if fv is None:
+            self.__write(self.SET, idx, payload)
+        else:
+            self.__write(self.ADD, idx, payload, np.asarray(fv, dtype=np.float32).tobytes())
+
+    def append_dirs(self, dir_mtimes: dict[str, int]) -> None:
+        self.__write(self.DIRS, 0, json.dumps(dir_mtimes, ensure_ascii=False).encode("utf-8"))
+
+    def sync(self) -> None:
+        with self.__lock:
+            if not self.__dirty:
+                return
+            self.__journal_file.flush()
+            os.fsync(self.__journal_file.fileno())
+            self.__dirty = False
+
+    def __iter_records(self, f: BinaryIO):
+        while True:
+            header = f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            kind, idx, payload_length, vector_length, crc = self.HEADER.unpack(header)
+            payload = f.read(payload_length)
+            vector = f.read(vector_length)
+            if len(payload) < payload_length or len(vector) < vector_length:
+                return
+            if zlib.crc32(vector, zlib.crc32(payload, kind)) != crc:
+                return
+            yield kind, idx, payload, vector
+
+    def replay(self, vec_idx_mgr: "VectorIndexManager", name_idx_mgr: "NameIndexManager") -> int:
+        # 名称项为NOTEXISTS当且仅当向量被标记删除，据此跳过重复的删除并在需要时恢复向量
+        replayed = 0
+        valid_length = 0
+        with open(self.__journal_path, "rb") as f:
+            for kind, idx, payload, vector in self.__iter_records(f):
+                valid_length = f.tell()
+                replayed += 1
+                if kind == self.DIRS:
+                    name_idx_mgr.forget_dirs()
+                    name_idx_mgr.update_dir_mtimes(json.loads(payload))
+                    continue
+                is_deleted = name_idx_mgr.get_name(idx) == NameIndexManager.NOTEXISTS
+                if kind == self.DELETE:
+                    if not is_deleted:
+                        name_idx_mgr.delete_name(idx)
+                        vec_idx_mgr.delete_vector(idx)
+                    continue
+                name, size, content_hash, mtime_ns, inode = json.loads(payload)
+                if kind == self.ADD:
+                    vec_idx_mgr.add_vectors(np.frombuffer(vector, dtype=np.float32).reshape(1, self.__dim), [idx])
+                elif is_deleted:
+                    vec_idx_mgr.restore_vector(idx)
+                name_idx_mgr.add_name(
+                    name, idx, bytes.fromhex(content_hash) if content_hash else None, (size, mtime_ns, inode)
+                )
+        if valid_length < self.size:
+            logging.error(f"变更日志末尾不完整，已截断: {self.__journal_path}")
+            self.__journal_file.truncate(valid_length)
+            # size取自tell()，截断后文件位置仍停在原末尾，需要移回有效长度
+            self.__journal_file.seek(valid_length)
+            os.fsync(self.__journal_file.fileno())
+        return replayed
+
+    def reset(self) -> None:
+        with self.__lock:
+            self.__reset()
+
+    def __reset(self) -> None:
+        self.__journal_file.truncate(0)
+        self.__journal_file.seek(0)
+        os.fsync(self.__journal_file.fileno())
+        self.__dirty = False
+        self.__created_time = time.monotonic()
+
+    def discard(self, length: int) -> None:
+        # 快照已包含日志的前length字节；写快照期间追加的记录复制到新文件后替换，保留下来
+        with self.__lock:
+            self.__journal_file.flush()
+            if length >= self.__journal_file.tell():
+                self.__reset()
+                return
+            tmp_path = self.__journal_path.with_suffix(".tmp")
+            with open(self.__journal_path, "rb") as src, open(tmp_path, "wb") as dst:
+                src.seek(length)
+                while chunk := src.read(1 << 20):
+                    dst.write(chunk)
+                dst.flush()
+                os.fsync(dst.fileno())
+            self.__journal_file.close()
+            os.replace(tmp_path, self.__journal_path)
+            self.__journal_file = open(self.__journal_path, "ab")
+            self.__dirty = False
+            self.__created_time = time.monotonic()
+
+    def close(self) -> None:
+        self.__journal_file.close()
+
+
+
+# 解码或编码失败的文件：路径 -> [文件大小, 修改时间(ns), 失败类型, 失败次数]。
+# 文件大小和修改时间都没变时同步会直接跳过，文件被修改后才会重试。
+# 只记录文件本身的问题；推理失败通常是模型或会话的问题，不缓存，下次同步自然重试
+class FailureCache(object):
+    UNREADABLE = "unreadable"
+    DECODE = "decode"
+    PREPROCESS = "preprocess"
+    INFERENCE = "inference"
+    FILE_ERRORS = (UNREADABLE, DECODE, PREPROCESS)
+    def __init__(self, failure_cache_path: Path) -> None:
+        self.__failure_cache_path = failure_cache_path
+        self.__init_cache()
+
+    @property
+    def failed_files(self) -> list[tuple[str, int, int, str, int]]:
+        return [(fpath, *info) for fpath, info in self.__failures.items()]
+
+    def __init_cache(self) -> None:
+        try:
+            with open(self.__failure_cache_path, "r", encoding="utf-8") as f:
+                self.__failures: dict[str, list] = json.load(f)
+        except (json.JSONDecodeError, FileNotFoundError):
+            self.__failures = {}
+        # 旧版本会把推理失败也记录下来，模型加载失败一次就会让整个图库被跳过
+        self.__failures = {
+            fpath: info for fpath, info in self.__failures.items() if info[2] in FailureCache.FILE_ERRORS
+        }
+
+    @staticmethod
+    def __get_stat(fpath: str) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(fpath)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def should_skip(self, fpath: str, size: int | None = None, mtime_ns: int | None = None) -> bool:
+        info = self.__failures.get(fpath)
+        if info is None:
+            return False
+        file_stat = (size, mtime_ns) if size is not None and mtime_ns is not None else self.__get_stat(fpath)
+        return file_stat == (info[0], info[1])
+
+    def record(self, fpath: str, error_kind: str) -> None:
+        if error_kind not in FailureCache.FILE_ERRORS:
+            return
+        file_stat = self.__get_stat(fpath)
+        if file_stat is None:
+            return
+        attempts = self.__failures.get(fpath, [0, 0, "", 0])[3] + 1
+        self.__failures[fpath] = [*file_stat, error_kind, attempts]
+
+    def discard(self, fpath: str) -> None:
+        self.__failures.pop(fpath, None)
+
+    def clear(self) -> None:
+        self.__failures.clear()
+        self.save()
+
+    def save(self) -> None:
+        with open(self.__failure_cache_path, "w", encoding="utf-8") as f:
+            json.dump(self.__failures, f, ensure_ascii=False, indent=4)
+
+
+
+# 按内容哈希持久化保存的特征向量，与HNSW图相互独立：重建索引、调整参数时无需重新推理。
+# 目录按模型指纹区分，keys.bin依次存放16字节内容哈希，vectors.f32按同样顺序存放float32特征
+class EmbeddingStore(object):
+    KEY_SIZE = 16
+    def __init__(self, store_dir: Path, model_fingerprint: str, dim: int, read_only: bool = False) -> None:
+        self.__store_dir = Path(store_dir) / model_fingerprint
+        self.__keys_path = self.__store_dir / "keys.bin"
+        self.__vectors_path = self.__store_dir / "vectors.f32"
+        self.__dim = dim
+        self.__read_only = read_only
+        self.__lock = Lock()
+        self.__vectors: np.memmap | None = None
+        self.__keys_file: BinaryIO | None = None
+        self.__vectors_file: BinaryIO | None = None
+        self.__init_store()
+
+    @property
+    def count(self) -> int:
+        return len(self.__keys)
+
+    def __init_store(self) -> None:
+        if not self.__read_only:
+            Path.mkdir(self.__store_dir, parents=True, exist_ok=True)
+        keys_bytes = self.__keys_path.read_bytes() if self.__keys_path.exists() else b""
+        vectors_size = self.__vectors_path.stat().st_size if self.__vectors_path.exists() else 0
+        count = min(len(keys_bytes) // self.KEY_SIZE, vectors_size // (self.__dim * 4))
+        self.__keys: dict[bytes, int] = {
+            keys_bytes[row * self.KEY_SIZE: (row + 1) * self.KEY_SIZE]: row
+            for row in range(count)
+        }
+        if self.__read_only:
+            return
+        # 进程在追加途中被杀时两个文件长度可能不一致，截掉不完整的尾部
+        self.__keys_file = open(self.__keys_path, "ab")
+        self.__vectors_file = open(self.__vectors_path, "ab")
+        self.__keys_file.truncate(count * self.KEY_SIZE)
+        self.__vectors_file.truncate(count * self.__dim * 4)
+
+    def __map_vectors(self) -> np.memmap:
+        if self.__vectors is None or len(self.__vectors) < len(self.__keys):
+            self.__vectors = np.memmap(self.__vectors_path, dtype=np.float32, mode="r").reshape(-1, self.__dim)
+        return self.__vectors
+
+    def get(self, key: bytes | None) -> np.ndarray | None:
+        if key is None:
+            return None
+        row = self.__keys.get(key)
+        if row is None:
+            return None
+        with self.__lock:
+            return np.array(self.__map_vectors()[row])
 
+    def put_many(self, keys: list[bytes | None], fvs: np.ndarray) -> None:
+        if self.__keys_file is None or self.__vectors_file is None:
+            return
+        with self.__lock:
+            new_rows = []
+            for key, fv in zip(keys, fvs):
+                if key is None or key in self.__keys:
+                    continue
+                self.__keys[key] = len(self.__keys)
+                new_rows.append((key, fv))
+            if not new_rows:
+                return
+            # 先写向量再写哈希，中途崩溃时只会留下没有对应哈希的向量，重启时会被截掉
+            self.__vectors_file.write(np.stack([fv for _, fv in new_rows]).astype(np.float32).tobytes())
+            self.__vectors_file.flush()
+            self.__keys_file.write(b"".join(key for key, _ in new_rows))
+            self.__keys_file.flush()
 
+    def close(self) -> None:
+        for f in (self.__keys_file, self.__vectors_file):
+            if f is not None:
+                f.close()
+        self.__keys_file = self.__vectors_file = None
+        self.__vectors = None
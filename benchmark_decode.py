@@ -0,0 +1,100 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import time
+
+
+import numpy as np
+
+
+from setting import Setting
+from encoder import MultiModalEncoder
+from utils import FileOperation, ImageOperation
+
+
+
+# 对比完整解码与快速解码(draft/reduce)：解码+预处理吞吐量，以及两条路径得到的特征的余弦相似度
+# 用法: python benchmark_decode.py <图片目录> [--limit 200]
+def build_encoder(setting: Setting, fast_decode: bool) -> MultiModalEncoder:
+    return MultiModalEncoder(
+        vocab_path=None,
+        image_encoder_path=Path(setting.get_config("model", "image_encoder_path")),
+        text_encoder_path=None,
+        mean=np.array(setting.get_config("model", "mean"), dtype=np.float32)[:, None, None],
+        std=np.array(setting.get_config("model", "std"), dtype=np.float32)[:, None, None],
+        normalization=setting.get_config("model", "normalization"),
+        image_size=setting.get_config("model", "image_size"),
+        context_length=setting.get_config("model", "context_length"),
+        max_batch_size=setting.get_config("function", "encode_batch_size", 32),
+        session_profile=setting.get_config("model", "session_profile", {}),
+        fast_decode=fast_decode,
+        max_image_pixels=setting.get_config("model", "max_image_pixels", 0)
+    )
+
+
+def run_decode(encoder: MultiModalEncoder, files: list[str]) -> tuple[np.ndarray, list[int], float]:
+    processed_images = []
+    decoded_files = []
+    start = time.perf_counter()
+    for file_idx, fpath in enumerate(files):
+        image_obj = ImageOperation.get_image_obj(fpath)
+        if image_obj is None:
+            continue
+        try:
+            processed_images.append(encoder.preprocess_image(image_obj))
+            decoded_files.append(file_idx)
+        except (OSError, ValueError):
+            continue
+    elapsed = time.perf_counter() - start
+    # 一张都没有解码成功时返回空数组，编码得到None
+    if not processed_images:
+        return np.zeros(0, dtype=np.float32), decoded_files, elapsed
+    return np.concatenate(processed_images, axis=0), decoded_files, elapsed
+
+
+def cosine(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return np.sum(a * b, axis=1)
+
+
+def main() -> None:
+    parser = ArgumentParser(description="快速解码基准测试")
+    parser.add_argument("image_dir")
+    parser.add_argument("--limit", type=int, default=200)
+    args = parser.parse_args()
+
+    setting = Setting()
+    files = []
+    for fpath in FileOperation.get_file_iterator(args.image_dir):
+        files.append(fpath)
+        if len(files) >= args.limit:
+            break
+    if not files:
+        print("目录中没有可用的图片")
+        return
+
+    results = {}
+    for fast_decode in (False, True):
+        encoder = build_encoder(setting, fast_decode)
+        processed_images, decoded_files, elapsed = run_decode(encoder, files)
+        features = encoder.encode_image_batch(processed_images)
+        results[fast_decode] = (dict(zip(decoded_files, features)) if features is not None else {})
+        name = "快速解码" if fast_decode else "完整解码"
+        throughput = len(decoded_files) / elapsed if decoded_files else 0.0
+        print(f"{name}: {len(decoded_files)}张, {elapsed:.2f}s, {throughput:.1f}张/s")
+
+    common = sorted(results[False].keys() & results[True].keys())
+    if not common:
+        return
+    similarities = cosine(
+        np.stack([results[False][i] for i in common]),
+        np.stack([results[True][i] for i in common])
+    )
+    print(
+        f"特征漂移(余弦相似度): 平均 {similarities.mean():.5f}, "
+        f"最小 {similarities.min():.5f}, P1 {np.percentile(similarities, 1):.5f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
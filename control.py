@@ -3,6 +3,7 @@ from ttkbootstrap import Style, Treeview
 from tkinterdnd2 import DND_FILES, TkinterDnD
 import tkinter as tk
 from pathlib import Path
+from threading import Lock
 from typing import Literal
 import datetime
 import os
@@ -12,6 +13,7 @@ from widgets import BasicImagePreviewView, DetailListView, ThumbnailGridView
 from setting import Setting, WinInfo
 from utils import FileOperation, ImageOperation, Decorator
 from search_tools import SearchTool
+from watcher import DirectoryWatcher, FileChanges
 import webbrowser
 
 
@@ -24,6 +26,9 @@ class CoreControl(WinGUI):
         self.setting = Setting()
         self.__change_theme(setting_theme=True)
         self.search_tools = SearchTool(self.setting)
+        self.__directory_watcher: DirectoryWatcher | None = None
+        self.__watched_dirs: list[str] = []
+        self.__watcher_lock = Lock()
         self.index_table_control = IndexTableControl(self)
         self.search_control = SearchControl(self)
         self.menu_control = MenuControl(self)
@@ -56,6 +61,7 @@ class CoreControl(WinGUI):
         self.update_index_button.config(command=self.index_table_control.sync_index)
         self.delete_index_button.config(command=self.index_table_control.delete_search_dir)
         self.rebuild_index_button.config(command=self.index_table_control.rebuild_index)
+        self.auto_update_btn.config(command=self.refresh_directory_watcher)
 
         # 常规设置项
         self.theme_combobox.bind("<<ComboboxSelected>>", lambda e: self.__change_theme())
@@ -73,6 +79,7 @@ class CoreControl(WinGUI):
         if self.setting.get_config("function", "auto_update_index"):
             self.auto_update_btn.invoke()
             self.index_table_control.sync_index(show_message=False)
+            self.refresh_directory_watcher()
         else:
             self.index_table_control.update_index_tip()
         self.after(self.setting.schedule_save_interval, self.__schedule_save)
@@ -101,6 +108,32 @@ class CoreControl(WinGUI):
             for dir_path in file_paths:
                 self.index_table_control.add_search_dir(dir_path)
 
+    @Decorator.send_task
+    def refresh_directory_watcher(self) -> None:
+        # 开启自动更新索引时监视所有索引目录，目录列表变化或关闭自动更新时重建/停止监视
+        with self.__watcher_lock:
+            search_dirs = list(self.setting.get_config("index", "search_dir"))
+            enabled = self.auto_update_btn.instate(['selected'])
+            if self.__directory_watcher is not None:
+                if enabled and search_dirs == self.__watched_dirs:
+                    return
+                self.__directory_watcher.stop()
+                self.__directory_watcher = None
+            if not enabled:
+                return
+            self.__watched_dirs = search_dirs
+            self.__directory_watcher = DirectoryWatcher(
+                search_dirs,
+                self.index_table_control.apply_file_changes,
+                backend=self.setting.get_config("function", "watch_backend", "auto"),
+                debounce=self.setting.get_config("function", "watch_debounce", 2.0),
+                poll_interval=self.setting.get_config("function", "watch_poll_interval", 30.0),
+                exclude_patterns=self.setting.get_config("index", "exclude_patterns", []),
+                skip_hidden=self.setting.get_config("index", "skip_hidden", False),
+                scan_workers=self.setting.get_config("function", "scan_workers", 8)
+            )
+            self.__directory_watcher.start()
+
     def __schedule_save(self) -> None:
         self.search_tools.save_index()
         self.after(self.setting.schedule_save_interval, self.__schedule_save)
@@ -112,8 +145,10 @@ class CoreControl(WinGUI):
             self.setting.modity_config("function", "max_work_thread", int(float(self.update_threads_count_scale.get())))
             self.setting.save_settings()
             self.setting.clean_log()
+            if self.__directory_watcher is not None:
+                self.__directory_watcher.stop()
             self.search_tools.destroy()
-            self.search_tools.save_index()
+            self.search_tools.save_index(force=True)
             FileOperation.clear_folder_all(Setting.temp_image_path)
             self.search_tools.set_force_end_update(True)
         except Exception as e:
@@ -292,6 +327,7 @@ class IndexTableControl(object):
         search_dirs.append(dir_path)
         self.refresh_index_dataset_table()
         self.core_control.setting.save_settings()
+        self.core_control.refresh_directory_watcher()
 
     def rebuild_index(self) -> None:
         answer = messagebox.askyesno("提示", "重建索引极其耗时，\n您确定要进行重建吗？")
@@ -328,13 +364,14 @@ class IndexTableControl(object):
         )
         self._is_updating = True
         self.__check_queue()
-        self.core_control.search_tools.remove_nonexists()
-        for image_dir in self.core_control.setting.get_config("index", "search_dir"):
-            if Path(image_dir).exists():
-                self.core_control.search_tools.update_index(
-                    image_dir,
-                    int(float(self.core_control.update_threads_count_scale.get()))
-                )
+        sync_plan = self.core_control.search_tools.plan_sync(
+            self.core_control.setting.get_config("index", "search_dir")
+        )
+        print(sync_plan)
+        self.core_control.search_tools.execute_sync_plan(
+            sync_plan,
+            int(float(self.core_control.update_threads_count_scale.get()))
+        )
         self.core_control.update_index_button.config(text="更新索引目录", command=self.sync_index)
         self.core_control.delete_index_button.config(state=tk.ACTIVE)
         self.core_control.rebuild_index_button.config(state=tk.ACTIVE)
@@ -367,8 +404,22 @@ class IndexTableControl(object):
             self.core_control.search_tools.remove_files_in_directory(dir_path)
         self.core_control.search_tools.remove_nonexists()
         self.core_control.setting.save_settings()
+        self.core_control.refresh_directory_watcher()
         self.core_control.after(1000, self.update_index_tip)
 
+    def apply_file_changes(self, changes: FileChanges) -> None:
+        # 目录监视回调(在监视线程中执行)：事件丢失时退回完整同步，否则只处理变化的文件
+        if changes.rescan:
+            if not self._is_updating:
+                self.sync_index(show_message=False)
+            return
+        self.core_control.search_tools.apply_file_changes(
+            changes, 
+            int(float(self.core_control.update_threads_count_scale.get()))
+        )
+        if not self._is_updating:
+            self.core_control.after(0, self.update_index_tip)
+
     def __check_queue(self) -> None:
         try:
             while True:
@@ -1,5 +1,9 @@
 from pathlib import Path
+from threading import local, Lock
+from typing import Literal
+import hashlib
 import logging
+import os
 
 
 from tokenizer import FullTokenizer
@@ -9,17 +13,45 @@ import onnxruntime as ort
 
 
 
+# per_worker模式下线程借用的会话；线程结束、线程局部变量被回收时把会话还回空闲池，下次新建的线程直接复用
+class _SessionLease(object):
+    def __init__(self, session: ort.InferenceSession, idle_sessions: list[ort.InferenceSession]) -> None:
+        self.session = session
+        self.__idle_sessions = idle_sessions
+
+    def __del__(self) -> None:
+        self.__idle_sessions.append(self.session)
+
+
+
 class MultiModalEncoder:
+    GRAPH_OPTIMIZATION_LEVELS = {
+        "disable": ort.GraphOptimizationLevel.ORT_DISABLE_ALL,
+        "basic": ort.GraphOptimizationLevel.ORT_ENABLE_BASIC,
+        "extended": ort.GraphOptimizationLevel.ORT_ENABLE_EXTENDED,
+        "all": ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    }
+    EXECUTION_MODES = {
+        "sequential": ort.ExecutionMode.ORT_SEQUENTIAL,
+        "parallel": ort.ExecutionMode.ORT_PARALLEL
+    }
+
     def __init__(
             self, 
-            vocab_path: Path, 
+            vocab_path: Path | None, 
             image_encoder_path: Path, 
-            text_encoder_path: Path, 
+            text_encoder_path: Path | None, 
             mean: np.ndarray,
             std: np.ndarray,
             normalization: bool,
             image_size: int,
-            context_length: int
+            context_length: int,
+            max_batch_size: int = 32,
+            session_profile: dict | None = None,
+            session_mode: Literal["shared", "per_worker"] = "shared",
+            session_workers: int = 1,
+            fast_decode: bool = False,
+            max_image_pixels: int = 0
         ) -> None:
 
         self.__image_size = image_size
@@ -27,9 +59,63 @@ class MultiModalEncoder:
         self.__std = std
         self.__normalization = normalization
         self.__context_length = context_length
-        self.__tokenizer = FullTokenizer(vocab_path) if vocab_path.exists() else None
-        self.image_session = self._init_onnx_session(image_encoder_path)
-        self.text_session = self._init_onnx_session(text_encoder_path)
+        self.__max_batch_size = max(1, max_batch_size)
+        self.__fast_decode = fast_decode
+        self.__max_image_pixels = max_image_pixels
+        self.__session_profile: dict = session_profile or {}
+        self.__session_mode = session_mode
+        # 同时推理的会话数(per_worker模式的推理线程数或索引子进程数)，线程数为0时按它平分CPU核心
+        self.__session_workers = max(1, session_workers)
+        self.__image_encoder_path = image_encoder_path
+        self.__fingerprint = ""
+        self.__worker_local = local()
+        self.__idle_sessions: list[ort.InferenceSession] = []
+        self.__idle_lock = Lock()
+        self.__tokenizer = FullTokenizer(vocab_path) if vocab_path is not None and vocab_path.exists() else None
+        self.__image_session = self._init_onnx_session(image_encoder_path)
+        # 仅做图像编码的场景(如索引子进程)传入None，不加载文本模型
+        self.text_session = self._init_onnx_session(text_encoder_path) if text_encoder_path is not None else None
+
+    @property
+    def fingerprint(self) -> str:
+        # 模型指纹：模型文件大小与头部内容 + 影响特征的预处理参数，任一变化都会得到不同的特征
+        if self.__fingerprint:
+            return self.__fingerprint
+        hasher = hashlib.blake2b(digest_size=8)
+        try:
+            with open(self.__image_encoder_path, "rb") as f:
+                hasher.update(str(Path(self.__image_encoder_path).stat().st_size).encode())
+                hasher.update(f.read(1024 * 1024))
+        except OSError:
+            return ""
+        hasher.update(repr((
+            self.__image_size, self.__mean.ravel().tolist(), self.__std.ravel().tolist(),
+            self.__normalization, self.__fast_decode
+        )).encode())
+        self.__fingerprint = hasher.hexdigest()
+        return self.__fingerprint
+
+    @property
+    def has_image_model(self) -> bool:
+        # 只检查模型是否加载成功，不会像image_session那样在per_worker模式下为当前线程创建会话
+        return self.__image_session is not None
+
+    @property
+    def image_session(self) -> ort.InferenceSession | None:
+        # per_worker模式下每个线程首次推理时借用一个会话(没有空闲的才新建)，shared模式下所有线程共用一个会话
+        if self.__session_mode != "per_worker" or self.__image_session is None:
+            return self.__image_session
+        lease = getattr(self.__worker_local, "image_session", None)
+        if lease is None:
+            with self.__idle_lock:
+                session = self.__idle_sessions.pop() if self.__idle_sessions else None
+            if session is None:
+                session = self._init_onnx_session(self.__image_encoder_path)
+                if session is None:
+                    return None
+            lease = _SessionLease(session, self.__idle_sessions)
+            self.__worker_local.image_session = lease
+        return lease.session
 
     def tokenize(self, texts) -> np.ndarray:
         if self.__tokenizer is None:
@@ -53,12 +139,39 @@ class MultiModalEncoder:
             result[i, :len(tokens)] = tokens
         return result
 
-    def _init_onnx_session(self, model_path) -> ort.InferenceSession | None:
+    def _init_session_options(self, model_path: Path) -> tuple[ort.SessionOptions, Path]:
+        profile = self.__session_profile
+        sess_options = ort.SessionOptions()
+        auto_threads = max(1, (os.cpu_count() or 1) // self.__session_workers)
+        sess_options.intra_op_num_threads = profile.get("intra_op_num_threads", 0) or auto_threads
+        sess_options.inter_op_num_threads = profile.get("inter_op_num_threads", 0) or auto_threads
+        sess_options.execution_mode = self.EXECUTION_MODES[profile.get("execution_mode", "sequential")]
+        sess_options.graph_optimization_level = self.GRAPH_OPTIMIZATION_LEVELS[
+            profile.get("graph_optimization_level", "all")
+        ]
+        sess_options.enable_cpu_mem_arena = profile.get("enable_cpu_mem_arena", True)
+        sess_options.enable_mem_pattern = profile.get("enable_mem_pattern", True)
+
+        optimized_model_dir = profile.get("optimized_model_dir", "")
+        if not optimized_model_dir:
+            return sess_options, model_path
+        # 图优化结果缓存到磁盘，之后直接加载优化后的模型，跳过启动时的图优化
+        level = profile.get("graph_optimization_level", "all")
+        optimized_model_path = Path(optimized_model_dir) / f"{model_path.stem}.{level}.onnx"
+        if optimized_model_path.exists() and optimized_model_path.stat().st_mtime >= model_path.stat().st_mtime:
+            sess_options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_DISABLE_ALL
+            return sess_options, optimized_model_path
+        Path.mkdir(optimized_model_path.parent, parents=True, exist_ok=True)
+        sess_options.optimized_model_filepath = str(optimized_model_path)
+        return sess_options, model_path
+
+    def _init_onnx_session(self, model_path: Path) -> ort.InferenceSession | None:
         try:
+            sess_options, model_path = self._init_session_options(Path(model_path))
             session = ort.InferenceSession(
                 str(model_path),
-                providers=['CPUExecutionProvider'],
-                provider_options=[{'intra_op_num_threads': 1, 'inter_op_num_threads': 1}]
+                sess_options=sess_options,
+                providers=['CPUExecutionProvider']
             )
             return session
         except Exception as e:
@@ -68,11 +181,30 @@ class MultiModalEncoder:
     def _normalization(self, fv: np.ndarray) -> None:
         if self.__normalization:
             norm = np.linalg.norm(fv, axis=-1, keepdims=True)
-            fv[fv == 0] = 1.0
+            norm[norm == 0] = 1.0
             fv /= norm
 
-    def _preprocess_image(self, img: Image.Image) -> np.ndarray | None:
+    def reduce_image(self, img: Image.Image) -> Image.Image:
+        # 快速解码：JPEG用draft让解码器直接按1/2~1/8缩小解码，其他格式解码后整数倍reduce，
+        # 都只缩到约2倍目标尺寸，剩下的交给最终的BICUBIC resize
+        # 像素数按原始尺寸检查，在draft之前、还未解码时就拒绝过大的图像
+        width, height = img.size
+        if self.__max_image_pixels and width * height > self.__max_image_pixels:
+            raise ValueError(f"图像像素数过大: {width}x{height}")
+        target_size = self.__image_size * 2
+        if self.__fast_decode and img.format == "JPEG":
+            img.draft("RGB", (target_size, target_size))
+            width, height = img.size
+        if not self.__fast_decode:
+            return img
+        factor = min(width, height) // target_size
+        if factor >= 2 and img.mode in ("RGB", "RGBA", "L", "LA"):
+            img = img.reduce(factor)
+        return img
+
+    def convert_image(self, img: Image.Image) -> Image.Image:
         # img = img.convert("RGB")
+        img = self.reduce_image(img)
         if img.mode in ('P', 'PA', '1', 'L', 'LA'):
             img = img.convert('RGBA')
         
@@ -83,42 +215,69 @@ class MultiModalEncoder:
             img = background
         else:
             img = img.convert("RGB")
+        return img
+
+    def image_to_array(self, img: Image.Image) -> np.ndarray:
         img = img.resize((self.__image_size, self.__image_size), Image.Resampling.BICUBIC)
         img_array = np.asarray(img, dtype=np.float32).transpose(2, 0, 1)
         img_array = (img_array / 255.0 - self.__mean) / self.__std
         img_array = np.expand_dims(img_array, axis=0)
         return img_array
 
+    def preprocess_image(self, img: Image.Image) -> np.ndarray | None:
+        return self.image_to_array(self.convert_image(img))
+
     def encode_image(self, image_obj: Image.Image) -> np.ndarray | None:
-        if self.image_session is None:
+        image_features = self.encode_images([image_obj])
+        if image_features is None:
             return None
-        
-        processed_image = self._preprocess_image(image_obj)
-        if processed_image is None:
+        return image_features[0]
+
+    def encode_images(self, image_objs: list[Image.Image]) -> np.ndarray | None:
+        if not self.has_image_model or not image_objs:
             return None
         try:
-            input_name = self.image_session.get_inputs()[0].name
-            result = self.image_session.run([], {input_name: processed_image})
-            image_features = result[0][0]
+            processed_images = [self.preprocess_image(image_obj) for image_obj in image_objs]
+        except (OSError, ValueError) as e:
+            logging.error(f"预处理图像时出现错误: {e}")
+            return None
+        return self.encode_image_batch(np.concatenate(processed_images, axis=0))
+
+    def encode_image_batch(self, processed_images: np.ndarray) -> np.ndarray | None:
+        # processed_images: (N, 3, H, W)
+        session = self.image_session
+        if session is None or len(processed_images) == 0:
+            return None
+        try:
+            image_features = self._run_batched(session, processed_images)
             self._normalization(image_features)
         except Exception as e:
             logging.error(f"编码图像时出现错误: {e}")
             return None
         return image_features
     
-    def encode_text(self, input_text: str) -> np.ndarray | None:
+    def encode_text(self, input_text: str | list[str]) -> np.ndarray | None:
         if self.text_session is None or self.__tokenizer is None:
             return None
         try:
             text = self.tokenize(input_text)
-            text_features_list = []
-            for i in range(len(text)):
-                one_text = np.expand_dims(text[i], axis=0)
-                text_feature = self.text_session.run([], {self.text_session.get_inputs()[0].name: one_text})[0].squeeze()
-                text_features_list.append(text_feature)
-            text_features = np.stack(text_features_list, axis=0)
+            text_features = self._run_batched(self.text_session, text)
             self._normalization(text_features)
             return text_features
         except Exception as e:
             logging.error(f"编码文字时出现错误: {e}")
 
+    def encode_texts(self, input_texts: list[str]) -> np.ndarray | None:
+        if not input_texts:
+            return None
+        return self.encode_text(input_texts)
+
+    def _run_batched(self, session: ort.InferenceSession, inputs: np.ndarray) -> np.ndarray:
+        # 整批送入模型，仅在超过max_batch_size时分块；batch维固定为1的模型只能逐条推理
+        model_input = session.get_inputs()[0]
+        step = 1 if model_input.shape[0] == 1 else self.__max_batch_size
+        outputs = [
+            session.run([], {model_input.name: inputs[start: start + step]})[0]
+            for start in range(0, len(inputs), step)
+        ]
+        return np.concatenate(outputs, axis=0).reshape(len(inputs), -1)
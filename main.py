@@ -1,7 +1,10 @@
+from multiprocessing import freeze_support
+
 from control import CoreControl
 
 
 if __name__ == "__main__":
+    freeze_support()
     win = CoreControl()
     win.mainloop()
 
@@ -0,0 +1,398 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, Future, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing.shared_memory import SharedMemory
+from itertools import chain, islice
+from pathlib import Path
+from queue import Queue, Empty
+from threading import Thread, Event
+from typing import Callable, Iterable, Iterator
+import logging
+import time
+
+
+import numpy as np
+from PIL import Image
+
+
+from encoder import MultiModalEncoder
+from IndexManager import EmbeddingStore, FailureCache
+from utils import FileOperation, ImageOperation
+
+
+
+# inferred为经过模型推理的项数(特征库命中与解码失败的项不计)，用于估计编码速度
+PipelineResult = namedtuple("PipelineResult", ["ids", "paths", "features", "keys", "error", "inferred"], defaults=[0])
+class PipelineStage(object):
+    STOP = None
+    def __init__(
+            self,
+            name: str,
+            target: Callable[[Queue, Queue], None],
+            workers: int,
+            in_queue: Queue,
+            out_queue: Queue
+        ) -> None:
+        self.name = name
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.__target = target
+        self.__threads = [
+            Thread(target=self.__worker, daemon=True)
+            for _ in range(max(1, workers))
+        ]
+
+    @property
+    def workers(self) -> int:
+        return len(self.__threads)
+
+    def __worker(self) -> None:
+        try:
+            self.__target(self.in_queue, self.out_queue)
+        except Exception as e:
+            logging.error(f"索引流水线阶段{self.name}异常退出: {e}")
+
+    def start(self, next_stage_workers: int) -> None:
+        for thread in self.__threads:
+            thread.start()
+        Thread(target=self.__close, args=(next_stage_workers, ), daemon=True).start()
+
+    def __close(self, next_stage_workers: int) -> None:
+        # 本阶段所有线程结束后，向下游每个线程各发送一个结束标记
+        for thread in self.__threads:
+            thread.join()
+        for _ in range(next_stage_workers):
+            self.out_queue.put(PipelineStage.STOP)
+
+
+
+# 解码 -> 预处理 -> 推理 三段式流水线，每段拥有独立的有界队列和线程数；
+# 通过queue_depths观察各段输入队列，长期堆满的那一段就是当前机器上的瓶颈
+class IndexPipeline(object):
+    def __init__(
+            self,
+            encoder: MultiModalEncoder,
+            decode_workers: int,
+            preprocess_workers: int,
+            inference_workers: int,
+            queue_size: int,
+            batch_size: int,
+            batch_wait: float,
+            pause_event: Event,
+            should_stop: Callable[[], bool],
+            store: EmbeddingStore | None = None
+        ) -> None:
+        self.__encoder = encoder
+        self.__store = store
+        self.__batch_size = max(1, batch_size)
+        self.__batch_wait = batch_wait
+        self.__pause_event = pause_event
+        self.__should_stop = should_stop
+        decode_queue: Queue[tuple[int, str] | None] = Queue(maxsize=queue_size)
+        preprocess_queue: Queue[tuple[int, str, bytes | None, Image.Image] | None] = Queue(maxsize=queue_size)
+        inference_queue: Queue[tuple[int, str, bytes | None, np.ndarray] | None] = Queue(maxsize=queue_size)
+        self.__result_queue: Queue[PipelineResult | None] = Queue(maxsize=queue_size)
+        self.__stages = [
+            PipelineStage("decode", self.__decode, decode_workers, decode_queue, preprocess_queue),
+            PipelineStage("preprocess", self.__preprocess, preprocess_workers, preprocess_queue, inference_queue),
+            PipelineStage("inference", self.__inference, inference_workers, inference_queue, self.__result_queue)
+        ]
+
+    @property
+    def queue_depths(self) -> dict[str, tuple[int, int]]:
+        depths = {stage.name: (stage.in_queue.qsize(), stage.in_queue.maxsize) for stage in self.__stages}
+        depths["result"] = (self.__result_queue.qsize(), self.__result_queue.maxsize)
+        return depths
+
+    def run(self, items: Iterable[tuple[int, str]]) -> Iterator[PipelineResult]:
+        for stage, next_stage in zip(self.__stages, self.__stages[1:]):
+            stage.start(next_stage.workers)
+        self.__stages[-1].start(1)
+        Thread(target=self.__feed, args=(items, ), daemon=True).start()
+        while True:
+            result = self.__result_queue.get()
+            if result is PipelineStage.STOP:
+                break
+            yield result
+
+    def __feed(self, items: Iterable[tuple[int, str]]) -> None:
+        decode_stage = self.__stages[0]
+        try:
+            for item in items:
+                if self.__should_stop():
+                    break
+                decode_stage.in_queue.put(item)
+        finally:
+            for _ in range(decode_stage.workers):
+                decode_stage.in_queue.put(PipelineStage.STOP)
+
+    def __decode(self, in_queue: Queue, out_queue: Queue) -> None:
+        # 每个文件单独捕获异常(损坏的PNG/GIF可能抛出SyntaxError、struct.error等)，出错只产生一条错误结果，线程继续工作。
+        # 特征库命中的项与推理一样攒满batch_size或超过batch_wait秒才产出，写入索引时整批只同步一次
+        hits: list[tuple[int, str, bytes, np.ndarray]] = []
+        deadline = 0.0
+        while True:
+            try:
+                item = in_queue.get(timeout=max(0.0, deadline - time.monotonic())) if hits else in_queue.get()
+            except Empty:
+                self.__put_hits(hits)
+                continue
+            if item is PipelineStage.STOP:
+                break
+            self.__pause_event.wait()
+            idx, fpath = item
+            if self.__should_stop():
+                continue
+            key = None
+            try:
+                # 特征库中已有相同内容的图片时直接取出特征，跳过解码和推理
+                key = FileOperation.get_content_hash(fpath)
+                fv = self.__store.get(key) if self.__store is not None else None
+                if fv is not None:
+                    if not hits:
+                        deadline = time.monotonic() + self.__batch_wait
+                    hits.append((idx, fpath, key, fv))
+                    if len(hits) >= self.__batch_size:
+                        self.__put_hits(hits)
+                    continue
+                image_obj = ImageOperation.get_image_obj(fpath)
+                if image_obj is None:
+                    self.__result_queue.put(PipelineResult([idx], [fpath], None, [key], FailureCache.UNREADABLE))
+                    continue
+                image_obj = self.__encoder.convert_image(image_obj)
+            except Exception as e:
+                logging.error(f"解码图像失败 {fpath}: {e}")
+                self.__result_queue.put(PipelineResult([idx], [fpath], None, [key], FailureCache.DECODE))
+                continue
+            out_queue.put((idx, fpath, key, image_obj))
+        self.__put_hits(hits)
+
+    def __put_hits(self, hits: list[tuple[int, str, bytes, np.ndarray]]) -> None:
+        if not hits:
+            return
+        self.__result_queue.put(PipelineResult(
+            [idx for idx, _, _, _ in hits],
+            [fpath for _, fpath, _, _ in hits],
+            np.stack([fv for _, _, _, fv in hits]),
+            [key for _, _, key, _ in hits],
+            ""
+        ))
+        hits.clear()
+
+    def __preprocess(self, in_queue: Queue, out_queue: Queue) -> None:
+        while (item := in_queue.get()) is not PipelineStage.STOP:
+            idx, fpath, key, image_obj = item
+            if self.__should_stop():
+                continue
+            try:
+                processed_image = self.__encoder.image_to_array(image_obj)
+            except Exception as e:
+                logging.error(f"预处理图像失败 {fpath}: {e}")
+                self.__result_queue.put(PipelineResult([idx], [fpath], None, [key], FailureCache.PREPROCESS))
+                continue
+            out_queue.put((idx, fpath, key, processed_image))
+
+    def __inference(self, in_queue: Queue, out_queue: Queue) -> None:
+        # 动态批处理：攒满batch_size或距本批第一张超过batch_wait秒即送入模型
+        finished = False
+        while not finished:
+            batch: list[tuple[int, str, bytes | None, np.ndarray]] = []
+            item = in_queue.get()
+            if item is PipelineStage.STOP:
+                break
+            batch.append(item)
+            deadline = time.monotonic() + self.__batch_wait
+            while len(batch) < self.__batch_size:
+                try:
+                    item = in_queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except Empty:
+                    break
+                if item is PipelineStage.STOP:
+                    finished = True
+                    break
+                batch.append(item)
+            self.__pause_event.wait()
+            ids = [idx for idx, _, _, _ in batch]
+            paths = [fpath for _, fpath, _, _ in batch]
+            keys = [key for _, _, key, _ in batch]
+            if self.__should_stop():
+                continue
+            try:
+                features = self.__encoder.encode_image_batch(
+                    np.concatenate([processed_image for _, _, _, processed_image in batch], axis=0)
+                )
+            except Exception as e:
+                logging.error(f"编码图像时出现错误: {e}")
+                features = None
+            error = "" if features is not None else FailureCache.INFERENCE
+            out_queue.put(PipelineResult(ids, paths, features, keys, error, len(batch)))
+
+
+
+# 以下为进程池后端在子进程中运行的部分：每个子进程持有自己的编码器(仅图像会话)，
+# 特征写入主进程分配的共享内存槽位，只把成功标记通过管道传回
+_worker_encoder: MultiModalEncoder | None = None
+_worker_shm: SharedMemory | None = None
+_worker_features: np.ndarray | None = None
+_worker_store: EmbeddingStore | None = None
+
+
+def _init_process_worker(
+        encoder_kwargs: dict,
+        shm_name: str,
+        shape: tuple[int, int, int],
+        store_args: tuple[Path, str, int] | None
+    ) -> None:
+    global _worker_encoder, _worker_shm, _worker_features, _worker_store
+    _worker_encoder = MultiModalEncoder(**encoder_kwargs)
+    _worker_shm = SharedMemory(name=shm_name)
+    _worker_features = np.ndarray(shape, dtype=np.float32, buffer=_worker_shm.buf)
+    # 子进程以只读方式打开特征库，新特征统一由主进程写入
+    _worker_store = EmbeddingStore(*store_args, read_only=True) if store_args is not None else None
+
+
+def _encode_in_process(slot: int, fpaths: list[str]) -> tuple[list[str], list[bytes | None], list[bool]]:
+    assert _worker_encoder is not None and _worker_features is not None
+    keys: list[bytes | None] = []
+    rows: list[np.ndarray | None] = []
+    errors: list[str] = []
+    processed_images: list[np.ndarray] = []
+    processed_rows: list[int] = []
+    for row, fpath in enumerate(fpaths):
+        keys.append(None)
+        rows.append(None)
+        errors.append("")
+        # 与线程后端一样逐个文件捕获异常，一个坏文件不影响同批的其他文件
+        try:
+            keys[row] = FileOperation.get_content_hash(fpath)
+            rows[row] = _worker_store.get(keys[row]) if _worker_store is not None else None
+            if rows[row] is not None:
+                continue
+            image_obj = ImageOperation.get_image_obj(fpath)
+            if image_obj is None:
+                errors[row] = FailureCache.UNREADABLE
+                continue
+            processed_images.append(_worker_encoder.preprocess_image(image_obj))
+            processed_rows.append(row)
+        except Exception as e:
+            logging.error(f"解码图像失败 {fpath}: {e}")
+            errors[row] = FailureCache.DECODE
+    if processed_images:
+        features = _worker_encoder.encode_image_batch(np.concatenate(processed_images, axis=0))
+        for row_idx, row in enumerate(processed_rows):
+            if features is None:
+                errors[row] = FailureCache.INFERENCE
+            else:
+                rows[row] = features[row_idx]
+    valid_rows = [fv for fv in rows if fv is not None]
+    if valid_rows:
+        _worker_features[slot, :len(valid_rows)] = np.stack(valid_rows)
+    inferred = [False] * len(fpaths)
+    for row in processed_rows:
+        inferred[row] = True
+    return errors, keys, inferred
+
+
+
+class ProcessIndexPipeline(object):
+    def __init__(
+            self,
+            encoder_kwargs: dict,
+            workers: int,
+            batch_size: int,
+            dim: int,
+            pause_event: Event,
+            should_stop: Callable[[], bool],
+            fallback: Callable[[], IndexPipeline],
+            store_args: tuple[Path, str, int] | None = None
+        ) -> None:
+        self.__encoder_kwargs = encoder_kwargs
+        self.__store_args = store_args
+        self.__workers = max(1, workers)
+        self.__batch_size = max(1, batch_size)
+        self.__dim = dim
+        # 每个进程两个槽位：一个在推理，一个排队，在途任务数因此有上限
+        self.__slots = self.__workers * 2
+        self.__busy_slots = 0
+        self.__pause_event = pause_event
+        self.__should_stop = should_stop
+        self.__fallback = fallback
+
+    @property
+    def queue_depths(self) -> dict[str, tuple[int, int]]:
+        return {"process": (self.__busy_slots, self.__slots)}
+
+    def run(self, items: Iterable[tuple[int, str]]) -> Iterator[PipelineResult]:
+        items = iter(items)
+        shape = (self.__slots, self.__batch_size, self.__dim)
+        try:
+            shm = SharedMemory(create=True, size=int(np.prod(shape)) * np.dtype(np.float32).itemsize)
+        except OSError as e:
+            logging.error(f"创建共享内存失败，改用线程后端: {e}")
+            yield from self.__fallback().run(items)
+            return
+
+        features_buffer = np.ndarray(shape, dtype=np.float32, buffer=shm.buf)
+        in_flight: dict[Future, tuple[int, list[tuple[int, str]]]] = {}
+        free_slots = list(range(self.__slots))
+        try:
+            with ProcessPoolExecutor(
+                max_workers=self.__workers,
+                initializer=_init_process_worker,
+                initargs=(self.__encoder_kwargs, shm.name, shape, self.__store_args)
+            ) as executor:
+                exhausted = False
+                while True:
+                    while free_slots and not exhausted and not self.__should_stop():
+                        self.__pause_event.wait()
+                        chunk = list(islice(items, self.__batch_size))
+                        if not chunk:
+                            exhausted = True
+                            break
+                        slot = free_slots.pop()
+                        future = executor.submit(_encode_in_process, slot, [fpath for _, fpath in chunk])
+                        in_flight[future] = (slot, chunk)
+                    self.__busy_slots = len(in_flight)
+                    if not in_flight:
+                        break
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        slot, chunk = in_flight[future]
+                        errors, keys, inferred = future.result()
+                        del in_flight[future]
+                        features = features_buffer[slot, :errors.count("")].copy()
+                        free_slots.append(slot)
+                        yield from self.__split_result(chunk, errors, keys, inferred, features)
+        except BrokenProcessPool as e:
+            logging.error(f"索引子进程异常退出，剩余任务改用线程后端: {e}")
+            unfinished = [item for _, chunk in in_flight.values() for item in chunk]
+            yield from self.__fallback().run(chain(unfinished, items))
+        finally:
+            self.__busy_slots = 0
+            shm.close()
+            shm.unlink()
+
+    @staticmethod
+    def __split_result(
+            chunk: list[tuple[int, str]],
+            errors: list[str],
+            keys: list[bytes | None],
+            inferred: list[bool],
+            features: np.ndarray
+        ) -> Iterator[PipelineResult]:
+        succeeded = [
+            (idx, fpath, key, row_inferred)
+            for (idx, fpath), key, error, row_inferred in zip(chunk, keys, errors, inferred) if not error
+        ]
+        if succeeded:
+            yield PipelineResult(
+                [idx for idx, _, _, _ in succeeded],
+                [fpath for _, fpath, _, _ in succeeded],
+                features,
+                [key for _, _, key, _ in succeeded],
+                "",
+                sum(row_inferred for _, _, _, row_inferred in succeeded)
+            )
+        for (idx, fpath), key, error, row_inferred in zip(chunk, keys, errors, inferred):
+            if error:
+                yield PipelineResult([idx], [fpath], None, [key], error, int(row_inferred))
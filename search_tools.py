@@ -1,9 +1,14 @@
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from threading import Thread, Event
+from threading import Thread, Event, Lock, RLock
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, islice
 from pathlib import Path
-from typing import Iterator
+from typing import Iterator, Iterable
 from re import split
+import tempfile
 import logging
+import json
+import os
+import time
 
 
 import numpy as np
@@ -11,133 +16,622 @@ from tqdm import tqdm
 from PIL import Image
 
 from setting import Setting
-from IndexManager import VectorIndexManager, NameIndexManager
+from IndexManager import VectorIndexManager, NameIndexManager, EmbeddingStore, FailureCache, IndexCheckpoint, IndexJournal
 from encoder import MultiModalEncoder
+from pipeline import IndexPipeline, ProcessIndexPipeline
+from watcher import FileChanges
 from utils import FileOperation, ImageOperation
 
 
+class SyncPlan(object):
+    # 一次全局同步的执行计划：所有索引目录只扫描一次，得到新增/修改/删除/移动的文件。
+    # 新文件可能有上百万个，逐行写入临时文件，执行时再按需读出，内存占用与图库大小无关
+    def __init__(self, encode_rate: float = 0.0) -> None:
+        self.changed_files: list[tuple[int, str]] = []
+        self.deleted_ids: list[int] = []
+        self.moved_files: list[tuple[int, str]] = []
+        self.scanned_dir_mtimes: dict[str, int] = {}
+        self.encode_rate = encode_rate
+        self.new_count = 0
+        self.__new_files_spool = tempfile.TemporaryFile("w+", encoding="utf-8")
+
+    @property
+    def encode_count(self) -> int:
+        return self.new_count + len(self.changed_files)
+
+    def add_new_file(self, fpath: str, size: int, mtime_ns: int) -> None:
+        self.__new_files_spool.write(json.dumps([fpath, size, mtime_ns], ensure_ascii=False) + "\n")
+        self.new_count += 1
+
+    def iter_new_files(self) -> Iterator[tuple[str, int, int]]:
+        self.__new_files_spool.flush()
+        self.__new_files_spool.seek(0)
+        for line in self.__new_files_spool:
+            fpath, size, mtime_ns = json.loads(line)
+            yield fpath, size, mtime_ns
+
+    def close(self) -> None:
+        self.__new_files_spool.close()
+
+    @property
+    def estimated_seconds(self) -> float | None:
+        # 按上一次同步实测的编码速度估算，还没有同步过时无法估计
+        if not self.encode_rate:
+            return None
+        return self.encode_count / self.encode_rate
+
+    def __str__(self) -> str:
+        summary = (
+            f"新增{self.new_count}张, 修改{len(self.changed_files)}张, "
+            f"删除{len(self.deleted_ids)}张, 移动{len(self.moved_files)}张, 需编码{self.encode_count}张"
+        )
+        if self.estimated_seconds is not None:
+            summary += f", 预计耗时{self.estimated_seconds:.0f}秒"
+        return summary
+
+
+
 class SearchTool(object):
+    # 原地覆盖写入不改变目录的修改时间，剪枝扫描发现不了，每FULL_SYNC_EVERY次同步做一次不剪枝的完整扫描
+    FULL_SYNC_EVERY = 10
+
     def __init__(self, setting: Setting) -> None:
         self.__search_event = Event()
         self.__search_event.set()
         self.__init_event = Event()
         self.__force_stop_update = False
+        # 完整同步与目录监视的增量更新可能来自不同线程，修改索引时互斥
+        self.__update_lock = RLock()
+        # 快照在更新锁内复制、锁外写入，同一时间只能有一个快照在写；先取更新锁再取此锁
+        self.__snapshot_lock = Lock()
+        self.__pipeline: IndexPipeline | ProcessIndexPipeline | None = None
+        self.__setting = setting
+        # 上次同步测得的编码速度(张/秒)，随设置一起保存，启动后第一次同步即可给出预计耗时
+        self.__encode_rate: float = setting.get_config("function", "encode_rate", 0.0)
+        self.__destroy_event = Event()
+        # remove_nonexists中消失的文件：(文件大小, 内容哈希) -> 原索引位置，用于识别移动/重命名
+        self.__vanished_files: dict[tuple[int, bytes], int] = {}
+        # 同一文件系统内移动时inode与修改时间不变：(文件大小, 修改时间ns, inode) -> 原索引位置
+        self.__vanished_inodes: dict[tuple[int, int, int], int] = {}
         Thread(target=self.__async_init, args=(setting, ), daemon=True).start()
         
     def __async_init(self, setting: Setting) -> None:
+        # 名称索引改为二进制列存储，旧配置中的.json路径作为导入来源
+        name_index_path = Path(setting.get_config("index", "name_index_path")).with_suffix(".bin")
+        self.__index_checkpoint = IndexCheckpoint(
+            setting.get_config("index", "vector_index_path"),
+            name_index_path
+        )
+        self.__index_checkpoint.recover()
+        self.__snapshot_journal_bytes: int = setting.get_config("index", "snapshot_max_journal_mb", 256) * 1024 * 1024
+        self.__snapshot_interval: float = setting.get_config("index", "snapshot_interval", 600)
         self.__vec_idx_mgr = VectorIndexManager(
             setting.get_config("index", "vector_index_path"),
-            setting.get_config("index", "index_capacity"),
+            setting.get_config("index", "index_capacity", 1024),
             setting.get_config("index", "index_space"),
-            setting.get_config("index", "index_dim")
+            setting.get_config("index", "index_dim"),
+            setting.get_config("index", "hnsw_m", 32),
+            setting.get_config("index", "hnsw_ef_construction", 200),
+            setting.get_config("index", "hnsw_ef_search", 100),
+            setting.get_config("index", "vector_backend", "hnsw"),
+            setting.get_config("index", "flat_dtype", "float32"),
+            setting.get_config("index", "flat_mmap", False),
+            setting.get_config("index", "flat_max_elements", 200000),
+            setting.get_config("index", "flat_rerank_factor", 4),
+            setting.get_config("index", "ivf_nlist", 0),
+            setting.get_config("index", "ivf_nprobe", 16)
         )
+        self.__vec_idx_mgr.remove_stale_files()
         self.__name_idx_mgr = NameIndexManager(
-            Path(setting.get_config("index", "name_index_path")),
+            name_index_path,
             setting.get_config("index", "max_match_count")
         )
-        self.__multimodal_encoder = MultiModalEncoder(
-            Path(setting.get_config("model", "vocab_path")),
-            Path(setting.get_config("model", "image_encoder_path")),
-            Path(setting.get_config("model", "text_encoder_path")),
-            np.array(setting.get_config("model", "mean"), dtype=np.float32)[:, None, None],
-            np.array(setting.get_config("model", "std"), dtype=np.float32)[:, None, None],
-            setting.get_config("model", "normalization"),
-            setting.get_config("model", "image_size"),
-            setting.get_config("model", "context_length")
+        self.__pipeline_config: dict = setting.get_config("function", "pipeline", {})
+        self.__index_backend: str = setting.get_config("function", "index_backend", "thread")
+        self.__process_workers: int = setting.get_config("function", "process_workers", 4)
+        session_mode = setting.get_config("function", "session_mode", "shared")
+        # per_worker模式下推理阶段每个线程一个会话，inference_workers为0时与进程后端的并行数一致；
+        # shared模式下只有一个会话，并发的推理共用它的线程池
+        self.__inference_workers: int = self.__pipeline_config.get("inference_workers", 0) or (
+            self.__process_workers if session_mode == "per_worker" else 1
+        )
+        self.__encoder_kwargs = dict(
+            vocab_path=Path(setting.get_config("model", "vocab_path")),
+            image_encoder_path=Path(setting.get_config("model", "image_encoder_path")),
+            text_encoder_path=Path(setting.get_config("model", "text_encoder_path")),
+            mean=np.array(setting.get_config("model", "mean"), dtype=np.float32)[:, None, None],
+            std=np.array(setting.get_config("model", "std"), dtype=np.float32)[:, None, None],
+            normalization=setting.get_config("model", "normalization"),
+            image_size=setting.get_config("model", "image_size"),
+            context_length=setting.get_config("model", "context_length"),
+            max_batch_size=setting.get_config("function", "encode_batch_size", 32),
+            session_profile=setting.get_config("model", "session_profile", {}),
+            session_mode=session_mode,
+            session_workers=self.__inference_workers if session_mode == "per_worker" else 1,
+            fast_decode=setting.get_config("model", "fast_decode", False),
+            max_image_pixels=setting.get_config("model", "max_image_pixels", 0)
         )
+        self.__multimodal_encoder = MultiModalEncoder(**self.__encoder_kwargs)
+        self.__index_dim: int = setting.get_config("index", "index_dim")
+        self.__store_dir = Path(setting.get_config(
+            "index", "embedding_store_dir",
+            str(Path(setting.get_config("index", "vector_index_path")).parent / "embeddings")
+        ))
+        self.__embedding_store = self.__init_embedding_store()
+        self.__failure_cache = FailureCache(Path(setting.get_config(
+            "index", "failure_cache_path",
+            str(Path(setting.get_config("index", "name_index_path")).parent / "failure_cache.json")
+        )))
+        self.__encode_batch_size: int = setting.get_config("function", "encode_batch_size", 32)
+        self.__encode_batch_wait: float = setting.get_config("function", "encode_batch_wait", 0.05)
+        self.__scan_workers: int = setting.get_config("function", "scan_workers", 8)
+        self.__exclude_patterns: list[str] = setting.get_config("index", "exclude_patterns", [])
+        self.__skip_hidden: bool = setting.get_config("index", "skip_hidden", False)
+        self.__prune_unchanged_dirs: bool = setting.get_config("index", "prune_unchanged_dirs", False)
+        self.__sync_count = 0
+        self.__index_journal = IndexJournal(
+            Path(setting.get_config("index", "name_index_path")).parent / "index.journal", 
+            self.__index_dim
+        )
+        self.__index_journal.replay(self.__vec_idx_mgr, self.__name_idx_mgr)
+        self.__check_index_consistency()
         self.__init_event.set()
+        Thread(target=self.__compact_journal_loop, daemon=True).start()
+
+    def __init_embedding_store(self) -> EmbeddingStore | None:
+        fingerprint = self.__multimodal_encoder.fingerprint
+        if not fingerprint:
+            return None
+        try:
+            return EmbeddingStore(self.__store_dir, fingerprint, self.__index_dim)
+        except OSError as e:
+            logging.error(f"打开特征库失败: {e}")
+            return None
+
+    def __check_index_consistency(self) -> None:
+        # 向量索引丢失或损坏而名称索引仍在时，清空名称索引，下次同步会从特征库快速重建向量
+        if self.__vec_idx_mgr.element_count == 0 and self.__name_idx_mgr.valid_index_count > 0:
+            logging.error("向量索引为空但名称索引不为空，将在下次同步时重建索引")
+            self.__name_idx_mgr.reset_index()
+            self.__index_journal.reset()
+
+    @property
+    def pipeline_queue_depths(self) -> dict[str, tuple[int, int]]:
+        if self.__pipeline is None:
+            return {}
+        return self.__pipeline.queue_depths
 
     @property
     def valid_index_count(self) -> int:
         self.__init_event.wait()
         return self.__name_idx_mgr.valid_index_count
 
-    def __get_changed_files_index(self) -> list[tuple[int, str]]:
-        changed_files_index = []
-        for idx, [index_file, old_metainfo] in enumerate(self.__name_idx_mgr.name_index):
-            if index_file == NameIndexManager.NOTEXISTS:
-                continue
-            new_metainfo = FileOperation.get_metainfo(index_file)
-            if old_metainfo != new_metainfo:
-                changed_files_index.append((idx, index_file))
-        return changed_files_index
-    
-    def __get_new_files_index(self, target_dir: str) -> list[tuple[int, str]]:
-        new_files_index = []
-        current_files = FileOperation.get_file_iterator(target_dir)
-        existing_files = set(i[0] for i in self.__name_idx_mgr.name_index)
-        new_files = []
-        for file in current_files:
-            if file not in existing_files:
-                new_files.append(file)
-            if self.__force_stop_update:
-                break
-
-        if not new_files:
-            return []
+    def __iter_allocated_ids(self, new_files: Iterable[str]) -> Iterator[tuple[int, str]]:
+        # 惰性分配：先复用名称索引记录的空位，再从开始时的末尾连续追加。
+        # 边分配边写入时add_name在末尾补出的空位属于已分配的新文件，不在空位快照中
+        index_length = self.__name_idx_mgr.count
+        reserved_ids = set(self.__vanished_files.values()) | set(self.__vanished_inodes.values())
+        free_ids = (idx for idx in self.__name_idx_mgr.iter_free_ids() if idx not in reserved_ids)
+        for new_file in new_files:
+            idx = next(free_ids, None)
+            if idx is None:
+                idx = index_length
+                index_length += 1
+            yield idx, new_file
 
-        for idx, [index_file, _] in enumerate(self.__name_idx_mgr.name_index):
-            if index_file == NameIndexManager.NOTEXISTS:
-                new_files_index.append((idx, new_files.pop())) 
-            if len(new_files) == 0:
-                break
-        for idx, new_file in enumerate(new_files, len(self.__name_idx_mgr.name_index)):
-            new_files_index.append((idx, new_file))
+    @staticmethod
+    def __match_vanished_file(
+            new_file: str, 
+            size: int, 
+            mtime_ns: int,
+            vanished_inodes: dict[tuple[int, int, int], int],
+            vanished_files: dict[tuple[int, bytes], int]
+        ) -> int | None:
+        idx = None
+        if vanished_inodes:
+            try:
+                inode = os.stat(new_file).st_ino
+            except OSError:
+                return None
+            idx = vanished_inodes.pop((size, mtime_ns, inode), None) if inode else None
+        if idx is None:
+            content_hash = FileOperation.get_content_hash(new_file)
+            idx = vanished_files.pop((size, content_hash), None) if content_hash else None
+        if idx is None:
+            return None
+        for vanished in (vanished_files, vanished_inodes):
+            for key in [key for key, vanished_idx in vanished.items() if vanished_idx == idx]:
+                del vanished[key]
+        return idx
 
-        return new_files_index
+    def __relabel_moved_files(self, new_files: list[tuple[str, int, int]]) -> list[str]:
+        # 新文件与本轮消失的文件inode相同或内容哈希相同(且大小一致)时视为移动或重命名，
+        # 直接改写原位置的路径并恢复向量
+        if not self.__vanished_files and not self.__vanished_inodes:
+            return [new_file for new_file, _, _ in new_files]
+        vanished_sizes = {key[0] for key in self.__vanished_files} | {key[0] for key in self.__vanished_inodes}
+        remaining_files = []
+        for new_file, size, mtime_ns in new_files:
+            idx = None
+            if size in vanished_sizes:
+                idx = self.__match_vanished_file(
+                    new_file, size, mtime_ns, self.__vanished_inodes, self.__vanished_files
+                )
+            if idx is None:
+                remaining_files.append(new_file)
+                continue
+            self.__name_idx_mgr.relabel_name(idx, new_file)
+            self.__vec_idx_mgr.restore_vector(idx)
+            self.__log_entries([idx])
+        return remaining_files
 
-    def __index_target_dir(self, target_dir) -> list[tuple[int, str]]:
-        changed_files_index = self.__get_changed_files_index()
-        new_files_index = self.__get_new_files_index(target_dir)
-        return changed_files_index + new_files_index
-    
     def update_max_match_count(self, max_match_count: int) -> None:
         self.__name_idx_mgr.update_max_match_count(max_match_count)
         
-    def update_index(self, image_dir, max_workers: int = 10) -> None:
-        def _process_item(item) -> tuple[int, str, np.ndarray | None]:
-            self.__search_event.wait()
-            idx, fpath = item
-            if self.__force_stop_update:
-                return idx, fpath, None
-            image_obj = ImageOperation.get_image_obj(fpath)
-            if image_obj is None:
-                fv = None
-            else:
-                fv = self.__multimodal_encoder.encode_image(image_obj)
-            return idx, fpath, fv
+    def __create_thread_pipeline(self, max_workers: int) -> IndexPipeline:
+        return IndexPipeline(
+            self.__multimodal_encoder,
+            decode_workers=max_workers,
+            preprocess_workers=self.__pipeline_config.get("preprocess_workers", 2),
+            inference_workers=self.__inference_workers,
+            queue_size=self.__pipeline_config.get("queue_size", 64),
+            batch_size=self.__encode_batch_size,
+            batch_wait=self.__encode_batch_wait,
+            pause_event=self.__search_event,
+            should_stop=lambda: self.__force_stop_update,
+            store=self.__embedding_store
+        )
+
+    def __create_pipeline(self, max_workers: int) -> IndexPipeline | ProcessIndexPipeline:
+        if self.__index_backend != "process":
+            return self.__create_thread_pipeline(max_workers)
+        # 子进程只加载图像模型，索引管理器始终由主进程独占；各进程一个会话，平分CPU核心
+        worker_encoder_kwargs = dict(
+            self.__encoder_kwargs,
+            vocab_path=None,
+            text_encoder_path=None,
+            session_mode="shared",
+            session_workers=self.__process_workers
+        )
+        store_args = None
+        if self.__embedding_store is not None:
+            store_args = (self.__store_dir, self.__multimodal_encoder.fingerprint, self.__index_dim)
+        return ProcessIndexPipeline(
+            worker_encoder_kwargs,
+            workers=self.__process_workers,
+            batch_size=self.__encode_batch_size,
+            dim=self.__index_dim,
+            pause_event=self.__search_event,
+            should_stop=lambda: self.__force_stop_update,
+            fallback=lambda: self.__create_thread_pipeline(max_workers),
+            store_args=store_args
+        )
+
+    def __execute_index_items(
+            self, 
+            need_to_update: Iterable[tuple[int, str]], 
+            total: int, 
+            max_workers: int, 
+            show_progress: bool = True
+        ) -> set[str]:
+        # need_to_update可以是惰性迭代器，流水线按有界队列逐个拉取，结果随完成写入索引；
+        # 返回因推理失败而没有索引的文件所在的目录，这些目录不能按修改时间跳过
+        if not self.__multimodal_encoder.has_image_model:
+            logging.error("图像模型未加载，跳过本次索引")
+            return {os.path.dirname(fpath) for _, fpath in need_to_update}
+        retry_dirs = set()
+        inferred_count = 0
+        start_time = time.perf_counter()
+        self.__pipeline = self.__create_pipeline(max_workers)
+        pbar = tqdm(total=total, ascii=False, ncols=50, disable=not show_progress)
+        for ids, fpaths, features, keys, error, inferred in self.__pipeline.run(need_to_update):
+            inferred_count += inferred
+            # 推理失败的整批直接丢弃，不记入失败缓存，下次同步重试
+            if error == FailureCache.INFERENCE:
+                logging.error(f"{len(fpaths)}张图片推理失败，将在下次同步时重试")
+                retry_dirs.update(os.path.dirname(fpath) for fpath in fpaths)
+            for fpath in fpaths:
+                if error:
+                    self.__failure_cache.record(fpath, error)
+                else:
+                    self.__failure_cache.discard(fpath)
+            if features is not None:
+                self.__vec_idx_mgr.add_vectors(features, ids)
+                for idx, fpath, key in zip(ids, fpaths, keys):
+                    self.__name_idx_mgr.add_name(fpath, idx, key)
+                self.__log_entries(ids, features)
+                if self.__embedding_store is not None:
+                    self.__embedding_store.put_many(keys, features)
+                self.__save_snapshot(force=False)
+            pbar.update(len(ids))
+        pbar.close()
+        self.__pipeline = None
+        # 只按经过推理的项估计编码速度，特征库命中的项几乎不耗时
+        if inferred_count >= self.__encode_batch_size and not self.__force_stop_update:
+            self.__encode_rate = inferred_count / max(time.perf_counter() - start_time, 1e-6)
+            self.__setting.modity_config("function", "encode_rate", round(self.__encode_rate, 2))
+        return retry_dirs
+
+    def plan_sync(self, search_dirs: list[str]) -> SyncPlan:
+        # 所有索引目录只扫描一次，与名称索引比对一次，得到全局的同步计划；除补齐旧索引的元信息外不修改索引
         self.__init_event.wait()
-        need_to_update = self.__index_target_dir(image_dir)
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            pbar = tqdm(total=len(need_to_update), ascii=False, ncols=50)
-            futures = [executor.submit(_process_item, item) for item in need_to_update]
-            for future in as_completed(futures):
-                idx, fpath, fv = future.result()
-                if fv is not None:
-                    self.__vec_idx_mgr.add_vector(fv, idx)
-                    self.__name_idx_mgr.add_name(fpath, idx)
-                pbar.update(1)
-            pbar.close()
-    
+        with self.__update_lock:
+            plan = SyncPlan(self.__encode_rate)
+            full_scan = self.__sync_count % SearchTool.FULL_SYNC_EVERY == 0
+            self.__sync_count += 1
+            known_dir_mtimes = self.__name_idx_mgr.dir_mtimes if self.__prune_unchanged_dirs and not full_scan else {}
+            name_index = self.__name_idx_mgr.name_index
+            # 扫描结果边产出边比对，不保留整份文件列表
+            seen = np.zeros(len(name_index), dtype=bool)
+            for search_dir in search_dirs:
+                if not Path(search_dir).is_dir():
+                    continue
+                for file, size, mtime_ns in FileOperation.scan_files(
+                    search_dir,
+                    self.__scan_workers,
+                    self.__exclude_patterns,
+                    self.__skip_hidden,
+                    known_dir_mtimes,
+                    plan.scanned_dir_mtimes
+                ):
+                    if self.__force_stop_update:
+                        plan.close()
+                        return SyncPlan(self.__encode_rate)
+                    idx = self.__name_idx_mgr.find(file)
+                    if idx is None:
+                        if not self.__failure_cache.should_skip(file, size, mtime_ns):
+                            plan.add_new_file(file, size, mtime_ns)
+                        continue
+                    seen[idx] = True
+                    _, index_size, _, index_mtime_ns, _ = name_index[idx]
+                    if size != index_size or (index_mtime_ns and mtime_ns != index_mtime_ns):
+                        plan.changed_files.append((idx, file))
+                    elif not index_mtime_ns:
+                        self.__fill_metainfo(idx, file)
+            # 修改时间变化的目录重新列出了文件，其余扫描到的目录文件列表不变
+            listed_dirs = {
+                directory for directory, dir_mtime_ns in plan.scanned_dir_mtimes.items()
+                if known_dir_mtimes.get(directory) != dir_mtime_ns
+            }
+            valid_ids = self.__name_idx_mgr.valid_ids
+            for idx in valid_ids[~seen[valid_ids]].tolist():
+                index_file = self.__name_idx_mgr.get_name(idx)
+                parent_dir = os.path.dirname(index_file)
+                if parent_dir in listed_dirs:
+                    plan.deleted_ids.append(idx)
+                elif parent_dir not in plan.scanned_dir_mtimes and not os.path.exists(index_file):
+                    plan.deleted_ids.append(idx)
+            self.__plan_moved_files(plan)
+            return plan
+
+    def __fill_metainfo(self, idx: int, index_file: str) -> None:
+        try:
+            self.__name_idx_mgr.update_metainfo(idx, FileOperation.get_metainfo(index_file))
+            self.__log_entries([idx])
+        except OSError:
+            pass
+
+    def __plan_moved_files(self, plan: SyncPlan) -> None:
+        # 与本次将被删除的文件比对inode或内容哈希，匹配上的新文件直接改写路径，不再编码
+        vanished_files: dict[tuple[int, bytes], int] = {}
+        vanished_inodes: dict[tuple[int, int, int], int] = {}
+        for idx in plan.deleted_ids:
+            _, size, _, mtime_ns, inode = self.__name_idx_mgr.name_index[idx]
+            content_hash = self.__name_idx_mgr.get_content_hash(idx)
+            if content_hash is not None:
+                vanished_files[(size, content_hash)] = idx
+            if inode:
+                vanished_inodes[(size, mtime_ns, inode)] = idx
+        if not vanished_files and not vanished_inodes:
+            return
+        vanished_sizes = {key[0] for key in vanished_files} | {key[0] for key in vanished_inodes}
+        moved_ids = set()
+        for new_file, size, mtime_ns in plan.iter_new_files():
+            if size not in vanished_sizes:
+                continue
+            idx = self.__match_vanished_file(new_file, size, mtime_ns, vanished_inodes, vanished_files)
+            if idx is None:
+                continue
+            plan.moved_files.append((idx, new_file))
+            moved_ids.add(idx)
+        plan.new_count -= len(moved_ids)
+        plan.deleted_ids = [idx for idx in plan.deleted_ids if idx not in moved_ids]
+
+    def execute_sync_plan(self, plan: SyncPlan, max_workers: int = 10) -> None:
+        self.__init_event.wait()
+        with self.__update_lock:
+            self.__vanished_files.clear()
+            self.__vanished_inodes.clear()
+            for idx in plan.deleted_ids:
+                self.__remove_vanished(idx)
+            for idx, new_file in plan.moved_files:
+                self.__name_idx_mgr.relabel_name(idx, new_file)
+                self.__log_entries([idx])
+            moved_files = {new_file for _, new_file in plan.moved_files}
+            new_files = (
+                new_file for new_file, _, _ in plan.iter_new_files() 
+                if new_file not in moved_files
+            )
+            need_to_update = chain(plan.changed_files, self.__iter_allocated_ids(new_files))
+            try:
+                retry_dirs = self.__execute_index_items(need_to_update, plan.encode_count, max_workers)
+            finally:
+                plan.close()
+            for directory in retry_dirs:
+                plan.scanned_dir_mtimes.pop(directory, None)
+            if not self.__force_stop_update:
+                self.__name_idx_mgr.update_dir_mtimes(plan.scanned_dir_mtimes)
+                self.__index_journal.append_dirs(self.__name_idx_mgr.dir_mtimes)
+                self.__backfill_content_hashes()
+            # 本次计划中的移动已经处理完，不再为消失的文件保留位置
+            self.__vanished_files.clear()
+            self.__vanished_inodes.clear()
+            self.__save_snapshot(force=False)
+
+    def __backfill_content_hashes(self, batch_size: int = 1024) -> None:
+        # 旧版本索引中的文件没有内容哈希，移动或重命名后只能重新编码；同步结束后逐批补算，
+        # 只读取文件头/中/尾的采样，索引之后又被修改过的文件留给下次同步
+        unhashed_ids = iter(self.__name_idx_mgr.unhashed_ids.tolist())
+        with ThreadPoolExecutor(max_workers=self.__scan_workers) as executor:
+            while ids := list(islice(unhashed_ids, batch_size)):
+                if self.__force_stop_update:
+                    return
+                entries = [self.__name_idx_mgr.get_entry(idx) for idx in ids]
+                for idx, content_hash in zip(ids, executor.map(self.__hash_unchanged_file, entries)):
+                    if content_hash is None:
+                        continue
+                    self.__name_idx_mgr.set_content_hash(idx, content_hash)
+                    self.__log_entries([idx])
+                self.__save_snapshot(force=False)
+
+    @staticmethod
+    def __hash_unchanged_file(entry: list) -> bytes | None:
+        index_file, size, _, mtime_ns, _ = entry
+        try:
+            new_size, new_mtime_ns, _ = FileOperation.get_metainfo(index_file)
+        except OSError:
+            return None
+        if new_size != size or new_mtime_ns != mtime_ns:
+            return None
+        return FileOperation.get_content_hash(index_file)
+
+    def __log_entries(self, ids: list[int], features: np.ndarray | None = None) -> None:
+        name_index = self.__name_idx_mgr.name_index
+        for i, idx in enumerate(ids):
+            self.__index_journal.append(idx, name_index[idx], features[i] if features is not None else None)
+
+    def __save_snapshot(self, force: bool = True) -> None:
+        # 每批修改都先fsync变更日志；日志超过snapshot_max_journal_mb或距上次快照超过snapshot_interval秒时，
+        # 才把完整索引写成新快照，并丢弃日志中快照已包含的部分。
+        # 索引在更新锁内复制，写文件与fsync在锁外进行(调用方自己持有更新锁时除外)；已有快照在写时不重复保存
+        with self.__update_lock:
+            if not self.__snapshot_lock.acquire(blocking=force):
+                return
+            try:
+                self.__index_journal.sync()
+                journal_size = self.__index_journal.size
+                if journal_size == 0 or not force and (
+                    journal_size < self.__snapshot_journal_bytes and
+                    self.__index_journal.age < self.__snapshot_interval
+                ):
+                    self.__snapshot_lock.release()
+                    return
+                writers = [self.__vec_idx_mgr.snapshot(), self.__name_idx_mgr.snapshot()]
+                self.__failure_cache.save()
+            except Exception as e:
+                self.__snapshot_lock.release()
+                logging.error(f"保存索引时出现错误: {e}")
+                return
+        try:
+            self.__index_checkpoint.commit(writers)
+            self.__index_journal.discard(journal_size)
+            self.__vec_idx_mgr.remove_superseded_files()
+        except Exception as e:
+            logging.error(f"保存索引时出现错误: {e}")
+        finally:
+            self.__snapshot_lock.release()
+
+    def __compact_journal_loop(self) -> None:
+        # 后台按大小/时间策略合并日志，只在复制索引时占用更新锁
+        while not self.__destroy_event.wait(60):
+            self.__save_snapshot(force=False)
+
+    def __remove_vanished(self, idx: int) -> None:
+        # 记录消失文件的inode与内容哈希，之后出现的同一文件可以直接复用向量
+        _, size, _, mtime_ns, inode = self.__name_idx_mgr.name_index[idx]
+        content_hash = self.__name_idx_mgr.get_content_hash(idx)
+        if content_hash is not None:
+            self.__vanished_files[(size, content_hash)] = idx
+        if inode:
+            self.__vanished_inodes[(size, mtime_ns, inode)] = idx
+        self.__name_idx_mgr.delete_name(idx)
+        self.__vec_idx_mgr.delete_vector(idx)
+        self.__log_entries([idx])
+
     def remove_nonexists(self) -> None:
+        # 按所在目录分组，每个目录只并行列出一次，与索引中的文件名求差得到已消失的文件，
+        # 网络路径上不再是每个文件一次往返
         self.__init_event.wait()
-        for idx, (index_file, _) in tqdm(enumerate(self.__name_idx_mgr.name_index), ascii=False, ncols=50):
-            if Path(index_file).exists() or index_file == NameIndexManager.NOTEXISTS:
-                continue
-            self.__name_idx_mgr.delete_name(idx)
-            self.__vec_idx_mgr.delete_vector(idx)
+        with self.__update_lock:
+            self.__vanished_files.clear()
+            self.__vanished_inodes.clear()
+            directories = list(self.__name_idx_mgr.iter_directories())
+            with ThreadPoolExecutor(max_workers=self.__scan_workers) as executor:
+                listings = executor.map(FileOperation.list_file_names, [directory for directory, _ in directories])
+                for (_, ids), file_names in tqdm(zip(directories, listings), total=len(directories), ascii=False, ncols=50):
+                    for idx in ids.tolist():
+                        index_file = self.__name_idx_mgr.get_name(idx)
+                        if file_names is None:
+                            vanished = not os.path.exists(index_file)
+                        else:
+                            vanished = os.path.basename(index_file) not in file_names
+                        if vanished:
+                            self.__remove_vanished(idx)
+            self.__save_snapshot(force=False)
 
     def remove_files_in_directory(self, directory: str) -> None:
         self.__init_event.wait()
-        directory_path = Path(directory).resolve()
-        for idx, (index_file, _) in enumerate(self.__name_idx_mgr.name_index):
-            if index_file == NameIndexManager.NOTEXISTS:
-                continue
-            file_path = Path(index_file).resolve()
-            if not file_path.is_relative_to(directory_path):
-                continue
-            self.__name_idx_mgr.delete_name(idx)
-            self.__vec_idx_mgr.delete_vector(idx)
+        with self.__update_lock:
+            self.__name_idx_mgr.forget_dirs(directory)
+            self.__index_journal.append_dirs(self.__name_idx_mgr.dir_mtimes)
+            ids = self.__name_idx_mgr.ids_in_directory(directory).tolist()
+            for idx in ids:
+                self.__name_idx_mgr.delete_name(idx)
+            self.__vec_idx_mgr.delete_vectors(ids)
+            self.__log_entries(ids)
+            self.__save_snapshot(force=False)
+
+    def apply_file_changes(self, changes: FileChanges, max_workers: int = 4) -> None:
+        # 目录监视的增量更新：移动直接改写路径，删除只标记向量，新增或修改的文件走同一条编码流水线
+        self.__init_event.wait()
+        with self.__update_lock:
+            upserts = list(changes.upserts)
+            for src, dst in changes.moves:
+                idx = self.__name_idx_mgr.find(src)
+                if idx is None:
+                    upserts.append(dst)
+                    continue
+                dst_idx = self.__name_idx_mgr.find(dst)
+                if dst_idx is not None:
+                    self.__remove_vanished(dst_idx)
+                self.__name_idx_mgr.relabel_name(idx, dst)
+                self.__log_entries([idx])
+            dirs_forgotten = False
+            for path in changes.deletes:
+                idx = self.__name_idx_mgr.find(path)
+                if idx is not None:
+                    self.__remove_vanished(idx)
+                    continue
+                # 不是已索引的文件时按目录处理，删除其下的所有文件
+                for idx in self.__name_idx_mgr.ids_in_directory(path).tolist():
+                    self.__remove_vanished(idx)
+                dirs_forgotten |= self.__name_idx_mgr.forget_dirs(path)
+            # 整批只记录一次目录表
+            if dirs_forgotten:
+                self.__index_journal.append_dirs(self.__name_idx_mgr.dir_mtimes)
+
+            need_to_update = []
+            new_files = []
+            for path in upserts:
+                try:
+                    size, mtime_ns, _ = FileOperation.get_metainfo(path)
+                except OSError:
+                    continue
+                idx = self.__name_idx_mgr.find(path)
+                if idx is None:
+                    if not self.__failure_cache.should_skip(path, size, mtime_ns):
+                        new_files.append((path, size, mtime_ns))
+                    continue
+                _, old_size, _, old_mtime_ns, _ = self.__name_idx_mgr.name_index[idx]
+                if size != old_size or mtime_ns != old_mtime_ns:
+                    need_to_update.append((idx, path))
+            need_to_update.extend(self.__iter_allocated_ids(self.__relabel_moved_files(new_files)))
+            # 没有在这一批中出现的消失文件按删除处理，它们的位置可以复用
+            self.__vanished_files.clear()
+            self.__vanished_inodes.clear()
+            if need_to_update:
+                self.__execute_index_items(need_to_update, len(need_to_update), max_workers, show_progress=False)
+            self.__save_snapshot(force=False)
 
     def checkout(self, content: Image.Image | str) -> Iterator[tuple[str, float]]:
         self.__init_event.wait()
@@ -148,35 +642,75 @@ class SearchTool(object):
         if isinstance(content, Image.Image):
             fv = self.__multimodal_encoder.encode_image(content)
         else:
-            keywords = split(r"[\s|,]", content)
-            if len(keywords) > 1:
-                combine_sentence = f"一张照片同时包含了{'、'.join(keywords[:-2])}和{keywords[-1]}"
-            else:
-                combine_sentence = content
-            fv = self.__multimodal_encoder.encode_text(combine_sentence)
+            fv = self.__multimodal_encoder.encode_text(self.__combine_keywords(content))
 
         if fv is None:
             return
         sim_list, ids_list = self.__vec_idx_mgr.match(fv, results_count)
         for img_id, similarity in zip(ids_list, sim_list):
-            yield (self.__name_idx_mgr.name_index[img_id][0], similarity)
+            yield (self.__name_idx_mgr.get_name(img_id), similarity)
         self.continue_update_index()
 
+    def checkout_texts(self, contents: list[str]) -> list[list[tuple[str, float]]]:
+        self.__init_event.wait()
+        results_count = self.__name_idx_mgr.results_count
+        contents = [content for content in contents if content != ""]
+        if results_count == 0 or not contents:
+            return []
+        fvs = self.__multimodal_encoder.encode_texts([self.__combine_keywords(content) for content in contents])
+        if fvs is None:
+            return []
+        all_results = []
+        for fv in fvs:
+            sim_list, ids_list = self.__vec_idx_mgr.match(fv[None, :], results_count)
+            all_results.append([
+                (self.__name_idx_mgr.get_name(img_id), similarity)
+                for img_id, similarity in zip(ids_list, sim_list)
+            ])
+        return all_results
+
+    @staticmethod
+    def __combine_keywords(content: str) -> str:
+        keywords = split(r"[\s|,]", content)
+        if len(keywords) > 1:
+            return f"一张照片同时包含了{'、'.join(keywords[:-2])}和{keywords[-1]}"
+        return content
+
     def is_empty_index(self) -> bool:
         return self.__name_idx_mgr.results_count == 0
     
     def reset_index(self) -> None:
         self.__init_event.wait()
-        self.__vec_idx_mgr.reset_index()
-        self.__name_idx_mgr.reset_index()
+        # 等正在写的快照完成，避免它在清空之后又替换回旧的索引文件
+        with self.__update_lock, self.__snapshot_lock:
+            self.__vec_idx_mgr.reset_index()
+            self.__name_idx_mgr.reset_index()
+            self.__index_journal.reset()
 
-    def save_index(self) -> None:
+    def save_index(self, force: bool = False) -> None:
+        # 退出时force为True，写一次完整快照：下次启动不必重放日志，完整精度向量文件的代数也与索引一致
         self.__init_event.wait()
+        # 正在更新索引时不打断，更新过程会按进度自行保存
+        if not self.__update_lock.acquire(blocking=False):
+            return
         try:
-            self.__vec_idx_mgr.save_index()
-            self.__name_idx_mgr.save_index()
-        except Exception as e:
-            logging.error(f"保存索引时出现错误: {e}")
+            self.__save_snapshot(force=force)
+            self.__failure_cache.save()
+        finally:
+            self.__update_lock.release()
+
+    def list_failed_files(self) -> list[tuple[str, int, int, str, int]]:
+        self.__init_event.wait()
+        return self.__failure_cache.failed_files
+
+    def clear_failed_files(self) -> None:
+        self.__init_event.wait()
+        with self.__update_lock:
+            for fpath, *_ in self.__failure_cache.failed_files:
+                self.__name_idx_mgr.forget_dirs(os.path.dirname(fpath))
+            self.__index_journal.append_dirs(self.__name_idx_mgr.dir_mtimes)
+            self.__index_journal.sync()
+            self.__failure_cache.clear()
 
     def stop_update_index(self) -> None:
         self.__search_event.clear()
@@ -188,6 +722,7 @@ class SearchTool(object):
         self.__search_event.set()
 
     def destroy(self) -> None:
+        self.__destroy_event.set()
         self.__search_event.set()
         self.__init_event.set()
 
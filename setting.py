@@ -32,9 +32,11 @@ class Setting(object):
                 except (ValueError, IndexError):
                     pass
 
-    def get_config(self, config_type: Literal["model", "index", "function"], key: str):
+    def get_config(self, config_type: Literal["model", "index", "function"], key: str, default=KeyError):
         config_type_key = f"{config_type}_config"
-        return self.__config[config_type_key][key]
+        if default is KeyError:
+            return self.__config[config_type_key][key]
+        return self.__config[config_type_key].get(key, default)
 
     def modity_config(self, config_type: Literal["model", "index", "function"], key: str, content) -> None:
         self.__config[f"{config_type}_config"][key] = content
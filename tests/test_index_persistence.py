@@ -0,0 +1,160 @@
+from pathlib import Path
+
+import numpy as np
+
+from IndexManager import VectorIndexManager, NameIndexManager, IndexJournal, IvfBackend, SectionFile
+
+
+DIM = 8
+
+
+def make_vectors(count: int, seed: int = 0) -> np.ndarray:
+    # 围绕若干中心的聚类数据，训练倒排列表时各列表都不为空
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(16, DIM)) * 4
+    return (centers[rng.integers(0, 16, count)] + rng.normal(size=(count, DIM))).astype(np.float32)
+
+
+def make_entry(idx: int) -> list:
+    return [f"/images/{idx}.jpg", 100 + idx, f"{idx:032x}", 1000 + idx, 0]
+
+
+def test_journal_replay_truncates_torn_tail(tmp_path: Path):
+    journal_path = tmp_path / "index.journal"
+    fvs = make_vectors(4)
+    journal = IndexJournal(journal_path, DIM)
+    for idx in range(3):
+        journal.append(idx, make_entry(idx), fvs[idx])
+    journal.sync()
+    valid_length = journal.size
+    journal.append(3, make_entry(3), fvs[3])
+    journal.sync()
+    journal.close()
+    # 模拟写到一半时崩溃：最后一条记录只剩前半段
+    with open(journal_path, "r+b") as f:
+        f.truncate(valid_length + 10)
+
+    vec_idx_mgr = VectorIndexManager(str(tmp_path / "vector_index.bin"), 16, "l2", DIM, backend="flat")
+    name_idx_mgr = NameIndexManager(tmp_path / "name_index.bin", 10)
+    journal = IndexJournal(journal_path, DIM)
+    assert journal.replay(vec_idx_mgr, name_idx_mgr) == 3
+    assert journal.size == valid_length
+    assert name_idx_mgr.find("/images/2.jpg") == 2
+    assert name_idx_mgr.find("/images/3.jpg") is None
+    assert vec_idx_mgr.element_count == 3
+
+    # 截断后继续追加的记录接在有效部分之后，再次重放时完整可读
+    journal.append(3, make_entry(3), fvs[3])
+    journal.sync()
+    journal.close()
+    vec_idx_mgr = VectorIndexManager(str(tmp_path / "vector_index.bin"), 16, "l2", DIM, backend="flat")
+    name_idx_mgr = NameIndexManager(tmp_path / "name_index.bin", 10)
+    journal = IndexJournal(journal_path, DIM)
+    assert journal.replay(vec_idx_mgr, name_idx_mgr) == 4
+    assert name_idx_mgr.find("/images/3.jpg") == 3
+    assert np.allclose(vec_idx_mgr.get_vectors([3]), fvs[3:4])
+    journal.close()
+
+
+def test_name_index_round_trip(tmp_path: Path):
+    name_index_path = tmp_path / "name_index.bin"
+    name_idx_mgr = NameIndexManager(name_index_path, 10)
+    for idx in range(6):
+        entry = make_entry(idx)
+        name_idx_mgr.add_name(entry[0], idx, bytes.fromhex(entry[2]), (entry[1], entry[3], entry[4]))
+    name_idx_mgr.delete_name(1)
+    name_idx_mgr.add_name("/moved/4.jpg", 4, bytes.fromhex(make_entry(4)[2]), (104, 1004, 0))
+    name_idx_mgr.update_dir_mtimes({"/images": 123})
+    name_idx_mgr.save_index()
+
+    loaded = NameIndexManager(name_index_path, 10)
+    assert loaded.valid_index_count == 5
+    assert loaded.find("/images/0.jpg") == 0
+    assert loaded.find("/images/1.jpg") is None
+    assert loaded.find("/images/4.jpg") is None
+    assert loaded.find("/moved/4.jpg") == 4
+    assert loaded.get_name(1) == NameIndexManager.NOTEXISTS
+    assert loaded.get_entry(5) == make_entry(5)
+    assert loaded.get_content_hash(4) == bytes.fromhex(make_entry(4)[2])
+    assert loaded.dir_mtimes == {"/images": 123}
+    assert list(loaded.iter_free_ids()) == [1]
+
+    # 复用空位后再次保存加载
+    loaded.add_name("/images/new.jpg", 1, None, (1, 1, 0))
+    loaded.save_index()
+    reloaded = NameIndexManager(name_index_path, 10)
+    assert reloaded.find("/images/new.jpg") == 1
+    assert list(reloaded.iter_free_ids()) == []
+
+
+def add_to_ivf(backend: IvfBackend, fvs: np.ndarray, ids: list[int]) -> None:
+    # 与VectorIndexManager相同的调用顺序
+    backend.reserve(ids)
+    backend.add(fvs, ids)
+    flush = backend.prepare_flush()
+    if flush is not None:
+        backend.apply_flush(flush)
+    rewrite = backend.prepare_rewrite()
+    if rewrite is not None:
+        backend.apply_rewrite(rewrite)
+
+
+def test_ivf_round_trip_and_retrain(tmp_path: Path, monkeypatch):
+    monkeypatch.setattr(IvfBackend, "MIN_TRAIN_ROWS", 500)
+    monkeypatch.setattr(IvfBackend, "SEGMENT_ROWS", 200)
+    monkeypatch.setattr(IvfBackend, "MAX_SEGMENTS", 3)
+    index_path = tmp_path / "vector_index.bin"
+    fvs = make_vectors(1200)
+    backend = IvfBackend("l2", DIM, 16, index_path, nlist=8, nprobe=8)
+    for start in range(0, 400, 100):
+        add_to_ivf(backend, fvs[start: start + 100], list(range(start, start + 100)))
+    assert backend.nlist == 1
+    for start in range(400, 1000, 100):
+        add_to_ivf(backend, fvs[start: start + 100], list(range(start, start + 100)))
+    # 达到训练规模后按新的聚类中心重写
+    assert backend.nlist == 8
+    backend.delete(10)
+    backend.delete(11)
+    backend.restore(11)
+    backend.save(index_path)
+
+    loaded = IvfBackend("l2", DIM, 16, index_path, nlist=8, nprobe=8)
+    loaded.load(index_path)
+    assert loaded.nlist == 8
+    assert loaded.element_count == 1000
+    assert np.allclose(loaded.get_items([0, 500, 999]), fvs[[0, 500, 999]])
+    _, labels = loaded.search(fvs[11], 1)
+    assert labels[0] == 11
+    _, labels = loaded.search(fvs[10], 5)
+    assert 10 not in labels
+    # 已删除的向量加载后仍可恢复
+    loaded.restore(10)
+    _, labels = loaded.search(fvs[10], 1)
+    assert labels[0] == 10
+
+    # 加载后继续写入并落成新段但不保存：只读加载不清理，由持有索引的进程在恢复后清理
+    add_to_ivf(loaded, fvs[1000:], list(range(1000, 1200)))
+    loaded.save(index_path)
+    segment_dir = tmp_path / "vector_index.ivf"
+    saved_segments = {path.name for path in segment_dir.glob("*.seg")}
+    add_to_ivf(loaded, fvs[:IvfBackend.SEGMENT_ROWS], list(range(1200, 1200 + IvfBackend.SEGMENT_ROWS)))
+    unsaved_segments = {path.name for path in segment_dir.glob("*.seg")} - saved_segments
+    assert unsaved_segments
+    reloaded = IvfBackend("l2", DIM, 16, index_path, nlist=8, nprobe=8)
+    reloaded.load(index_path)
+    assert reloaded.element_count == 1200
+    assert unsaved_segments <= {path.name for path in segment_dir.glob("*.seg")}
+    reloaded.remove_unreferenced_segments()
+    assert not unsaved_segments & {path.name for path in segment_dir.glob("*.seg")}
+    again = IvfBackend("l2", DIM, 16, index_path, nlist=8, nprobe=8)
+    again.load(index_path)
+    assert np.allclose(again.get_items(list(range(1000, 1200))), fvs[1000:1200])
+
+    # 合并后再次保存：提交检查点后，之前保存过而新快照不再引用的段被删除
+    for start in range(0, 4 * IvfBackend.SEGMENT_ROWS, IvfBackend.SEGMENT_ROWS):
+        ids = list(range(1200 + start, 1200 + start + IvfBackend.SEGMENT_ROWS))
+        add_to_ivf(again, fvs[start: start + IvfBackend.SEGMENT_ROWS], ids)
+    again.save(index_path)
+    again.remove_superseded_segments()
+    _, header = SectionFile.read(index_path, IvfBackend.MAGIC)
+    assert {path.name for path in segment_dir.glob("*.seg")} == {name for name, _ in header["segments"]}
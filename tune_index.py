@@ -0,0 +1,153 @@
+from argparse import ArgumentParser
+from pathlib import Path
+import time
+
+
+import numpy as np
+import hnswlib
+
+
+from setting import Setting
+from IndexManager import VectorIndexManager, NameIndexManager
+
+
+
+# 离线调优HNSW参数：从现有索引中抽样，暴力计算精确的top-k作为基准，
+# 遍历M/ef_construction/ef，给出recall@k、单次查询p50/p99延迟与索引大小，选出满足召回率要求且p99最低的参数写入配置
+# 用法: python tune_index.py [--k 10] [--sample 50000] [--queries 200] [--target-recall 0.95] [--dry-run]
+def load_library(setting: Setting, sample: int, queries: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    # 按现有索引文件的后端读取向量，不触发后端转换
+    vector_index_path = setting.get_config("index", "vector_index_path")
+    vec_idx_mgr = VectorIndexManager(
+        vector_index_path,
+        setting.get_config("index", "index_capacity", 1024),
+        setting.get_config("index", "index_space"),
+        setting.get_config("index", "index_dim"),
+        backend=VectorIndexManager.stored_kind(vector_index_path)
+    )
+    name_idx_mgr = NameIndexManager(
+        Path(setting.get_config("index", "name_index_path")).with_suffix(".bin"),
+        setting.get_config("index", "max_match_count")
+    )
+    ids = np.random.default_rng(seed).permutation(name_idx_mgr.valid_ids)
+    query_ids, base_ids = ids[:queries], ids[queries: queries + sample]
+    base = vec_idx_mgr.get_vectors(base_ids.tolist())
+    query = vec_idx_mgr.get_vectors(query_ids.tolist())
+    return base, query
+
+
+def exact_top_k(base: np.ndarray, query: np.ndarray, k: int, space: str, block_size: int = 64) -> np.ndarray:
+    # 按查询分块计算全部距离，argpartition取前k个
+    base_norms = np.einsum("ij,ij->i", base, base)
+    results = []
+    for start in range(0, len(query), block_size):
+        scores = query[start: start + block_size] @ base.T
+        distances = -scores if space == "cosine" else base_norms[None, :] - 2 * scores
+        results.append(np.argpartition(distances, k - 1, axis=1)[:, :k])
+    return np.concatenate(results, axis=0)
+
+
+def evaluate(
+        base: np.ndarray,
+        query: np.ndarray,
+        ground_truth: np.ndarray,
+        space: str,
+        k: int,
+        hnsw_m: int,
+        ef_construction: int,
+        ef_values: list[int]
+    ) -> list[dict]:
+    hnsw_index = hnswlib.Index(space=space, dim=base.shape[1])
+    hnsw_index.init_index(max_elements=len(base), ef_construction=ef_construction, M=hnsw_m, random_seed=42)
+    start = time.perf_counter()
+    hnsw_index.add_items(base, np.arange(len(base)))
+    build_time = time.perf_counter() - start
+    index_size = hnsw_index.index_file_size()
+    # 程序中每次只查询一条，按单线程逐条计时
+    hnsw_index.set_num_threads(1)
+    results = []
+    for ef in ef_values:
+        hnsw_index.set_ef(ef)
+        latencies = []
+        hits = 0
+        for fv, expected in zip(query, ground_truth):
+            start = time.perf_counter()
+            labels, _ = hnsw_index.knn_query(fv[None, :], k=k)
+            latencies.append(time.perf_counter() - start)
+            hits += len(np.intersect1d(labels[0], expected))
+        results.append({
+            "hnsw_m": hnsw_m,
+            "hnsw_ef_construction": ef_construction,
+            "hnsw_ef_search": ef,
+            "recall": hits / (len(query) * k),
+            "p50_ms": np.percentile(latencies, 50) * 1000,
+            "p99_ms": np.percentile(latencies, 99) * 1000,
+            "size_mb": index_size / 1024 / 1024,
+            "build_s": build_time
+        })
+    return results
+
+
+def choose(results: list[dict], target_recall: float) -> dict:
+    qualified = [result for result in results if result["recall"] >= target_recall]
+    if not qualified:
+        return max(results, key=lambda result: result["recall"])
+    return min(qualified, key=lambda result: (result["p99_ms"], result["size_mb"]))
+
+
+def main() -> None:
+    parser = ArgumentParser(description="HNSW参数调优")
+    parser.add_argument("--k", type=int, default=None, help="默认为max_match_count")
+    parser.add_argument("--sample", type=int, default=50000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--m", type=int, nargs="+", default=[8, 16, 32, 48])
+    parser.add_argument("--ef-construction", type=int, nargs="+", default=[100, 200, 400])
+    parser.add_argument("--ef", type=int, nargs="+", default=[10, 20, 40, 80, 100, 200, 400])
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--dry-run", action="store_true", help="只输出结果，不写入配置")
+    args = parser.parse_args()
+
+    setting = Setting()
+    k = args.k or setting.get_config("index", "max_match_count")
+    space = setting.get_config("index", "index_space")
+    if not Path(setting.get_config("index", "vector_index_path")).exists():
+        print("没有找到向量索引，请先建立索引")
+        return
+    base, query = load_library(setting, args.sample, args.queries, args.seed)
+    if len(base) <= k or len(query) == 0:
+        print("索引中的图片太少，无法调优")
+        return
+    ground_truth = exact_top_k(base, query, k, space)
+    ef_values = sorted({max(ef, k) for ef in args.ef})
+    print(f"样本{len(base)}张, 查询{len(query)}次, k={k}")
+
+    results = []
+    for hnsw_m in args.m:
+        for ef_construction in args.ef_construction:
+            for result in evaluate(base, query, ground_truth, space, k, hnsw_m, ef_construction, ef_values):
+                results.append(result)
+                print(
+                    f"M={result['hnsw_m']:<3} ef_construction={result['hnsw_ef_construction']:<4} "
+                    f"ef={result['hnsw_ef_search']:<4} recall@{k}={result['recall']:.4f} "
+                    f"p50={result['p50_ms']:.3f}ms p99={result['p99_ms']:.3f}ms "
+                    f"大小={result['size_mb']:.1f}MB 构建={result['build_s']:.1f}s"
+                )
+
+    chosen = choose(results, args.target_recall)
+    if chosen["recall"] < args.target_recall:
+        print(f"没有参数达到召回率{args.target_recall}，选择召回率最高的一组")
+    print(
+        f"选择: M={chosen['hnsw_m']}, ef_construction={chosen['hnsw_ef_construction']}, "
+        f"ef={chosen['hnsw_ef_search']}, recall@{k}={chosen['recall']:.4f}, p99={chosen['p99_ms']:.3f}ms"
+    )
+    if args.dry_run:
+        return
+    for key in ("hnsw_m", "hnsw_ef_construction", "hnsw_ef_search"):
+        setting.modity_config("index", key, chosen[key])
+    setting.save_settings()
+    print(f"已写入{Setting.config_path}，M与ef_construction在重建索引后生效")
+
+
+if __name__ == "__main__":
+    main()
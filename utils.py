@@ -2,12 +2,16 @@ from pathlib import Path
 from queue import Queue
 from threading import Thread
 from typing import Iterator, Callable
-from collections import namedtuple
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from fnmatch import fnmatch
 import logging
+import stat
 import unicodedata
 import os
 import subprocess
 import functools
+import hashlib
 import ctypes
 import sys
 import io
@@ -76,9 +80,88 @@ class Decorator(object):
 class FileOperation(object):
     @staticmethod
     def get_file_iterator(target_dir) -> Iterator[str]:
-        for file_path in tqdm(Path(target_dir).rglob('*'), desc="扫描文件"):
-            if file_path.is_file() and file_path.suffix.lower() in Setting.accepted_exts:
-                yield str(file_path)
+        for file_path, _, _ in FileOperation.scan_files(target_dir):
+            yield file_path
+
+    @staticmethod
+    def __is_excluded(entry: os.DirEntry, exclude_patterns: list[str], skip_hidden: bool) -> bool:
+        if skip_hidden:
+            if entry.name.startswith("."):
+                return True
+            # Windows下DirEntry自带文件属性，不会额外产生stat调用
+            if os.name == "nt" and entry.stat(follow_symlinks=False).st_file_attributes & stat.FILE_ATTRIBUTE_HIDDEN:
+                return True
+        return any(fnmatch(entry.name, pattern) or fnmatch(entry.path, pattern) for pattern in exclude_patterns)
+
+    @staticmethod
+    def __scan_directory(
+            directory: str,
+            exclude_patterns: list[str],
+            skip_hidden: bool,
+            known_mtime_ns: int | None
+        ) -> tuple[list[tuple[str, int, int]], list[str], str, int]:
+        # 目录修改时间与上次记录一致时，说明其中的文件列表没有变化，只继续向下找子目录
+        files = []
+        sub_dirs = []
+        try:
+            dir_mtime_ns = os.stat(directory).st_mtime_ns
+            listing_changed = dir_mtime_ns != known_mtime_ns
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    try:
+                        if FileOperation.__is_excluded(entry, exclude_patterns, skip_hidden):
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            sub_dirs.append(entry.path)
+                        elif not listing_changed:
+                            continue
+                        elif entry.is_file() and os.path.splitext(entry.name)[1].lower() in Setting.accepted_exts:
+                            entry_stat = entry.stat()
+                            files.append((entry.path, entry_stat.st_size, entry_stat.st_mtime_ns))
+                    except OSError:
+                        continue
+        except OSError as e:
+            logging.error(f"扫描目录失败 {directory}: {e}")
+            return [], [], directory, 0
+        return files, sub_dirs, directory, dir_mtime_ns
+
+    @staticmethod
+    def scan_files(
+            target_dir: str | Path,
+            max_workers: int = 8,
+            exclude_patterns: list[str] | None = None,
+            skip_hidden: bool = False,
+            known_dir_mtimes: dict[str, int] | None = None,
+            scanned_dir_mtimes: dict[str, int] | None = None,
+            show_progress: bool = True
+        ) -> Iterator[tuple[str, int, int]]:
+        # 基于os.scandir的并行扫描，复用DirEntry中的类型与stat信息，产出(路径, 大小, 修改时间ns)；
+        # 传入known_dir_mtimes时跳过文件列表未变化的目录，scanned_dir_mtimes收集本次扫描到的目录修改时间
+        exclude_patterns = exclude_patterns or []
+        known_dir_mtimes = known_dir_mtimes or {}
+        pending_dirs: deque[str] = deque([str(Path(target_dir))])
+        running: set[Future] = set()
+        pbar = tqdm(desc="扫描文件", disable=not show_progress)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while pending_dirs or running:
+                while pending_dirs and len(running) < max_workers * 2:
+                    directory = pending_dirs.popleft()
+                    running.add(executor.submit(
+                        FileOperation.__scan_directory, 
+                        directory, 
+                        exclude_patterns, 
+                        skip_hidden, 
+                        known_dir_mtimes.get(directory)
+                    ))
+                done, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    files, sub_dirs, directory, dir_mtime_ns = future.result()
+                    if scanned_dir_mtimes is not None and dir_mtime_ns:
+                        scanned_dir_mtimes[directory] = dir_mtime_ns
+                    pending_dirs.extend(sub_dirs)
+                    pbar.update(len(files))
+                    yield from files
+        pbar.close()
 
     @staticmethod
     def open_file(file_path: str | Path, highlight: bool = False) -> None:
@@ -152,6 +235,22 @@ class FileOperation(object):
         except (FileNotFoundError, OSError) as e:
             logging.error(f"删除文件失败: {file_path}")
 
+    @staticmethod
+    def fsync_file(file_path: str | Path) -> None:
+        with open(file_path, "rb+") as f:
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def fsync_dir(dir_path: str | Path) -> None:
+        # Windows下无法打开目录做fsync，rename本身由NTFS日志保证
+        if os.name == "nt":
+            return
+        fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
     @staticmethod
     def save_as(src_path: str | Path, dest_path: str | Path, is_binary: bool = False, inplace=True) -> bool:
         src_path = Path(src_path)
@@ -217,9 +316,38 @@ class FileOperation(object):
         return str(file_path.name)
 
     @staticmethod
-    def get_metainfo(file_path: str | Path) -> int:
-        file_size = os.path.getsize(file_path)
-        return file_size
+    def get_metainfo(file_path: str | Path) -> tuple[int, int, int]:
+        # (文件大小, 修改时间ns, inode)；不支持inode的文件系统上inode为0
+        file_stat = os.stat(file_path)
+        return file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino
+
+    @staticmethod
+    def list_file_names(dir_path: str | Path) -> set[str] | None:
+        # 列出目录下的所有文件名；目录不存在时为空集合，无法读取时返回None，由调用方逐个检查
+        try:
+            with os.scandir(dir_path) as entries:
+                return {entry.name for entry in entries}
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+        except OSError:
+            return None
+
+    @staticmethod
+    def get_content_hash(file_path: str | Path, sample_size: int = 65536) -> bytes | None:
+        # 快速内容哈希：文件大小 + 头/中/尾各取一段，不读全文件
+        try:
+            with open(file_path, "rb") as f:
+                file_size = os.fstat(f.fileno()).st_size
+                hasher = hashlib.blake2b(file_size.to_bytes(8, "little"), digest_size=16)
+                if file_size <= sample_size * 3:
+                    hasher.update(f.read())
+                    return hasher.digest()
+                for offset in (0, (file_size - sample_size) // 2, file_size - sample_size):
+                    f.seek(offset)
+                    hasher.update(f.read(sample_size))
+                return hasher.digest()
+        except OSError:
+            return None
 
     @staticmethod
     def generate_unique_filename(target_dir: Path, suffix: str) -> Path:
@@ -310,9 +438,10 @@ class ImageOperation(object):
 
     @staticmethod
     def get_image_obj(image_path: str | Path) -> ImageFile | None:
+        # 像素数超过PIL上限(MAX_IMAGE_PIXELS的2倍)时Image.open抛出DecompressionBombError，同样视为无法读取
         try:
             return Image.open(image_path)
-        except (UnidentifiedImageError, OSError, FileNotFoundError) as e:
+        except (UnidentifiedImageError, OSError, FileNotFoundError, Image.DecompressionBombError) as e:
             return
         
 
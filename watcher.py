@@ -0,0 +1,447 @@
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from threading import Thread, Event, Lock
+from pathlib import Path
+from typing import Callable
+from fnmatch import fnmatch
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+
+
+from setting import Setting
+from utils import FileOperation
+
+
+
+# 一批防抖后的文件变化；rescan为True表示事件有丢失(如inotify队列溢出)，需要完整同步一次
+FileChanges = namedtuple("FileChanges", ["upserts", "deletes", "moves", "rescan"])
+
+
+class ChangeQueue(object):
+    # 同一路径的多次事件合并为最终状态，静默debounce秒(或距首个事件max_delay秒)后整批交给回调
+    def __init__(self, callback: Callable[[FileChanges], None], debounce: float = 2.0, max_delay: float = 30.0) -> None:
+        self.__callback = callback
+        self.__debounce = debounce
+        self.__max_delay = max(max_delay, debounce)
+        self.__lock = Lock()
+        self.__wakeup = Event()
+        self.__stop_event = Event()
+        self.__changes: dict[str, str] = {}
+        self.__moves: dict[str, str] = {}
+        self.__rescan = False
+        self.__first_event_time = 0.0
+        self.__last_event_time = 0.0
+        self.__thread: Thread | None = None
+
+    def __touch(self) -> None:
+        now = time.monotonic()
+        if not self.__changes and not self.__moves and not self.__rescan:
+            self.__first_event_time = now
+        self.__last_event_time = now
+        self.__wakeup.set()
+
+    def put_upsert(self, path: str) -> None:
+        with self.__lock:
+            self.__touch()
+            self.__changes[path] = "upsert"
+
+    def put_delete(self, path: str) -> None:
+        with self.__lock:
+            self.__touch()
+            # 刚移动过来又被删除：等价于删除移动前的路径
+            path = self.__moves.pop(path, path)
+            self.__changes[path] = "delete"
+
+    def put_move(self, src: str, dst: str) -> None:
+        with self.__lock:
+            self.__touch()
+            self.__changes.pop(dst, None)
+            if src in self.__moves:
+                # a->b->c 合并为 a->c
+                self.__moves[dst] = self.__moves.pop(src)
+            elif self.__changes.get(src) == "upsert":
+                # 移动前已被修改，旧向量不能复用
+                self.__changes[src] = "delete"
+                self.__changes[dst] = "upsert"
+            else:
+                self.__moves[dst] = src
+
+    def request_rescan(self) -> None:
+        with self.__lock:
+            self.__touch()
+            self.__rescan = True
+
+    def __take_changes(self) -> FileChanges:
+        with self.__lock:
+            changes = FileChanges(
+                upserts=[path for path, kind in self.__changes.items() if kind == "upsert"],
+                deletes=[path for path, kind in self.__changes.items() if kind == "delete"],
+                moves=[(src, dst) for dst, src in self.__moves.items()],
+                rescan=self.__rescan
+            )
+            self.__changes = {}
+            self.__moves = {}
+            self.__rescan = False
+            return changes
+
+    def __is_due(self) -> bool:
+        with self.__lock:
+            if not self.__changes and not self.__moves and not self.__rescan:
+                return False
+            now = time.monotonic()
+            return (
+                now - self.__last_event_time >= self.__debounce or
+                now - self.__first_event_time >= self.__max_delay
+            )
+
+    def __run(self) -> None:
+        while not self.__stop_event.is_set():
+            self.__wakeup.wait(self.__debounce)
+            self.__wakeup.clear()
+            if not self.__is_due():
+                continue
+            changes = self.__take_changes()
+            try:
+                self.__callback(changes)
+            except Exception as e:
+                logging.error(f"应用文件变化时出现错误: {e}")
+
+    def start(self) -> None:
+        self.__thread = Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stop_event.set()
+        self.__wakeup.set()
+
+
+
+class BasicWatcher(ABC):
+    def __init__(
+            self,
+            directories: list[str],
+            change_queue: ChangeQueue,
+            exclude_patterns: list[str] | None = None,
+            skip_hidden: bool = False
+        ) -> None:
+        self._directories = [str(Path(directory)) for directory in directories]
+        self._change_queue = change_queue
+        self._exclude_patterns = exclude_patterns or []
+        self._skip_hidden = skip_hidden
+        self._stop_event = Event()
+        self._thread: Thread | None = None
+
+    def _is_excluded(self, path: str) -> bool:
+        name = os.path.basename(path)
+        if self._skip_hidden and name.startswith("."):
+            return True
+        return any(fnmatch(name, pattern) or fnmatch(path, pattern) for pattern in self._exclude_patterns)
+
+    def _is_image(self, path: str) -> bool:
+        return os.path.splitext(path)[1].lower() in Setting.accepted_exts and not self._is_excluded(path)
+
+    @abstractmethod
+    def _run(self) -> None:
+        pass
+
+    def start(self) -> None:
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+
+
+class PollingWatcher(BasicWatcher):
+    # 定时扫描并与上次快照比较各文件的大小与修改时间。平时只重新列出修改时间变化的目录，
+    # 能发现新增、删除与重命名；原地覆盖写入不改变目录的修改时间，由每FULL_POLL_EVERY次一次的完整扫描发现
+    FULL_POLL_EVERY = 10
+    def __init__(
+            self,
+            directories: list[str],
+            change_queue: ChangeQueue,
+            exclude_patterns: list[str] | None = None,
+            skip_hidden: bool = False,
+            poll_interval: float = 30.0,
+            scan_workers: int = 8
+        ) -> None:
+        super().__init__(directories, change_queue, exclude_patterns, skip_hidden)
+        self.__poll_interval = poll_interval
+        self.__scan_workers = scan_workers
+        self.__dir_mtimes: dict[str, int] = {}
+        # 目录 -> {文件路径: (大小, 修改时间ns)}
+        self.__dir_files: dict[str, dict[str, tuple[int, int]]] = {}
+
+    def __poll(self, report: bool, full: bool = False) -> None:
+        scanned_dir_mtimes: dict[str, int] = {}
+        listed_files: dict[str, dict[str, tuple[int, int]]] = {}
+        for directory in self._directories:
+            for fpath, size, mtime_ns in FileOperation.scan_files(
+                directory,
+                self.__scan_workers,
+                self._exclude_patterns,
+                self._skip_hidden,
+                None if full else self.__dir_mtimes,
+                scanned_dir_mtimes,
+                show_progress=False
+            ):
+                listed_files.setdefault(os.path.dirname(fpath), {})[fpath] = (size, mtime_ns)
+        dir_files: dict[str, dict[str, tuple[int, int]]] = {}
+        for directory, dir_mtime_ns in scanned_dir_mtimes.items():
+            if not full and self.__dir_mtimes.get(directory) == dir_mtime_ns:
+                dir_files[directory] = self.__dir_files.get(directory, {})
+                continue
+            dir_files[directory] = listed_files.get(directory, {})
+            if not report:
+                continue
+            old_files = self.__dir_files.get(directory, {})
+            for fpath, metainfo in dir_files[directory].items():
+                if old_files.get(fpath) != metainfo:
+                    self._change_queue.put_upsert(fpath)
+            for fpath in old_files.keys() - dir_files[directory].keys():
+                self._change_queue.put_delete(fpath)
+        if report:
+            for directory in self.__dir_files.keys() - dir_files.keys():
+                for fpath in self.__dir_files[directory]:
+                    self._change_queue.put_delete(fpath)
+        self.__dir_mtimes = scanned_dir_mtimes
+        self.__dir_files = dir_files
+
+    def _run(self) -> None:
+        self.__poll(report=False, full=True)
+        polls = 0
+        while not self._stop_event.wait(self.__poll_interval):
+            polls += 1
+            try:
+                self.__poll(report=True, full=polls % PollingWatcher.FULL_POLL_EVERY == 0)
+            except Exception as e:
+                logging.error(f"轮询目录变化时出现错误: {e}")
+
+
+
+class InotifyWatcher(BasicWatcher):
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_DELETE_SELF = 0x00000400
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(
+            self,
+            directories: list[str],
+            change_queue: ChangeQueue,
+            exclude_patterns: list[str] | None = None,
+            skip_hidden: bool = False
+        ) -> None:
+        super().__init__(directories, change_queue, exclude_patterns, skip_hidden)
+        self.__libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.__fd = -1
+        self.__watch_dirs: dict[int, str] = {}
+
+    def __add_watch(self, directory: str) -> None:
+        wd = self.__libc.inotify_add_watch(self.__fd, os.fsencode(directory), self.WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"添加目录监视失败 {directory}: {os.strerror(errno)}")
+        self.__watch_dirs[wd] = directory
+
+    def __add_tree(self, directory: str, report: bool) -> None:
+        # 先加监视再列目录，列目录期间新建的文件也不会漏掉(最多重复上报一次)
+        self.__add_watch(directory)
+        try:
+            with os.scandir(directory) as entries:
+                entries = list(entries)
+        except OSError:
+            return
+        for entry in entries:
+            if self._is_excluded(entry.path):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    self.__add_tree(entry.path, report)
+                elif report and entry.is_file() and self._is_image(entry.path):
+                    self._change_queue.put_upsert(entry.path)
+            except OSError:
+                continue
+
+    def __watch_new_tree(self, directory: str) -> None:
+        try:
+            self.__add_tree(directory, report=True)
+        except OSError as e:
+            logging.error(f"{e}，将完整同步一次")
+            self._change_queue.request_rescan()
+
+    def __rename_tree(self, src: str, dst: str) -> None:
+        prefix = src + os.sep
+        for wd, directory in self.__watch_dirs.items():
+            if directory == src:
+                self.__watch_dirs[wd] = dst
+            elif directory.startswith(prefix):
+                self.__watch_dirs[wd] = dst + directory[len(src):]
+
+    def __iter_events(self, buffer: bytes):
+        offset = 0
+        while offset + self.EVENT_HEADER.size <= len(buffer):
+            wd, mask, cookie, length = self.EVENT_HEADER.unpack_from(buffer, offset)
+            offset += self.EVENT_HEADER.size
+            name = os.fsdecode(buffer[offset: offset + length].rstrip(b"\0"))
+            offset += length
+            yield wd, mask, cookie, name
+
+    def __handle_events(self, buffer: bytes) -> None:
+        # 同一次read中的MOVED_FROM/MOVED_TO按cookie配对成移动，未配对的视为移出或移入监视范围
+        moved_from: dict[int, tuple[str, bool]] = {}
+        for wd, mask, cookie, name in self.__iter_events(buffer):
+            if mask & self.IN_Q_OVERFLOW:
+                logging.error("目录监视事件队列溢出，将完整同步一次")
+                self._change_queue.request_rescan()
+                continue
+            if mask & self.IN_IGNORED:
+                self.__watch_dirs.pop(wd, None)
+                continue
+            directory = self.__watch_dirs.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            is_dir = bool(mask & self.IN_ISDIR)
+            if self._is_excluded(path):
+                continue
+            if mask & self.IN_MOVED_FROM:
+                moved_from[cookie] = (path, is_dir)
+            elif mask & self.IN_MOVED_TO and cookie in moved_from:
+                src, _ = moved_from.pop(cookie)
+                if not is_dir:
+                    self.__on_file_moved(src, path)
+                    continue
+                # 目录移动：旧路径整体删除，新路径下的文件由inode匹配直接复用向量
+                self.__rename_tree(src, path)
+                self._change_queue.put_delete(src)
+                self.__watch_new_tree(path)
+            elif is_dir and mask & (self.IN_CREATE | self.IN_MOVED_TO):
+                self.__watch_new_tree(path)
+            elif is_dir and mask & self.IN_DELETE:
+                self._change_queue.put_delete(path)
+            elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO) and self._is_image(path):
+                self._change_queue.put_upsert(path)
+            elif mask & self.IN_DELETE and self._is_image(path):
+                self._change_queue.put_delete(path)
+        for path, _ in moved_from.values():
+            self._change_queue.put_delete(path)
+
+    def __on_file_moved(self, src: str, dst: str) -> None:
+        if self._is_image(src) and self._is_image(dst):
+            self._change_queue.put_move(src, dst)
+        elif self._is_image(src):
+            self._change_queue.put_delete(src)
+        elif self._is_image(dst):
+            self._change_queue.put_upsert(dst)
+
+    def _run(self) -> None:
+        try:
+            while not self._stop_event.is_set():
+                readable, _, _ = select.select([self.__fd], [], [], 0.5)
+                if not readable:
+                    continue
+                self.__handle_events(os.read(self.__fd, 256 * 1024))
+        except OSError as e:
+            logging.error(f"目录监视异常退出，将完整同步一次: {e}")
+            self._change_queue.request_rescan()
+        finally:
+            os.close(self.__fd)
+            self.__fd = -1
+
+    def start(self) -> None:
+        self.__fd = self.__libc.inotify_init1(self.IN_CLOEXEC)
+        if self.__fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"初始化inotify失败: {os.strerror(errno)}")
+        try:
+            for directory in self._directories:
+                self.__add_tree(directory, report=False)
+        except OSError:
+            # 通常是超出了max_user_watches，交给调用方退回轮询
+            os.close(self.__fd)
+            self.__fd = -1
+            raise
+        super().start()
+
+
+
+class DirectoryWatcher(object):
+    # 监视所有索引目录：Linux下优先inotify，不可用时(其他系统、监视数量超限等)退回轮询
+    def __init__(
+            self,
+            directories: list[str],
+            callback: Callable[[FileChanges], None],
+            backend: str = "auto",
+            debounce: float = 2.0,
+            poll_interval: float = 30.0,
+            exclude_patterns: list[str] | None = None,
+            skip_hidden: bool = False,
+            scan_workers: int = 8
+        ) -> None:
+        self.__directories = [directory for directory in directories if Path(directory).is_dir()]
+        self.__backend = backend
+        self.__poll_interval = poll_interval
+        self.__exclude_patterns = exclude_patterns or []
+        self.__skip_hidden = skip_hidden
+        self.__scan_workers = scan_workers
+        self.__change_queue = ChangeQueue(callback, debounce, max(debounce * 10, debounce))
+        self.__watcher: BasicWatcher | None = None
+
+    @property
+    def backend(self) -> str:
+        if isinstance(self.__watcher, InotifyWatcher):
+            return "inotify"
+        if isinstance(self.__watcher, PollingWatcher):
+            return "polling"
+        return ""
+
+    def __create_inotify_watcher(self) -> InotifyWatcher | None:
+        if not sys.platform.startswith("linux") or self.__backend not in ("auto", "inotify"):
+            return None
+        try:
+            watcher = InotifyWatcher(
+                self.__directories, self.__change_queue, self.__exclude_patterns, self.__skip_hidden
+            )
+            watcher.start()
+            return watcher
+        except (OSError, AttributeError) as e:
+            logging.error(f"inotify不可用，改用轮询监视目录: {e}")
+            return None
+
+    def start(self) -> None:
+        if not self.__directories or self.__watcher is not None:
+            return
+        self.__change_queue.start()
+        self.__watcher = self.__create_inotify_watcher()
+        if self.__watcher is None:
+            self.__watcher = PollingWatcher(
+                self.__directories,
+                self.__change_queue,
+                self.__exclude_patterns,
+                self.__skip_hidden,
+                self.__poll_interval,
+                self.__scan_workers
+            )
+            self.__watcher.start()
+
+    def stop(self) -> None:
+        if self.__watcher is not None:
+            self.__watcher.stop()
+            self.__watcher = None
+        self.__change_queue.stop()